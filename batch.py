@@ -0,0 +1,268 @@
+# 
+# Batch scheduler of file operations
+# 
+# The jobs are classified by the operation and the formats :
+#   io  : wav to wav operations (chunk, clip, join, vol, channel), which copy
+#         or scale the PCM and are bound by the disk
+#   cpu : mp3 encodes / decodes, resampling and chains, which are bound by the cores
+# Each queue has its own thread pool, so copies do not wait behind encodes and
+# encodes do not oversubscribe the cores : a cpu job takes a core slot per ffmpeg it runs
+# (conv --jobs N takes N) out of the workers of the queue. The work is done by ffmpeg or by
+# I/O which releases the GIL, so threads are enough. Larger jobs start first to reduce the tail.
+# With a memory budget, each job reserves its estimated memory before it starts, so the
+# large jobs run fewer at once and a job over the budget runs alone.
+# 
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import pipeline
+import sound_api
+from sound_api import SoundFileError
+
+
+OPERATIONS = {
+    'conv': sound_api.convert_file,
+    'vol': sound_api.change_volume_file,
+    'channel': sound_api.change_channels_file,
+    'chunk': sound_api.remove_chunks_file,
+    'clip': sound_api.clip_file,
+    'join': sound_api.join_files,
+    'samrate': sound_api.change_samrate_file,
+    'chain': pipeline.chain_file,
+}
+
+QUEUES = ('io', 'cpu')
+DEFAULT_IO_JOBS = 4
+FFMPEG_MEMORY = 64 << 20        # ffmpeg streams the file, about constant for any length
+
+
+@dataclass
+class Job:
+    operation: str          # key of OPERATIONS
+    sources: tuple
+    destination: str
+    params: dict = field(default_factory=dict)      # keyword arguments of the operation
+    verify: bool = False    # verify the output after the operation
+    start: int | None = None    # clip range, for the verification
+    end: int | None = None
+    line: int = 0           # line number in the batch file
+    queue: str = ''
+    size: int = 0           # bytes of the sources
+
+
+@dataclass
+class JobResult:
+    job: Job
+    result: sound_api.FileResult | None = None
+    error: str | None = None
+    skipped: bool = False
+    report: dict | None = None      # verification report
+    seconds: float = 0.0
+
+
+@dataclass
+class QueueStats:
+    name: str
+    workers: int
+    jobs: int = 0
+    failed: int = 0
+    busy: float = 0.0       # sec, sum of the job times
+    bytes: int = 0          # bytes of the sources
+    first_start: float | None = None
+    last_end: float | None = None
+
+    @property
+    def wall(self):
+        if self.first_start is None:
+            return 0.0
+        return self.last_end - self.first_start
+
+    @property
+    def utilization(self):
+        """
+        Busy time of the workers / available time of the workers while the queue had jobs
+        """
+        if self.wall <= 0:
+            return 0.0
+        return self.busy / (self.workers * self.wall)
+
+
+def classify(job):
+    """
+    'io' or 'cpu' queue of the job
+    """
+    formats = {sound_api._extension(path) for path in (*job.sources, job.destination)}
+    if '.mp3' in formats or job.operation in ('samrate', 'chain'):
+        return 'cpu'
+    return 'io'
+
+
+def _source_size(job):
+    size = 0
+    for path in job.sources:
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+
+def footprint(job):
+    """
+    Estimated peak memory of the job (bytes)
+    """
+    memory = FFMPEG_MEMORY * max(1, job.params.get('jobs') or 1)
+    if job.operation == 'chunk':
+        # the PCM is copied by blocks, one block at most
+        try:
+            info = sound_api.probe(job.sources[0])
+            frame_size = info.channels * info.sample_width
+            memory = min(info.frames, sound_api.copy_block_frames(frame_size)) * frame_size
+        except (SoundFileError, OSError):
+            pass
+    return memory
+
+
+def core_slots(job, cores):
+    """
+    Core slots of the job out of cores, one per ffmpeg process it runs at once
+    """
+    if job.queue != 'cpu':
+        return 0
+    return min(max(1, job.params.get('jobs') or 1), cores)
+
+
+class Gate:
+    """
+    Weighted semaphore : reservations of a budget (bytes of memory, core slots),
+    a job over the budget waits for all the others
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.reserved = 0
+        self.peak = 0
+        self.waits = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        """
+        Wait until size fits in the budget, returns the reserved size
+        """
+        size = min(size, self.budget)
+        with self.condition:
+            if self.reserved + size > self.budget:
+                self.waits += 1
+                self.condition.wait_for(lambda: self.reserved + size <= self.budget)
+            self.reserved += size
+            self.peak = max(self.peak, self.reserved)
+        return size
+
+    def release(self, size):
+        with self.condition:
+            self.reserved -= size
+            self.condition.notify_all()
+
+
+def plan(jobs):
+    """
+    Classify the jobs and order them by the size of the sources, larger first
+    """
+    for job in jobs:
+        job.queue = classify(job)
+        job.size = _source_size(job)
+    return sorted(jobs, key=lambda job: job.size, reverse=True)
+
+
+class Scheduler:
+    def __init__(self, cpu_jobs=None, io_jobs=DEFAULT_IO_JOBS, skip_existing=False, max_memory=None):
+        self.workers = {'cpu': cpu_jobs or os.cpu_count() or 1, 'io': io_jobs or DEFAULT_IO_JOBS}
+        self.skip_existing = skip_existing
+        self.gate = Gate(max_memory) if max_memory else None
+        self.cores = Gate(self.workers['cpu'])
+        self.stats = {name: QueueStats(name, self.workers[name]) for name in QUEUES}
+        self.lock = threading.Lock()
+
+    def _run(self, job):
+        if self.skip_existing and sound_api.output_exists(job.destination) and not job.params.get('overwrite'):
+            # done by an earlier run, the outputs are renamed only when complete
+            return JobResult(job, skipped=True)
+
+        # always in this order, the cores and then the memory
+        slots = self.cores.acquire(core_slots(job, self.cores.budget))
+        reserved = self.gate.acquire(footprint(job)) if self.gate is not None else 0
+        started = time.perf_counter()
+        job_result = JobResult(job)
+        try:
+            job_result.result = OPERATIONS[job.operation](*job.sources, job.destination, **job.params)
+            if job.verify:
+                import verify
+
+                # the verification reads the output, which may be pending by the batch fsync policy
+                sound_api.flush_outputs()
+                job_result.report = verify.verify_result(job_result.result, job.start, job.end)
+                if not job_result.report['ok']:
+                    job_result.error = 'Verification failed. ' + ' / '.join(job_result.report['issues'])
+        except Exception as e:
+            # an unexpected error of a job fails the job only, the other jobs go on
+            job_result.error = sound_api.error_message(e)
+        finally:
+            if self.gate is not None:
+                self.gate.release(reserved)
+            self.cores.release(slots)
+        ended = time.perf_counter()
+        job_result.seconds = ended - started
+
+        with self.lock:
+            stats = self.stats[job.queue]
+            stats.jobs += 1
+            stats.failed += job_result.error is not None
+            stats.busy += job_result.seconds
+            stats.bytes += job.size
+            stats.first_start = started if stats.first_start is None else min(stats.first_start, started)
+            stats.last_end = ended if stats.last_end is None else max(stats.last_end, ended)
+        return job_result
+
+    def run_chain(self, jobs):
+        """
+        Run dependent jobs in order in this thread, the output of a job may be the source of the next.
+        Stops at the first failed job, returns the JobResults of the jobs which have run.
+        """
+        results = []
+        for job in jobs:
+            if results:
+                # the source may be pending by the batch fsync policy
+                sound_api.flush_outputs()
+            job.queue = classify(job)
+            job.size = _source_size(job)
+            results.append(self._run(job))
+            if results[-1].error is not None:
+                break
+        return results
+
+    def run(self, jobs, on_done=None):
+        """
+        Run the jobs, returns the JobResults in the order of the jobs.
+        on_done(JobResult) is called as each job finishes.
+        """
+        jobs = list(jobs)
+        planned = plan(jobs)
+        pools = {name: ThreadPoolExecutor(max_workers=self.workers[name], thread_name_prefix=f'{name}-queue') for name in QUEUES}
+        try:
+            futures = {}
+            for job in planned:
+                future = pools[job.queue].submit(self._run, job)
+                if on_done is not None:
+                    future.add_done_callback(lambda f: on_done(f.result()))
+                futures[id(job)] = future
+            results = [futures[id(job)].result() for job in jobs]
+        except BaseException:
+            for pool in pools.values():
+                pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        for pool in pools.values():
+            pool.shutdown()
+        return results
@@ -0,0 +1,206 @@
+# 
+# Fast chunk index of wav files
+# 
+# The file is mapped by mmap and only the chunk headers are touched, with
+# precompiled struct formats and __slots__ records, so a large archive can be
+# audited without reading the audio data.
+# Unlike remove_chunk.py nothing is rejected : odd chunks without the padding byte,
+# extensible fmt, fact chunks, RF64 and trailing junk are reported as they are.
+# 
+
+import json
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from struct import Struct
+
+import sound_api
+
+
+_riff_header = Struct('<4sI4s')
+_chunk_header = Struct('<4sI')
+_fmt_chunk = Struct('<HHIIHH')
+_fmt_extension = Struct('<HHI16s')      # cbSize, valid bits, channel mask, sub format GUID
+_ds64_chunk = Struct('<QQQ')            # RIFF size, data size, sample count
+_fact_chunk = Struct('<I')
+
+_RIFF_FORMS = (b'RIFF', b'RF64', b'BW64')
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+_UNKNOWN_SIZE = 0xFFFFFFFF
+
+
+class Chunk:
+    __slots__ = ('chunk_id', 'offset', 'size')
+
+    def __init__(self, chunk_id, offset, size):
+        self.chunk_id = chunk_id
+        self.offset = offset        # file position of the chunk header
+        self.size = size            # data size without the header and the padding byte
+
+    def as_dict(self):
+        return {'id': self.chunk_id, 'offset': self.offset, 'size': self.size}
+
+
+class ChunkIndex:
+    __slots__ = ('file', 'file_size', 'form', 'riff_size', 'chunks', 'fmt', 'fact_samples', 'issues')
+
+    def __init__(self, file, file_size):
+        self.file = file
+        self.file_size = file_size
+        self.form = None
+        self.riff_size = None
+        self.chunks = []
+        self.fmt = None
+        self.fact_samples = None
+        self.issues = []
+
+    def as_dict(self):
+        result = {
+            'file': self.file,
+            'file_size': self.file_size,
+            'form': self.form,
+            'riff_size': self.riff_size,
+            'chunks': [chunk.as_dict() for chunk in self.chunks],
+        }
+        if self.fmt is not None:
+            result['fmt'] = self.fmt
+        if self.fact_samples is not None:
+            result['fact_samples'] = self.fact_samples
+        result['issues'] = self.issues
+        return result
+
+
+def _chunk_id(raw):
+    return raw.decode('latin-1')
+
+
+def _valid_id(buf, position):
+    """
+    Printable ASCII chunk id at position
+    """
+    if position + 8 > len(buf):
+        return False
+    return all(0x20 <= b <= 0x7E for b in buf[position:position + 4])
+
+
+def _analyze_fmt(buf, position, size, index):
+    if size < _fmt_chunk.size:
+        index.issues.append(f'fmt chunk is too short ({size} bytes)')
+        return
+    audio_format, channels, rate, byte_rate, block_align, bits = _fmt_chunk.unpack_from(buf, position)
+    fmt = {
+        'format': audio_format,
+        'channels': channels,
+        'sampling_rate': rate,
+        'byte_rate': byte_rate,
+        'block_align': block_align,
+        'bits_per_sample': bits,
+    }
+    if audio_format == _WAVE_FORMAT_EXTENSIBLE:
+        if size >= _fmt_chunk.size + _fmt_extension.size:
+            _, valid_bits, channel_mask, sub_format = _fmt_extension.unpack_from(buf, position + _fmt_chunk.size)
+            fmt['valid_bits'] = valid_bits
+            fmt['channel_mask'] = channel_mask
+            # the first 2 bytes of the GUID are the format code
+            fmt['sub_format'] = int.from_bytes(sub_format[:2], 'little')
+        else:
+            index.issues.append('extensible fmt chunk is too short')
+    index.fmt = fmt
+
+
+def scan(buf, index):
+    """
+    Fill the ChunkIndex from the buffer of the whole file
+    """
+    end = len(buf)
+    if end < _riff_header.size:
+        index.issues.append('file is shorter than the RIFF header')
+        return index
+
+    form, riff_size, data_type = _riff_header.unpack_from(buf, 0)
+    index.form = _chunk_id(form)
+    index.riff_size = riff_size
+    if form not in _RIFF_FORMS or data_type != b'WAVE':
+        index.issues.append('not a RIFF WAVE file')
+        return index
+
+    ds64 = None
+    position = _riff_header.size
+    while position + _chunk_header.size <= end:
+        raw_id, size = _chunk_header.unpack_from(buf, position)
+        if not _valid_id(buf, position):
+            index.issues.append(f'trailing junk at {position} ({end - position} bytes)')
+            return index
+
+        if size == _UNKNOWN_SIZE and ds64 is not None and raw_id == b'data':
+            size = ds64[1]
+        index.chunks.append(Chunk(_chunk_id(raw_id), position, size))
+        data = position + _chunk_header.size
+
+        if data + size > end:
+            index.issues.append(f'{_chunk_id(raw_id)!r} chunk is truncated ({end - data} of {size} bytes)')
+            return index
+
+        if raw_id == b'fmt ':
+            _analyze_fmt(buf, data, size, index)
+        elif raw_id == b'fact' and size >= _fact_chunk.size:
+            index.fact_samples = _fact_chunk.unpack_from(buf, data)[0]
+        elif raw_id == b'ds64' and size >= _ds64_chunk.size:
+            ds64 = _ds64_chunk.unpack_from(buf, data)
+            index.riff_size = ds64[0]
+
+        position = data + size
+        if size % 2 == 1:
+            # padding byte, some writers omit it
+            if position < end and (_valid_id(buf, position + 1) or not _valid_id(buf, position)):
+                position += 1
+            else:
+                index.issues.append(f'{_chunk_id(raw_id)!r} chunk has no padding byte')
+
+    if position < end:
+        index.issues.append(f'trailing junk at {position} ({end - position} bytes)')
+    if index.riff_size + 8 != min(position, end):
+        index.issues.append(f'RIFF size {index.riff_size} does not match the chunks ({min(position, end) - 8})')
+    if index.fmt is None:
+        index.issues.append('no fmt chunk')
+    if not any(chunk.chunk_id == 'data' for chunk in index.chunks):
+        index.issues.append('no data chunk')
+    return index
+
+
+def index_file(path):
+    """
+    ChunkIndex of a wav file
+    """
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        index = ChunkIndex(path, file_size)
+        if file_size == 0:
+            index.issues.append('empty file')
+            return index
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return scan(buf, index)
+
+
+def _index_job(path):
+    """
+    Worker process : one JSON line per file, errors are reported in the line
+    """
+    try:
+        return json.dumps(index_file(path).as_dict())
+    except (OSError, ValueError) as e:
+        return json.dumps({'file': path, 'error': str(e)})
+
+
+def index_files(targets, jobs=None):
+    """
+    JSON lines of the wav files of targets in the order of the files
+    """
+    paths = sound_api.find_sound_files(targets, formats=('.wav',))
+    if jobs == 1:
+        yield from map(_index_job, paths)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        # large chunks, each job is a few page faults
+        yield from pool.map(_index_job, paths, chunksize=256)
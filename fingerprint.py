@@ -0,0 +1,336 @@
+# 
+# Audio fingerprint and duplicate detection
+# 
+# The fingerprint is a sequence of 32 bit sub-fingerprints, one per 46 msec,
+# from the signs of the band energy differences over frequency and time
+# (the same family as chromaprint / Haitsma-Kalker).
+# It is computed by vectorized STFTs over streamed blocks, at the native
+# sampling rate, so wav and mp3 copies of a sound give comparable codes.
+# 
+# The fingerprints are stored in a SQLite index with a banded min-hash sketch (LSH)
+# of the codes per file, and the sketch table is used to find the candidate pairs for dedupe.
+# 
+
+import functools
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+
+import sound_api
+
+
+FRAME_SEC = 0.371           # analysis frame
+HOP_SEC = FRAME_SEC / 8     # one sub-fingerprint per hop
+BANDS = 33                  # 33 bands -> 32 bits
+LOW_HZ = 300.0
+HIGH_HZ = 2000.0
+LSH_BANDS = 256             # sketch values per file
+LSH_ROWS = 1                # min-hash values per band
+SILENCE_CODES = (0, 0xFFFFFFFF)
+CACHE_SIZE = 1024           # fingerprints kept in memory by find_duplicates
+INDEX_VERSION = 1           # PRAGMA user_version, the sketch is rebuilt on a change
+COMMIT_FILES = 256          # fingerprints written by a transaction
+
+DEFAULT_INDEX = 'fingerprint.sqlite'
+
+
+@dataclass
+class Fingerprint:
+    codes: np.ndarray       # uint32
+    duration_ms: int
+
+
+@dataclass
+class Duplicate:
+    file_1: str
+    file_2: str
+    similarity: float       # 1 - bit error rate
+    coverage: float         # overlap / longer fingerprint
+    offset_ms: int          # file_2 position of the start of file_1
+
+
+def _band_matrix(frame, frame_rate):
+    """
+    (rfft bins, BANDS) matrix which sums the power spectrum into log spaced bands
+    """
+    freqs = np.fft.rfftfreq(frame, 1 / frame_rate)
+    edges = np.geomspace(LOW_HZ, HIGH_HZ, BANDS + 1)
+    band = np.searchsorted(edges, freqs, side='right') - 1
+    valid = (band >= 0) & (band < BANDS)
+    matrix = np.zeros((len(freqs), BANDS), dtype=np.float32)
+    matrix[np.nonzero(valid)[0], band[valid]] = 1.0
+    return matrix
+
+
+def band_energies(blocks, frame_rate):
+    """
+    Band energies of the STFT frames (frames, BANDS) for each block of monaural samples.
+    The frames continue across the block boundaries.
+    """
+    frame = round(frame_rate * FRAME_SEC)
+    hop = round(frame_rate * HOP_SEC)
+    matrix = _band_matrix(frame, frame_rate)
+
+    for power in sound_api.stft_power(blocks, frame, hop):
+        yield power @ matrix
+
+
+def sub_fingerprints(energies):
+    """
+    32 bit codes from the band energies, bit m of frame n is
+    (E(n,m) - E(n,m+1)) - (E(n-1,m) - E(n-1,m+1)) > 0
+    """
+    previous = None
+    for e in energies:
+        d = e[:, :-1] - e[:, 1:]
+        if previous is not None:
+            d = np.concatenate([previous, d])
+        if len(d) > 1:
+            bits = (d[1:] - d[:-1]) > 0
+            yield np.packbits(bits, axis=1, bitorder='little').view('<u4')[:, 0]
+        previous = d[-1:]
+
+
+def fingerprint_file(source_file, block_frames=1 << 16):
+    with sound_api.BlockReader(source_file, block_frames=block_frames, channels=1) as reader:
+        frame_rate = reader.info.frame_rate
+        codes = list(sub_fingerprints(band_energies(reader, frame_rate)))
+        frames = reader.info.frames
+
+    codes = np.concatenate(codes).astype(np.uint32) if codes else np.zeros(0, dtype=np.uint32)
+    if frames is None:
+        # mp3 stream, the length is known after decoding only
+        duration_ms = round(len(codes) * HOP_SEC * 1000)
+    else:
+        duration_ms = round(frames * 1000 / frame_rate)
+    return Fingerprint(codes, duration_ms)
+
+
+def _mix(x):
+    """
+    splitmix64 finalizer of uint64 values
+    """
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+_SEEDS = _mix(np.arange(1, LSH_BANDS * LSH_ROWS + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15))
+
+
+def sketch(codes):
+    """
+    Banded min-hash of the distinct 32 bit codes, silence is excluded.
+    Each of the LSH_BANDS * LSH_ROWS seeded hashes keeps its minimum over the codes, and the minimums
+    of a band are hashed with the band number into one sketch value, so 2 files share a value with
+    the probability J ** LSH_ROWS (J is the Jaccard index of their codes) whatever the size of the index.
+    Only a few percent of the codes survive re-encoding without a bit error, so a band has one row.
+    """
+    codes = np.unique(codes[~np.isin(codes, np.array(SILENCE_CODES, dtype=np.uint32))]).astype(np.uint64)
+    if len(codes) == 0:
+        return []
+    minimums = np.array([_mix(codes ^ seed).min() for seed in _SEEDS], dtype=np.uint64)
+    values = np.arange(LSH_BANDS, dtype=np.uint64)
+    for row in minimums.reshape(LSH_BANDS, LSH_ROWS).T:
+        values = _mix(values * np.uint64(0x9E3779B97F4A7C15) ^ row)
+    return values.view(np.int64).tolist()
+
+
+def compare(codes_1, codes_2):
+    """
+    Align 2 fingerprints by the most common offset of the equal codes,
+    returns (similarity, coverage, offset) of the overlap
+    """
+    if len(codes_1) == 0 or len(codes_2) == 0:
+        return 0.0, 0.0, 0
+
+    _, index_1, index_2 = np.intersect1d(codes_1, codes_2, assume_unique=False, return_indices=True)
+    if len(index_1) == 0:
+        return 0.0, 0.0, 0
+    offsets, counts = np.unique(index_2.astype(np.int64) - index_1, return_counts=True)
+    offset = int(offsets[counts.argmax()])
+
+    # codes_1[i] is aligned with codes_2[i + offset]
+    first = max(0, -offset)
+    last = min(len(codes_1), len(codes_2) - offset)
+    if last <= first:
+        return 0.0, 0.0, offset
+    x = codes_1[first:last]
+    y = codes_2[first + offset:last + offset]
+    errors = int(np.bitwise_count(x ^ y).sum())
+    similarity = 1.0 - errors / (32 * len(x))
+    coverage = len(x) / max(len(codes_1), len(codes_2))
+    return similarity, coverage, offset
+
+
+# 
+# Index
+# 
+
+def open_index(index_file):
+    db = sqlite3.connect(index_file)
+    db.execute('PRAGMA foreign_keys = ON')
+    db.execute('PRAGMA journal_mode = WAL')
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            duration_ms INTEGER NOT NULL,
+            codes BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS sketch (
+            hash INTEGER NOT NULL,
+            file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE
+        );
+        CREATE INDEX IF NOT EXISTS sketch_hash ON sketch(hash);
+        CREATE INDEX IF NOT EXISTS sketch_file_id ON sketch(file_id);
+    """)
+    if db.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+        # the sketch of an older version, rebuilt from the stored codes
+        with db:
+            db.execute('DELETE FROM sketch')
+            for file_id, codes in db.execute('SELECT id, codes FROM files').fetchall():
+                hashes = sketch(np.frombuffer(codes, dtype='<u4'))
+                db.executemany('INSERT INTO sketch (hash, file_id) VALUES (?, ?)', [(h, file_id) for h in hashes])
+            db.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+    return db
+
+
+def _fingerprint_job(path):
+    """
+    Worker process : fingerprint one file, errors are returned as a message
+    """
+    try:
+        fp = fingerprint_file(path)
+    except Exception as e:
+        # a corrupt file fails alone, the other files go on
+        return path, None, sound_api.error_message(e)
+    return path, (fp.duration_ms, fp.codes.astype('<u4').tobytes(), sketch(fp.codes)), None
+
+
+def update_index(index_file, targets, jobs=None, on_error=None):
+    """
+    Fingerprint the new or changed sound files of targets in parallel.
+    Unchanged files (same size and mtime) are skipped, and the entries of deleted files are removed.
+    Returns (processed, skipped, removed).
+    """
+    db = open_index(index_file)
+    try:
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in db.execute('SELECT path, size, mtime_ns FROM files')}
+
+        todo = {}
+        skipped = 0
+        for path in sound_api.find_sound_files(targets):
+            path = os.path.abspath(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                if on_error is not None:
+                    on_error(path, 'Source file does not exist.')
+                continue
+            if known.get(path) == (st.st_size, st.st_mtime_ns):
+                skipped += 1
+            else:
+                todo[path] = (st.st_size, st.st_mtime_ns)
+
+        removed = [path for path in known if not os.path.exists(path)]
+        with db:
+            db.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in removed])
+
+        def write(rows):
+            # a batch of files in one transaction, all or none of it
+            with db:
+                for path, (duration_ms, codes, hashes) in rows:
+                    size, mtime_ns = todo[path]
+                    db.execute('DELETE FROM files WHERE path = ?', (path,))
+                    cur = db.execute(
+                        'INSERT INTO files (path, size, mtime_ns, duration_ms, codes) VALUES (?, ?, ?, ?, ?)',
+                        (path, size, mtime_ns, duration_ms, codes))
+                    db.executemany('INSERT INTO sketch (hash, file_id) VALUES (?, ?)', [(h, cur.lastrowid) for h in hashes])
+            rows.clear()
+
+        processed = 0
+        rows = []
+        try:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                for path, result, error in pool.map(_fingerprint_job, todo, chunksize=8):
+                    if error is not None:
+                        if on_error is not None:
+                            on_error(path, error)
+                        continue
+                    rows.append((path, result))
+                    processed += 1
+                    if len(rows) >= COMMIT_FILES:
+                        write(rows)
+        finally:
+            # an interrupted or failed run keeps the finished files
+            write(rows)
+        return processed, skipped, len(removed)
+    finally:
+        db.close()
+
+
+def find_duplicates(index_file, threshold=0.65, min_coverage=0.8, min_shared=2, max_bucket=64):
+    """
+    Near-duplicate pairs of the index.
+    Candidates share at least min_shared sketch values, hash values which are shared by
+    more than max_bucket files (a code common to many sounds) are ignored.
+    The candidates are verified by the similarity and the coverage of the whole fingerprints.
+    """
+    db = open_index(index_file)
+    try:
+        candidates = db.execute("""
+            WITH buckets AS (
+                SELECT hash FROM sketch GROUP BY hash HAVING COUNT(*) BETWEEN 2 AND ?
+            )
+            SELECT a.file_id, b.file_id
+            FROM sketch a
+            JOIN sketch b ON a.hash = b.hash AND a.file_id < b.file_id
+            WHERE a.hash IN buckets
+            GROUP BY a.file_id, b.file_id
+            HAVING COUNT(*) >= ?
+            ORDER BY a.file_id, b.file_id
+        """, (max_bucket, min_shared)).fetchall()
+
+        # the candidates are sorted by the first file, a small cache keeps it between the pairs
+        @functools.lru_cache(maxsize=CACHE_SIZE)
+        def entry(file_id):
+            path, codes = db.execute('SELECT path, codes FROM files WHERE id = ?', (file_id,)).fetchone()
+            return path, np.frombuffer(codes, dtype='<u4')
+
+        duplicates = []
+        for id_1, id_2 in candidates:
+            path_1, codes_1 = entry(id_1)
+            path_2, codes_2 = entry(id_2)
+            similarity, coverage, offset = compare(codes_1, codes_2)
+            if similarity >= threshold and coverage >= min_coverage:
+                duplicates.append(Duplicate(path_1, path_2, similarity, coverage, round(offset * HOP_SEC * 1000)))
+        return duplicates
+    finally:
+        db.close()
+
+
+def group_duplicates(duplicates):
+    """
+    Groups of files connected by the duplicate pairs
+    """
+    parent = {}
+    def find(x):
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for d in duplicates:
+        parent[find(d.file_1)] = find(d.file_2)
+
+    groups = {}
+    for x in parent:
+        groups.setdefault(find(x), []).append(x)
+    return sorted(sorted(g) for g in groups.values())
@@ -0,0 +1,271 @@
+# 
+# ID3v2 / ID3v1 tags of mp3 files
+# 
+# ID3v2.3 and ID3v2.4 are read and written, the frames which are not text
+# (pictures, private data, ...) are kept as they are.
+# The ID3v2 tag is rewritten in place when the new frames fit in the old tag with its padding,
+# otherwise the file is rewritten once with a padding for the later edits.
+# The ID3v1 tag is the last 128 bytes of the file and is always written in place.
+# 
+
+import os
+import shutil
+import struct
+import tempfile
+from dataclasses import dataclass, field
+
+
+PADDING_SIZE = 1024         # padding of a rewritten ID3v2 tag
+
+GENRES = (
+    'Blues', 'Classic Rock', 'Country', 'Dance', 'Disco', 'Funk', 'Grunge', 'Hip-Hop',
+    'Jazz', 'Metal', 'New Age', 'Oldies', 'Other', 'Pop', 'R&B', 'Rap',
+    'Reggae', 'Rock', 'Techno', 'Industrial', 'Alternative', 'Ska', 'Death Metal', 'Pranks',
+    'Soundtrack', 'Euro-Techno', 'Ambient', 'Trip-Hop', 'Vocal', 'Jazz+Funk', 'Fusion', 'Trance',
+    'Classical', 'Instrumental', 'Acid', 'House', 'Game', 'Sound Clip', 'Gospel', 'Noise',
+    'AlternRock', 'Bass', 'Soul', 'Punk', 'Space', 'Meditative', 'Instrumental Pop', 'Instrumental Rock',
+    'Ethnic', 'Gothic', 'Darkwave', 'Techno-Industrial', 'Electronic', 'Pop-Folk', 'Eurodance', 'Dream',
+    'Southern Rock', 'Comedy', 'Cult', 'Gangsta', 'Top 40', 'Christian Rap', 'Pop/Funk', 'Jungle',
+    'Native American', 'Cabaret', 'New Wave', 'Psychadelic', 'Rave', 'Showtunes', 'Trailer', 'Lo-Fi',
+    'Tribal', 'Acid Punk', 'Acid Jazz', 'Polka', 'Retro', 'Musical', 'Rock & Roll', 'Hard Rock',
+)
+
+_ENCODINGS = {0: 'latin-1', 1: 'utf-16', 2: 'utf-16-be', 3: 'utf-8'}
+
+# frame flags which make the frame data unreadable without more processing
+_OPAQUE_FLAGS = {3: 0x00C0, 4: 0x000F}
+
+
+class Id3Error(Exception):
+    pass
+
+
+@dataclass
+class Id3Frame:
+    frame_id: bytes         # 4 bytes strings
+    flags: int              # 2 byte integer
+    data: bytes             # variable length
+
+
+@dataclass
+class Id3Tag:
+    version: int            # 3 (ID3v2.3) or 4 (ID3v2.4)
+    frames: list = field(default_factory=list)
+    size: int = 0           # bytes of the tag in the file including the padding, 0 for a new tag
+    footer: bool = False
+
+
+@dataclass
+class Id3v1Tag:             # 128 bytes
+    title: str = ''         # 30 bytes strings
+    artist: str = ''        # 30 bytes strings
+    album: str = ''         # 30 bytes strings
+    year: str = ''          # 4 bytes strings
+    comment: str = ''       # 30 bytes strings, 28 bytes if track
+    track: int = 0          # 1 byte integer, ID3v1.1
+    genre: int = 255        # 1 byte integer
+
+
+def _synchsafe(databuf):
+    return (databuf[0] << 21) | (databuf[1] << 14) | (databuf[2] << 7) | databuf[3]
+
+
+def _to_synchsafe(value):
+    if value >= 1 << 28:
+        raise Id3Error('ID3v2 tag is too large')
+    return bytes(((value >> 21) & 0x7F, (value >> 14) & 0x7F, (value >> 7) & 0x7F, value & 0x7F))
+
+
+def _unsynchronise_undo(databuf):
+    return databuf.replace(b'\xff\x00', b'\xff')
+
+
+def read_id3v2(f):
+    """
+    ID3v2 tag at the beginning of the file, None if there is no tag
+    """
+    f.seek(0)
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return None
+
+    version, flags = header[3], header[5]
+    if version not in (3, 4):
+        raise Id3Error(f'ID3v2.{version} is not supported')
+    size = _synchsafe(header[6:10])
+    footer = bool(flags & 0x10)
+    databuf = f.read(size)
+    if len(databuf) != size:
+        raise Id3Error('read error')
+
+    if flags & 0x80 and version == 3:
+        # unsynchronisation of the whole tag
+        databuf = _unsynchronise_undo(databuf)
+
+    position = 0
+    if flags & 0x40:
+        # skip the extended header
+        if version == 3:
+            position = 4 + struct.unpack('>I', databuf[:4])[0]
+        else:
+            position = _synchsafe(databuf[:4])
+
+    tag = Id3Tag(version, [], 10 + size + (10 if footer else 0), footer)
+    while position + 10 <= len(databuf) and databuf[position] != 0:
+        frame_id, frame_size, frame_flags = struct.unpack_from('>4sIH', databuf, position)
+        if version == 4:
+            frame_size = _synchsafe(databuf[position + 4:position + 8])
+        frame_data = databuf[position + 10:position + 10 + frame_size]
+        if len(frame_data) != frame_size:
+            raise Id3Error('frame size error')
+        tag.frames.append(Id3Frame(frame_id, frame_flags, frame_data))
+        position += 10 + frame_size
+    return tag
+
+
+def _decode(encoding, databuf):
+    if encoding not in _ENCODINGS:
+        raise Id3Error('text encoding error')
+    text = databuf.decode(_ENCODINGS[encoding], errors='replace')
+    # multiple values of ID3v2.4 are separated by NUL
+    return '/'.join(x for x in text.split('\0') if x)
+
+
+def _split_terminated(encoding, databuf):
+    """
+    (terminated string, rest) of the frame data
+    """
+    if encoding in (1, 2):
+        for i in range(0, len(databuf) - 1, 2):
+            if databuf[i:i + 2] == b'\0\0':
+                return databuf[:i], databuf[i + 2:]
+    elif (i := databuf.find(b'\0')) >= 0:
+        return databuf[:i], databuf[i + 1:]
+    return databuf, b''
+
+
+def frame_text(frame, version):
+    """
+    Text of a text frame (T***) or a comment frame (COMM), None for the other frames
+    """
+    if frame.flags & _OPAQUE_FLAGS[version] or not frame.data:
+        return None
+    encoding = frame.data[0]
+    if frame.frame_id == b'COMM':
+        _, text = _split_terminated(encoding, frame.data[4:])
+        return _decode(encoding, text)
+    if frame.frame_id.startswith(b'T') and frame.frame_id != b'TXXX':
+        return _decode(encoding, frame.data[1:])
+    return None
+
+
+def comment_description(frame):
+    if frame.frame_id != b'COMM' or not frame.data:
+        return None
+    description, _ = _split_terminated(frame.data[0], frame.data[4:])
+    return _decode(frame.data[0], description)
+
+
+def _encode(text, version):
+    if version == 4:
+        return 3, text.encode('utf-8')
+    try:
+        return 0, text.encode('latin-1')
+    except UnicodeEncodeError:
+        return 1, text.encode('utf-16')
+
+
+def text_frame(frame_id, text, version):
+    encoding, databuf = _encode(text, version)
+    if frame_id == b'COMM':
+        terminator = b'\0\0' if encoding in (1, 2) else b'\0'
+        bom = b'\xff\xfe' if encoding == 1 else b''
+        return Id3Frame(frame_id, 0, bytes((encoding,)) + b'eng' + bom + terminator + databuf)
+    return Id3Frame(frame_id, 0, bytes((encoding,)) + databuf)
+
+
+def pack_id3v2(tag, size=None):
+    """
+    Tag bytes of size bytes with a zero padding, or of the frames and PADDING_SIZE if size is None
+    """
+    databuf = bytearray()
+    for frame in tag.frames:
+        frame_size = _to_synchsafe(len(frame.data)) if tag.version == 4 else struct.pack('>I', len(frame.data))
+        databuf += frame.frame_id + frame_size + struct.pack('>H', frame.flags) + frame.data
+
+    if size is None:
+        size = 10 + len(databuf) + PADDING_SIZE
+    if 10 + len(databuf) > size:
+        return None
+    databuf += bytes(size - 10 - len(databuf))
+    return b'ID3' + bytes((tag.version, 0, 0)) + _to_synchsafe(size - 10) + bytes(databuf)
+
+
+def write_id3v2(dst_file, tag):
+    """
+    Write the ID3v2 tag, returns 'in place' or 'rewrite'
+    """
+    databuf = pack_id3v2(tag, tag.size) if tag.size and not tag.footer else None
+    if databuf is not None:
+        with open(dst_file, 'r+b') as dst:
+            dst.write(databuf)
+        return 'in place'
+
+    # the audio data is moved
+    databuf = pack_id3v2(tag)
+    directory = os.path.dirname(os.path.abspath(dst_file))
+    fd, temp_file = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with open(dst_file, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            dst.write(databuf)
+            src.seek(tag.size)
+            shutil.copyfileobj(src, dst)
+        shutil.copymode(dst_file, temp_file)
+        os.replace(temp_file, dst_file)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+    return 'rewrite'
+
+
+def _latin1(databuf):
+    return databuf.split(b'\0', 1)[0].decode('latin-1').rstrip(' ')
+
+
+def read_id3v1(f):
+    """
+    ID3v1 tag at the end of the file, None if there is no tag
+    """
+    f.seek(0, os.SEEK_END)
+    if f.tell() < 128:
+        return None
+    f.seek(-128, os.SEEK_END)
+    databuf = f.read(128)
+    if databuf[:3] != b'TAG':
+        return None
+
+    title, artist, album, year, comment, genre = struct.unpack('>3x30s30s30s4s30sB', databuf)
+    track = 0
+    if comment[28] == 0 and comment[29] != 0:
+        # ID3v1.1
+        track = comment[29]
+        comment = comment[:28]
+    return Id3v1Tag(_latin1(title), _latin1(artist), _latin1(album), _latin1(year), _latin1(comment), track, genre)
+
+
+def pack_id3v1(tag):
+    encode = lambda text, size: text.encode('latin-1', errors='replace')[:size].ljust(size, b'\0')
+    comment = encode(tag.comment, 28) + bytes((0, tag.track)) if tag.track else encode(tag.comment, 30)
+    return b'TAG' + encode(tag.title, 30) + encode(tag.artist, 30) + encode(tag.album, 30) \
+        + encode(tag.year, 4) + comment + bytes((tag.genre,))
+
+
+def write_id3v1(dst_file, tag):
+    """
+    Write the ID3v1 tag over the old one or append it, returns 'in place' or 'append'
+    """
+    with open(dst_file, 'r+b') as dst:
+        exists = read_id3v1(dst) is not None
+        dst.seek(-128 if exists else 0, os.SEEK_END)
+        dst.write(pack_id3v1(tag))
+    return 'in place' if exists else 'append'
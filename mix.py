@@ -0,0 +1,325 @@
+# 
+# Streaming mixdown of several sound files
+# 
+# Each source is decoded by blocks and converted to the output format on the fly by the stages of
+# pipeline.py (channels, then sampling rate, then gain), in this process. The blocks are summed in
+# float32, so the sum may exceed the full scale without clipping until the output is written, where it
+# is clipped or, with a limit, soft limited. The memory depends on the block size only, not the length.
+# The sum is the same as the ffmpeg graph of ffmpeg_graph() (volume, adelay and amix without
+# normalization), which ffmpeg_check() runs to compare with. Only the resampling is different,
+# a windowed-sinc filter here and swresample in ffmpeg.
+# 
+
+import math
+import os
+import tempfile
+import time
+from contextlib import ExitStack
+from dataclasses import dataclass
+
+import numpy as np
+
+import parallel_mp3
+import pipeline
+import sound_api
+import tags
+from sound_api import FormatError, ParameterError
+
+
+BLOCK_FRAMES = 1 << 16
+KNEE_DB = 6.0                   # the limiter starts this much below the limit
+MAX_DIFF_LSB = 1                # of the check, rounding of the limiter
+MIN_SNR_DB = 50.0               # of the check of a resampled mix, the resamplers are different
+
+
+class Track:
+    """
+    A source converted to the output format, read by consecutive parts from its offset
+    """
+    def __init__(self, reader, channels, frame_rate, dB=0.0, offset=0):
+        self.reader = reader
+        self.offset = offset        # frames of the output
+        info = reader.info
+        self.stages = []
+        if info.channels != channels:
+            self.stages.append(pipeline.Channels(channels))
+        if info.frame_rate != frame_rate:
+            self.stages.append(pipeline.Resample(frame_rate))
+        if dB:
+            self.stages.append(pipeline.Gain(dB))
+
+        # an output buffer per stage, reused for each block
+        self.buffers = []
+        ch, rate, frames = info.channels, info.frame_rate, reader.block_frames
+        for stage in self.stages:
+            ch, rate = stage.setup(ch, rate)
+            frames = stage.max_frames(frames)
+            self.buffers.append(np.empty((frames, ch), dtype=np.float32))
+
+        self.blocks = iter(reader)
+        self.flushed = 0            # stages flushed at the end of the source
+        self.rest = np.zeros((0, channels), dtype=np.float32)
+        self.ended = False
+
+    def _process(self, block, first=0):
+        for stage, out in zip(self.stages[first:], self.buffers[first:]):
+            block = out[:stage.process(block, out)]
+        return block
+
+    def _next(self):
+        """
+        Next converted block, None at the end. It is valid until the next call.
+        """
+        for block in self.blocks:
+            return self._process(block)
+        while self.flushed < len(self.stages):
+            i = self.flushed
+            self.flushed += 1
+            frames = self.stages[i].flush(self.buffers[i])
+            if frames > 0:
+                return self._process(self.buffers[i][:frames], i + 1)
+        return None
+
+    def add_to(self, out):
+        """
+        Add the next frames into out, returns the frames added, less than len(out) at the end
+        """
+        done = 0
+        while done < len(out) and not self.ended:
+            if not len(self.rest):
+                block = self._next()
+                if block is None:
+                    self.ended = True
+                    break
+                self.rest = block
+            n = min(len(self.rest), len(out) - done)
+            out[done:done + n] += self.rest[:n]
+            self.rest = self.rest[n:]
+            done += n
+        return done
+
+
+def _limit_params(limit):
+    """
+    (threshold, width) of the limiter for the limit by dBFS
+    """
+    ceiling = 10 ** (limit / 20)
+    threshold = ceiling * 10 ** (-KNEE_DB / 20)
+    return threshold, ceiling - threshold
+
+
+def soft_limit(samples, limit):
+    """
+    Limit the float samples in place to the limit by dBFS. Below the threshold (KNEE_DB under the limit)
+    the samples are not changed, above it the excess is compressed by tanh toward the limit.
+    """
+    threshold, width = _limit_params(limit)
+    over = np.abs(samples) > threshold
+    if over.any():
+        x = samples[over].astype(np.float64)
+        samples[over] = np.sign(x) * (threshold + width * np.tanh((np.abs(x) - threshold) / width))
+    return samples
+
+
+def _offset_frames(offset, frame_rate):
+    return round(offset * frame_rate / 1000)
+
+
+def _check_params(source_files, gains, offsets):
+    if not source_files:
+        raise ParameterError('No source file is specified.')
+    gains = list(gains) if gains else [0.0] * len(source_files)
+    offsets = list(offsets) if offsets else [0] * len(source_files)
+    if len(gains) != len(source_files):
+        raise ParameterError(f'{len(gains)} gains for {len(source_files)} source files.')
+    if len(offsets) != len(source_files):
+        raise ParameterError(f'{len(offsets)} offsets for {len(source_files)} source files.')
+    if any(offset < 0 for offset in offsets):
+        raise ParameterError('Offset must not be negative.')
+    return gains, offsets
+
+
+def _output_format(infos, ch=None, samrate=None):
+    """
+    (channels, sampling rate, sample width) of the mix, by default the most channels (up to stereo)
+    and the sampling rate and the sample width of the first source
+    """
+    if ch is not None and ch not in (1, 2):
+        raise ParameterError('Channels must be 1 or 2.')
+    if samrate is not None and samrate <= 0:
+        raise ParameterError('Sampling rate must be positive.')
+    channels = ch or min(max(info.channels for info in infos), 2)
+    return channels, samrate or infos[0].frame_rate, infos[0].sample_width
+
+
+def mix_blocks(tracks, channels, limit=None, block_frames=BLOCK_FRAMES):
+    """
+    Float32 blocks of the sum of the tracks, until the end of the longest one.
+    A block is valid until the next one is requested.
+    """
+    mixed = np.empty((block_frames, channels), dtype=np.float32)
+    position = 0
+    active = list(tracks)
+    while active:
+        mixed.fill(0.0)
+        frames = 0
+        for track in list(active):
+            start = track.offset - position
+            if start >= block_frames:
+                # not started yet, silent until the offset
+                frames = block_frames
+                continue
+            start = max(start, 0)
+            added = track.add_to(mixed[start:])
+            frames = max(frames, start + added)
+            if track.ended:
+                active.remove(track)
+        if frames == 0:
+            break
+        if limit is not None:
+            soft_limit(mixed[:frames], limit)
+        yield mixed[:frames]
+        position += frames
+
+
+def mix_files(source_files, destination_file, gains=None, offsets=None, ch=None, samrate=None, limit=None,
+              overwrite=False, block_frames=BLOCK_FRAMES):
+    """
+    Mix the source files into destination_file (wav or mp3). gains (dB) and offsets (msec) are per source.
+    The sources are converted to the channels and the sampling rate of the output on the fly.
+    limit (dBFS) soft limits the mix, otherwise the samples over the full scale are clipped.
+    """
+    source_files = list(source_files)
+    gains, offsets = _check_params(source_files, gains, offsets)
+    for n, source_file in enumerate(source_files, 1):
+        sound_api.check_source(source_file, f'Source file {n}')
+        sound_api._check_format(sound_api._extension(source_file), f'source file {n}')
+    sound_api.check_destination(destination_file, overwrite)
+    dst_ext = sound_api._check_format(sound_api._extension(destination_file), 'destination file')
+
+    with ExitStack() as stack:
+        readers = [stack.enter_context(sound_api.BlockReader(source_file, block_frames)) for source_file in source_files]
+        channels, frame_rate, sample_width = _output_format([reader.info for reader in readers], ch, samrate)
+        tracks = [Track(reader, channels, frame_rate, dB, _offset_frames(offset, frame_rate))
+                  for reader, dB, offset in zip(readers, gains, offsets)]
+        blocks = mix_blocks(tracks, channels, limit, block_frames)
+
+        with sound_api.atomic_output(destination_file, overwrite) as temp_file:
+            if dst_ext == '.wav':
+                pipeline._encode_wav(blocks, temp_file, channels, frame_rate, sample_width)
+                tags.copy_info_tags(source_files[0], temp_file)
+            else:
+                pipeline._encode_mp3(blocks, temp_file, channels, frame_rate, source_files[0])
+
+    return sound_api._result('mix', source_files, destination_file)
+
+
+# 
+# Reference by ffmpeg
+# 
+
+_PCM_CODECS = {1: 'pcm_u8', 2: 'pcm_s16le', 3: 'pcm_s24le', 4: 'pcm_s32le'}
+
+
+def _pan(source_channels, channels):
+    """
+    pan filter of Channels : the mean for monaural, the first channels for stereo
+    """
+    if channels == 1:
+        weight = repr(1 / source_channels)
+        return 'pan=mono|c0=' + '+'.join(f'{weight}*c{i}' for i in range(source_channels))
+    if source_channels == 1:
+        return 'pan=stereo|c0=c0|c1=c0'
+    return 'pan=stereo|c0=c0|c1=c1'
+
+
+def ffmpeg_graph(source_files, gains=None, offsets=None, ch=None, samrate=None, limit=None):
+    """
+    ffmpeg -filter_complex graph of the same mix, and the sample width of the output
+    """
+    source_files = list(source_files)
+    gains, offsets = _check_params(source_files, gains, offsets)
+    infos = [sound_api._header_info(source_file) for source_file in source_files]
+    channels, frame_rate, sample_width = _output_format(infos, ch, samrate)
+
+    chains = []
+    for i, (source_file, info, dB, offset) in enumerate(zip(source_files, infos, gains, offsets)):
+        # mp3 is decoded to 16 bits by BlockReader
+        filters = ['aformat=sample_fmts=s16'] if sound_api._extension(source_file) == '.mp3' else []
+        filters.append('aformat=sample_fmts=flt')
+        if info.channels != channels:
+            filters.append(_pan(info.channels, channels))
+        if info.frame_rate != frame_rate:
+            filters.append(f'aresample={frame_rate}')
+        if dB:
+            # the factor of Gain, rounded to float32 as it is
+            filters.append(f'volume={float(np.float32(10 ** (dB / 20)))!r}:precision=float')
+        filters.append(f'adelay=delays={_offset_frames(offset, frame_rate)}S:all=1')
+        chains.append(f'[{i}:a]{",".join(filters)}[a{i}]')
+
+    inputs = ''.join(f'[a{i}]' for i in range(len(source_files)))
+    graph = f'{inputs}amix=inputs={len(source_files)}:duration=longest:dropout_transition=0:normalize=0'
+    if limit is not None:
+        threshold, width = _limit_params(limit)
+        expr = f'if(gt(abs(val(ch)),{threshold!r}),sgn(val(ch))*({threshold!r}+{width!r}*tanh((abs(val(ch))-{threshold!r})/{width!r})),val(ch))'
+        graph += ',aeval=' + '|'.join([expr] * channels).replace(',', '\\,') + ':c=same'
+    return ';'.join(chains + [graph]), sample_width
+
+
+@dataclass
+class MixCheck:
+    frames: int
+    ffmpeg_frames: int
+    max_diff: int           # LSB of 16 bits, between the decoded outputs
+    snr: float              # dB, the output of ffmpeg to the difference
+    ffmpeg_seconds: float
+    resampled: bool         # the resamplers are different
+    tolerance: int = 0      # frames, rounding of the length by the resamplers
+
+    @property
+    def ok(self):
+        """
+        Same to MAX_DIFF_LSB, or MIN_SNR_DB for a resampled mix, which is not the same to the sample
+        """
+        if abs(self.frames - self.ffmpeg_frames) > self.tolerance:
+            return False
+        return self.snr >= MIN_SNR_DB if self.resampled else self.max_diff <= MAX_DIFF_LSB
+
+
+def ffmpeg_check(source_files, destination_file, gains=None, offsets=None, ch=None, samrate=None, limit=None):
+    """
+    Mix the source files by the ffmpeg graph of ffmpeg_graph() and compare it with destination_file
+    """
+    source_files = list(source_files)
+    graph, sample_width = ffmpeg_graph(source_files, gains, offsets, ch, samrate, limit)
+    ext = sound_api._extension(destination_file)
+    directory = os.path.dirname(os.path.abspath(destination_file))
+    fd, reference_file = tempfile.mkstemp(prefix='.amix.', suffix=ext, dir=directory)
+    os.close(fd)
+    try:
+        command = [arg for source_file in source_files for arg in ('-i', source_file)]
+        command += ['-filter_complex', graph]
+        command += ['-c:a', _PCM_CODECS[sample_width]] if ext == '.wav' else ['-c:a', 'libmp3lame']
+        started = time.perf_counter()
+        sound_api.run_ffmpeg(command + [reference_file])
+        seconds = time.perf_counter() - started
+
+        max_diff = signal = noise = 0.0
+        with sound_api.BlockReader(destination_file) as mixed, sound_api.BlockReader(reference_file) as reference:
+            if (mixed.info.channels, mixed.info.frame_rate) != (reference.info.channels, reference.info.frame_rate):
+                raise FormatError('The output of ffmpeg has different channels or sampling rate.')
+            blocks, totals = parallel_mp3._lockstep([mixed, reference])
+            for x, y in blocks:
+                d = (x - y).astype(np.float64)
+                max_diff = max(max_diff, float(np.abs(d).max(initial=0.0)))
+                signal += float(np.sum(y.astype(np.float64) ** 2))
+                noise += float(np.sum(d ** 2))
+        snr = math.inf if noise == 0 else 10 * math.log10(signal / noise) if signal > 0 else -math.inf
+        frame_rate = mixed.info.frame_rate
+        rates = [sound_api._header_info(source_file).frame_rate for source_file in source_files]
+        resampled = [rate for rate in rates if rate != frame_rate]
+        # the resamplers may end a resampled source a frame apart (of the lower rate)
+        tolerance = max((math.ceil(frame_rate / rate) for rate in resampled), default=0)
+        return MixCheck(totals[0], totals[1], math.ceil(max_diff * 32768), snr, seconds, bool(resampled), tolerance)
+    finally:
+        os.remove(reference_file)
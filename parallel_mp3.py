@@ -0,0 +1,472 @@
+# 
+# Parallel segmented mp3 encoding of a long wav file
+# 
+# The PCM input is split at mp3 frame boundaries (1152 samples, 576 for 24kHz and lower),
+# and each segment is encoded by its own ffmpeg (LAME) process, with some extra frames
+# before and after the segment to prime the encoder. From each encoded segment only the
+# frames of the segment itself are kept, so the frame streams line up exactly:
+# frame k of any segment covers the input from (k * 1152 - encoder delay), and the
+# encoder delay is the same for all segments.
+# 
+# The bit reservoir is disabled, because a frame may not borrow bits from a frame of
+# the other segment. The Xing / LAME header of the first segment is updated for the
+# whole stream (frames, bytes, TOC, encoder delay / padding), so the result plays back
+# gaplessly.
+# 
+
+import mmap
+import os
+import struct
+import subprocess
+import tempfile
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+
+import sound_api
+from sound_api import FfmpegError, FormatError
+
+
+OVERLAP_FRAMES = 8              # mp3 frames before and after each segment to prime the encoder
+MIN_SEGMENT_SEC = 30.0          # shorter segments are not worth another process
+BLOCK_FRAMES = 1 << 16          # PCM frames per write to ffmpeg
+MAX_SNR_LOSS_DB = 1.0           # parallel vs serial encode, more loss means broken joints
+
+_PCM_FORMATS = {1: 'u8', 2: 's16le', 3: 's24le', 4: 's32le'}
+
+# bitrate (kbps) tables of Layer III, [MPEG-1, MPEG-2/2.5]
+_BITRATES = (
+    (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0),
+    (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0),
+)
+_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+@dataclass
+class Mp3Frame:
+    offset: int
+    size: int
+
+
+@dataclass
+class ParallelResult:
+    segments: int
+    frames: int
+    bytes_written: int
+
+
+def samples_per_frame(frame_rate):
+    return 1152 if frame_rate >= 32000 else 576
+
+
+def _frame_size(header):
+    """
+    Size of the Layer III frame of the 4 bytes header, None if it is not a valid header
+    """
+    if header >> 21 != 0x7FF:
+        return None
+    version = (header >> 19) & 3
+    layer = (header >> 17) & 3
+    bitrate_index = (header >> 12) & 15
+    rate_index = (header >> 10) & 3
+    padding = (header >> 9) & 1
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrate = _BITRATES[version != 3][bitrate_index] * 1000
+    frame_rate = _SAMPLE_RATES[version][rate_index]
+    return (144 if version == 3 else 72) * bitrate // frame_rate + padding
+
+
+def id3v2_size(buf):
+    if len(buf) >= 10 and buf[:3] == b'ID3':
+        size = (buf[6] << 21) | (buf[7] << 14) | (buf[8] << 7) | buf[9]
+        footer = 10 if buf[5] & 0x10 else 0
+        return 10 + size + footer
+    return 0
+
+
+def scan_frames(buf, start=0):
+    """
+    mp3 frames of buf (bytes or mmap) from start, until the first broken frame or a trailing tag
+    """
+    frames = []
+    offset = start
+    end = len(buf)
+    while offset + 4 <= end:
+        size = _frame_size(struct.unpack_from('>I', buf, offset)[0])
+        if size is None or offset + size > end:
+            break
+        frames.append(Mp3Frame(offset, size))
+        offset += size
+    return frames
+
+
+def count_frames(mp3_file):
+    with open(mp3_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        return len(scan_frames(buf, id3v2_size(buf[:10])))
+
+
+def _side_info_size(header):
+    mpeg1 = (header >> 19) & 3 == 3
+    mono = (header >> 6) & 3 == 3
+    if mpeg1:
+        return 17 if mono else 32
+    return 9 if mono else 17
+
+
+def xing_offset(frame):
+    """
+    Offset of the 'Xing' / 'Info' tag in the first frame, None if it is not a Xing frame
+    """
+    header = struct.unpack_from('>I', frame, 0)[0]
+    offset = 4 + _side_info_size(header)
+    if frame[offset:offset + 4] in (b'Xing', b'Info'):
+        return offset
+    return None
+
+
+def xing_frames(frame):
+    """
+    Frame count of the Xing / Info tag, None if the tag has no count
+    """
+    offset = xing_offset(frame)
+    if offset is None or len(frame) < offset + 12:
+        return None
+    flags, frames = struct.unpack_from('>II', frame, offset + 4)
+    return frames if flags & 1 else None
+
+
+def estimate_info(mp3_file):
+    """
+    AudioInfo of the decoded mp3 from the first frame, without decoding.
+    The frames are exact with a Xing / Info tag, estimated by the bitrate of the first frame otherwise.
+    None if there is no frame at the beginning.
+    """
+    with open(mp3_file, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        start = id3v2_size(f.read(10))
+        f.seek(start)
+        frame = f.read(4096)
+    if len(frame) < 4:
+        return None
+    header = struct.unpack_from('>I', frame, 0)[0]
+    size = _frame_size(header)
+    if size is None:
+        return None
+
+    frame_rate = _SAMPLE_RATES[(header >> 19) & 3][(header >> 10) & 3]
+    channels = 1 if (header >> 6) & 3 == 3 else 2
+    count = xing_frames(frame[:size])
+    if count is None:
+        count = (file_size - start) // size
+    return sound_api.AudioInfo(channels, frame_rate, 2, count * samples_per_frame(frame_rate))
+
+
+def _crc16(data, crc=0):
+    """
+    CRC-16 (ANSI, reflected) used by the LAME tag
+    """
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+def update_xing(frame, frames, stream_bytes, toc, total_samples, frame_rate):
+    """
+    Xing frame (bytearray) updated for the whole stream.
+    toc : 100 byte positions by percent, relative to the Xing frame.
+    """
+    offset = xing_offset(frame)
+    if offset is None:
+        return frame
+
+    flags = struct.unpack_from('>I', frame, offset + 4)[0]
+    position = offset + 8
+    if flags & 1:
+        struct.pack_into('>I', frame, position, frames)
+        position += 4
+    if flags & 2:
+        struct.pack_into('>I', frame, position, stream_bytes)
+        position += 4
+    if flags & 4:
+        frame[position:position + 100] = bytes(min(255, 256 * p // max(1, stream_bytes)) for p in toc)
+        position += 100
+    if flags & 8:
+        position += 4
+
+    # LAME extension : 9 bytes version string, then delay / padding at +21, music length at +28
+    lame = position
+    if lame + 36 > len(frame) or frame[lame:lame + 4] not in (b'LAME', b'Lavf', b'Lavc', b'GOGO'):
+        return frame
+    delay = struct.unpack_from('>I', b'\0' + frame[lame + 21:lame + 24])[0] >> 12
+    padding = frames * samples_per_frame(frame_rate) - delay - total_samples
+    if 0 <= padding < 1 << 12:
+        frame[lame + 21:lame + 24] = struct.pack('>I', (delay << 12) | padding)[1:]
+    struct.pack_into('>I', frame, lame + 28, stream_bytes)
+    # music CRC is not computed for the stitched stream
+    struct.pack_into('>H', frame, lame + 32, 0)
+    struct.pack_into('>H', frame, lame + 34, 0)
+    struct.pack_into('>H', frame, lame + 34, _crc16(frame[:lame + 34]))
+    return frame
+
+
+def plan_segments(nframes, frame_rate, jobs):
+    """
+    Segment boundaries in PCM frames, aligned to the mp3 frames
+    """
+    spf = samples_per_frame(frame_rate)
+    count = min(jobs, max(1, int(nframes / frame_rate / MIN_SEGMENT_SEC)))
+    bounds = [round(i * nframes / count / spf) * spf for i in range(count)] + [nframes]
+    return [(bounds[i], bounds[i + 1]) for i in range(count) if bounds[i] < bounds[i + 1]]
+
+
+def _encode_segment(source_file, part_file, params, first, last, bitrate, with_header):
+    """
+    Encode the PCM frames [first, last) of source_file into part_file, fed through a pipe
+    """
+    command = [
+        'ffmpeg', '-vn', '-y', '-loglevel', 'fatal',
+        '-f', _PCM_FORMATS[params.sampwidth], '-ar', str(params.framerate), '-ac', str(params.nchannels),
+        '-i', 'pipe:0',
+    ]
+    if with_header:
+        # tags of the source file and the Xing / LAME header go to the first segment only
+        command += ['-i', source_file, '-map', '0:a', '-map_metadata', '1']
+    else:
+        command += ['-write_xing', '0', '-id3v2_version', '0']
+    command += ['-c:a', 'libmp3lame', '-reservoir', '0']
+    if bitrate:
+        command += ['-b:a', bitrate]
+    command += ['-f', 'mp3', part_file]
+    feed_ffmpeg(command, source_file, params, first, last)
+
+
+def feed_ffmpeg(command, source_file, params, first, last):
+    """
+    Run the ffmpeg command with the PCM frames [first, last) of the wav source_file on its stdin
+    """
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise FfmpegError('ffmpeg is not found.') from None
+
+    try:
+        with wave.open(source_file, 'rb') as w:
+            w.setpos(first)
+            remaining = last - first
+            while remaining > 0:
+                buf = w.readframes(min(BLOCK_FRAMES, remaining))
+                if not buf:
+                    break
+                process.stdin.write(buf)
+                remaining -= len(buf) // (params.nchannels * params.sampwidth)
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+    error = process.stderr.read()
+    process.stderr.close()
+    if process.wait() != 0:
+        raise FfmpegError(f'ffmpeg failed ({process.returncode}). {error.decode(errors="replace").strip()}'.strip())
+
+
+def encode(source_file, destination_file, jobs, bitrate=None):
+    """
+    Encode the wav source_file to the mp3 destination_file by jobs parallel segments.
+    Falls back to a single ffmpeg run when the file is too short to split.
+    """
+    try:
+        with wave.open(source_file, 'rb') as w:
+            params = w.getparams()
+    except sound_api._WAV_ERRORS as e:
+        raise FormatError(f'Invalid wav data. {e}') from None
+    if params.sampwidth not in _PCM_FORMATS:
+        raise FormatError(f'Unsupported sample width: {params.sampwidth} bytes.')
+
+    segments = plan_segments(params.nframes, params.framerate, jobs)
+    if len(segments) < 2:
+        command = ['-i', source_file] + (['-b:a', bitrate] if bitrate else []) + [destination_file]
+        sound_api.run_ffmpeg(command)
+        return ParallelResult(1, count_frames(destination_file), os.path.getsize(destination_file))
+
+    spf = samples_per_frame(params.framerate)
+    overlap = OVERLAP_FRAMES * spf
+    directory = os.path.dirname(os.path.abspath(destination_file))
+    parts = []
+    try:
+        for i in range(len(segments)):
+            fd, part_file = tempfile.mkstemp(prefix=f'.{os.path.basename(destination_file)}.', suffix=f'.part{i}.mp3', dir=directory)
+            os.close(fd)
+            parts.append(part_file)
+
+        # ffmpeg does the work, threads only feed the pipes
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = []
+            for i, (start, end) in enumerate(segments):
+                first = max(0, start - overlap)
+                last = min(params.nframes, end + overlap)
+                futures.append(pool.submit(_encode_segment, source_file, parts[i], params, first, last, bitrate, i == 0))
+            for future in futures:
+                future.result()
+
+        return _stitch(parts, segments, params, destination_file, overlap)
+    finally:
+        for part_file in parts:
+            try:
+                os.remove(part_file)
+            except OSError:
+                pass
+
+
+def _stitch(parts, segments, params, destination_file, overlap):
+    spf = samples_per_frame(params.framerate)
+
+    # frames to keep of each part, as (part index, byte range)
+    ranges = []
+    header = b''
+    xing = None
+    frame_sizes = []
+    for i, (part_file, (start, end)) in enumerate(zip(parts, segments)):
+        with open(part_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            tag_size = id3v2_size(buf[:10])
+            frames = scan_frames(buf, tag_size)
+            if i == 0:
+                header = bytes(buf[:tag_size])
+                if frames and xing_offset(buf[frames[0].offset:frames[0].offset + frames[0].size]) is not None:
+                    xing = bytearray(buf[frames[0].offset:frames[0].offset + frames[0].size])
+                    frames = frames[1:]
+
+            skip = (start - max(0, start - overlap)) // spf
+            if i == len(segments) - 1:
+                keep = frames[skip:]
+            else:
+                keep = frames[skip:skip + (end - start) // spf]
+                if len(keep) != (end - start) // spf:
+                    raise FfmpegError(f'Segment {i} is shorter than expected.')
+            if not keep:
+                raise FfmpegError(f'Segment {i} has no mp3 frame.')
+            ranges.append((part_file, keep[0].offset, keep[-1].offset + keep[-1].size))
+            frame_sizes.extend(frame.size for frame in keep)
+
+    total_frames = len(frame_sizes)
+    xing_size = len(xing) if xing is not None else 0
+    stream_bytes = xing_size + sum(frame_sizes)
+
+    if xing is not None:
+        # byte position of the frame at each percent of the frames
+        positions = np.concatenate([[0], np.cumsum(frame_sizes)]) + xing_size
+        toc = [int(positions[min(total_frames - 1, p * total_frames // 100)]) for p in range(100)]
+        xing = update_xing(xing, total_frames, stream_bytes, toc, params.nframes, params.framerate)
+
+    with open(destination_file, 'wb') as dst:
+        dst.write(header)
+        if xing is not None:
+            dst.write(xing)
+        for part_file, first, last in ranges:
+            with open(part_file, 'rb') as src:
+                src.seek(first)
+                remaining = last - first
+                while remaining > 0:
+                    buf = src.read(min(1 << 20, remaining))
+                    if not buf:
+                        break
+                    dst.write(buf)
+                    remaining -= len(buf)
+
+    return ParallelResult(len(segments), total_frames, os.path.getsize(destination_file))
+
+
+@dataclass
+class SerialCheck:
+    source_frames: int
+    parallel_frames: int
+    serial_frames: int
+    parallel_snr: float     # dB, decoded parallel encode vs source
+    serial_snr: float       # dB, decoded serial encode with the same settings (no bit reservoir) vs source
+    reservoir_snr: float    # dB, decoded serial encode with the bit reservoir vs source, for information
+
+    @property
+    def ok(self):
+        # the joints only, the cost of the disabled bit reservoir is in both
+        return (self.parallel_frames == self.serial_frames == self.source_frames
+                and self.parallel_snr >= self.serial_snr - MAX_SNR_LOSS_DB)
+
+    @property
+    def reservoir_cost(self):
+        """
+        SNR lost by disabling the bit reservoir (dB)
+        """
+        return self.reservoir_snr - self.serial_snr
+
+
+def _lockstep(readers):
+    """
+    Blocks of the same length from several BlockReaders, until the shortest one ends.
+    Returns the generator and the list of the total frames, complete after the generator ends.
+    """
+    totals = [0] * len(readers)
+
+    def blocks():
+        iterators = [iter(reader) for reader in readers]
+        pending = [np.zeros((0, reader.info.channels), np.float32) for reader in readers]
+        done = [False] * len(readers)
+        while True:
+            for k, iterator in enumerate(iterators):
+                while not done[k] and len(pending[k]) < BLOCK_FRAMES:
+                    block = next(iterator, None)
+                    if block is None:
+                        done[k] = True
+                    else:
+                        totals[k] += len(block)
+                        pending[k] = np.concatenate([pending[k], block])
+            n = min(len(p) for p in pending)
+            if n == 0:
+                break
+            yield [p[:n] for p in pending]
+            pending = [p[n:] for p in pending]
+        # count the rest of the longer ones
+        for k, iterator in enumerate(iterators):
+            for block in iterator:
+                totals[k] += len(block)
+
+    return blocks(), totals
+
+
+def _snr(signal, noise):
+    return float('inf') if noise == 0 else float(10 * np.log10(max(signal, 1e-30) / noise))
+
+
+def check_against_serial(source_file, destination_file, bitrate=None):
+    """
+    Encode source_file serially with the settings of the segments (no bit reservoir), and compare
+    the decoded parallel and serial encodes with the source by the number of samples and the SNR.
+    A serial encode with the bit reservoir is compared too, for the cost of disabling it.
+    """
+    directory = os.path.dirname(os.path.abspath(destination_file))
+    serial_files = []
+    try:
+        for reservoir in ('0', '1'):
+            fd, serial_file = tempfile.mkstemp(prefix='.serial.', suffix='.mp3', dir=directory)
+            os.close(fd)
+            serial_files.append(serial_file)
+            command = ['-i', source_file, '-c:a', 'libmp3lame', '-reservoir', reservoir]
+            sound_api.run_ffmpeg(command + (['-b:a', bitrate] if bitrate else []) + [serial_file])
+
+        signal = 0.0
+        noise = [0.0, 0.0, 0.0]
+        with sound_api.BlockReader(source_file) as source, \
+             sound_api.BlockReader(destination_file) as parallel, \
+             sound_api.BlockReader(serial_files[0]) as serial, \
+             sound_api.BlockReader(serial_files[1]) as reservoir:
+            blocks, totals = _lockstep([source, parallel, serial, reservoir])
+            for x, *encoded in blocks:
+                signal += float(np.square(x, dtype=np.float64).sum())
+                for k, y in enumerate(encoded):
+                    noise[k] += float(np.square(y - x, dtype=np.float64).sum())
+        return SerialCheck(totals[0], totals[1], totals[2], *(_snr(signal, n) for n in noise))
+    finally:
+        for serial_file in serial_files:
+            os.remove(serial_file)
@@ -0,0 +1,428 @@
+# 
+# Multi-process PCM pipeline over shared memory
+# 
+# The decoder, each stage (gain, channels, resample, ...) and the encoder run in their own
+# processes, connected by ring buffers in multiprocessing.shared_memory. A slot of a ring holds
+# a float32 block of (frames, channels), which both processes wrap as a NumPy array, so the
+# blocks are never pickled or copied through a pipe : a stage reads its input slot and writes
+# its result straight into the output slot. The slots are handed over by two semaphores per
+# ring (free / filled), so a fast stage waits for a slow one and the memory is bounded by the rings.
+# The stages work on consecutive blocks in parallel, so a chain of stages on one file
+# can use more than one core.
+# 
+
+import math
+import multiprocessing
+import os
+import queue
+import subprocess
+import threading
+import wave
+from multiprocessing import connection, shared_memory
+
+import numpy as np
+
+import sound_api
+import tags
+from sound_api import FfmpegError, ParameterError, SoundFileError
+
+
+BLOCK_FRAMES = 1 << 14          # frames per slot of the decoder ring
+RING_SLOTS = 8
+POLL_SEC = 0.1                  # wait of a slot before checking the abort flag
+
+
+class Aborted(Exception):
+    """
+    Another process of the pipeline has failed
+    """
+
+
+class RingBuffer:
+    """
+    Single producer / single consumer ring of float32 blocks in shared memory.
+    The header holds the frames of each slot, -1 marks the end of the stream.
+    It is passed to a child process by the name of the shared memory.
+    """
+    def __init__(self, context, abort, channels, block_frames=BLOCK_FRAMES, slots=RING_SLOTS):
+        self.channels = channels
+        self.block_frames = block_frames
+        self.slots = slots
+        self.abort = abort
+        self.free = context.Semaphore(slots)
+        self.filled = context.Semaphore(0)
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * 8 + slots * block_frames * channels * 4)
+        # only the creator unlinks the memory
+        self.owner = os.getpid()
+        self._map()
+
+    def _map(self):
+        self.frames = np.ndarray((self.slots,), dtype=np.int64, buffer=self.shm.buf)
+        self.data = np.ndarray((self.slots, self.block_frames, self.channels), dtype=np.float32, buffer=self.shm.buf, offset=self.slots * 8)
+        self.head = 0           # next slot to write
+        self.tail = 0           # next slot to read
+
+    def __getstate__(self):
+        return {
+            'name': self.shm.name, 'channels': self.channels, 'block_frames': self.block_frames, 'slots': self.slots,
+            'abort': self.abort, 'free': self.free, 'filled': self.filled,
+        }
+
+    def __setstate__(self, state):
+        name = state.pop('name')
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=name, track=False)
+        self.owner = None
+        self._map()
+
+    def _wait(self, semaphore):
+        while not semaphore.acquire(timeout=POLL_SEC):
+            if self.abort.is_set():
+                raise Aborted
+
+    def reserve(self):
+        """
+        Next free slot to write, as an array of (block_frames, channels)
+        """
+        self._wait(self.free)
+        return self.data[self.head]
+
+    def commit(self, frames):
+        """
+        Hand over the reserved slot with its frames
+        """
+        self.frames[self.head] = frames
+        self.head = (self.head + 1) % self.slots
+        self.filled.release()
+
+    def end(self):
+        self.reserve()
+        self.commit(-1)
+
+    def receive(self):
+        """
+        Next block of (frames, channels) as a view of the slot, None at the end of the stream.
+        The slot is valid until release().
+        """
+        self._wait(self.filled)
+        frames = int(self.frames[self.tail])
+        if frames < 0:
+            return None
+        return self.data[self.tail, :frames]
+
+    def release(self):
+        self.tail = (self.tail + 1) % self.slots
+        self.free.release()
+
+    def close(self):
+        # the views must be released before the shared memory
+        self.frames = self.data = None
+        self.shm.close()
+        if self.owner == os.getpid():
+            self.shm.unlink()
+
+
+# 
+# Stages
+# 
+
+class Stage:
+    """
+    A step of the pipeline. setup() gets the format of the input and returns the format of the output,
+    before max_frames() is called. process() writes the output of one input block into out and returns its frames.
+    """
+    def setup(self, channels, frame_rate):
+        return channels, frame_rate
+
+    def max_frames(self, block_frames):
+        """
+        Output frames of an input block at most
+        """
+        return block_frames
+
+    def process(self, block, out):
+        raise NotImplementedError
+
+    def flush(self, out):
+        """
+        Frames held by the stage at the end of the stream
+        """
+        return 0
+
+
+class Gain(Stage):
+    def __init__(self, dB):
+        self.dB = dB
+        self.factor = np.float32(10 ** (dB / 20))
+
+    def process(self, block, out):
+        np.multiply(block, self.factor, out=out[:len(block)])
+        return len(block)
+
+
+class Channels(Stage):
+    """
+    Downmix to monaural by the mean, or copy a monaural channel to stereo
+    """
+    def __init__(self, ch):
+        if ch not in (1, 2):
+            raise ParameterError('Channels must be 1 or 2.')
+        self.ch = ch
+
+    def setup(self, channels, frame_rate):
+        return self.ch, frame_rate
+
+    def process(self, block, out):
+        if self.ch == 1:
+            np.mean(block, axis=1, keepdims=True, out=out[:len(block)])
+        else:
+            out[:len(block)] = block[:, :1] if block.shape[1] == 1 else block[:, :2]
+        return len(block)
+
+
+class Resample(Stage):
+    """
+    Windowed-sinc resampling by sound_api.StreamResampler, the frames delayed by the filter
+    are output by flush()
+    """
+    def __init__(self, samrate):
+        if samrate <= 0:
+            raise ParameterError('Sampling rate must be positive.')
+        self.samrate = samrate
+        self.resampler = None
+
+    def setup(self, channels, frame_rate):
+        self.frame_rate = frame_rate
+        self.resampler = sound_api.StreamResampler(frame_rate, self.samrate)
+        return channels, self.samrate
+
+    def max_frames(self, block_frames):
+        # the frames held by the filter are output with a block, or by flush()
+        return math.ceil((block_frames + 2 * self.resampler.half) * self.samrate / self.frame_rate) + 2
+
+    def process(self, block, out):
+        samples = self.resampler.process(block)
+        out[:len(samples)] = samples
+        return len(samples)
+
+    def flush(self, out):
+        samples = self.resampler.flush()
+        out[:len(samples)] = samples
+        return len(samples)
+
+
+# 
+# Processes
+# 
+
+def _report(errors, abort, e):
+    if not isinstance(e, SoundFileError):
+        e = SoundFileError(f'{type(e).__name__}: {e}')
+    errors.put(e)
+    abort.set()
+
+
+def _decode_worker(source_file, ring, errors):
+    """
+    Decode source_file into float32 blocks of the ring
+    """
+    try:
+        with sound_api.BlockReader(source_file, block_frames=ring.block_frames) as reader:
+            info = reader.info
+            scale = np.float32(1 / sound_api._full_scale(info.sample_width))
+            while buf := reader.read_raw(ring.block_frames):
+                samples = sound_api._from_pcm_bytes(buf, info.channels, info.sample_width)
+                out = ring.reserve()[:len(samples)]
+                np.multiply(samples, scale, out=out, casting='unsafe')
+                if info.sample_width == 1:
+                    out -= 1.0
+                ring.commit(len(samples))
+        ring.end()
+    except Aborted:
+        pass
+    except BaseException as e:
+        _report(errors, ring.abort, e)
+    finally:
+        ring.close()
+
+
+def _stage_worker(stage, source, sink, errors):
+    """
+    Run the stage from the source ring to the sink ring
+    """
+    try:
+        while (block := source.receive()) is not None:
+            out = sink.reserve()
+            frames = stage.process(block, out)
+            source.release()
+            sink.commit(frames)
+        frames = stage.flush(sink.reserve())
+        if frames > 0:
+            sink.commit(frames)
+            sink.end()
+        else:
+            sink.commit(-1)
+    except Aborted:
+        pass
+    except BaseException as e:
+        _report(errors, source.abort, e)
+    finally:
+        source.close()
+        sink.close()
+
+
+def _ring_blocks(ring):
+    """
+    Blocks of the ring until the end of the stream, a slot is released when the next block is requested
+    """
+    while (block := ring.receive()) is not None:
+        yield block
+        ring.release()
+
+
+def _encode_wav(blocks, destination_file, channels, frame_rate, sample_width):
+    """
+    Write the float32 blocks of (frames, channels) as wav
+    """
+    with wave.open(destination_file, 'wb') as w:
+        w.setnchannels(channels)
+        w.setsampwidth(sample_width)
+        w.setframerate(frame_rate)
+        for block in blocks:
+            w.writeframesraw(sound_api._to_pcm_bytes(sound_api.from_float(block, frame_rate, sample_width)))
+
+
+def _encode_mp3(blocks, destination_file, channels, frame_rate, source_file):
+    """
+    Encode the float32 blocks of (frames, channels) by ffmpeg, with the tags of source_file
+    """
+    command = [
+        'ffmpeg', '-vn', '-y', '-loglevel', 'fatal',
+        '-f', 'f32le', '-ar', str(frame_rate), '-ac', str(channels), '-i', 'pipe:0',
+        # tags of the source file
+        '-i', source_file, '-map', '0:a', '-map_metadata', '1',
+        '-c:a', 'libmp3lame', '-f', 'mp3', destination_file,
+    ]
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise FfmpegError('ffmpeg is not found.') from None
+
+    # stderr is read by a thread, ffmpeg may write much while the blocks are fed
+    error = []
+    reader = threading.Thread(target=lambda: error.append(process.stderr.read()))
+    reader.start()
+    try:
+        for block in blocks:
+            # the block itself is written to the pipe
+            process.stdin.write(memoryview(block).cast('B'))
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        process.wait()
+        reader.join()
+    if process.returncode != 0:
+        raise FfmpegError(f'ffmpeg failed ({process.returncode}). {error[0].decode(errors="replace").strip()}'.strip())
+
+
+def _watch(processes, abort):
+    """
+    Set the abort flag when a process dies without reporting its error
+    """
+    pending = {process.sentinel: process for process in processes}
+    while pending:
+        for sentinel in connection.wait(list(pending)):
+            if pending.pop(sentinel).exitcode != 0:
+                abort.set()
+
+
+def _context():
+    """
+    forkserver, or spawn where it is not available. Not fork, a batch / watch runs the pipeline
+    on a thread of a multi-threaded process. The server imports this module only, not __main__.
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+def run(source_file, destination_file, stages, overwrite=False, block_frames=BLOCK_FRAMES):
+    """
+    Decode source_file, run each of the stages in its own process and encode destination_file (wav or mp3).
+    Returns the FileResult.
+    """
+    sound_api.check_source(source_file)
+    sound_api.check_destination(destination_file, overwrite)
+    sound_api._check_format(sound_api._extension(source_file), 'source file')
+    dst_ext = sound_api._check_format(sound_api._extension(destination_file), 'destination file')
+
+    info = sound_api._header_info(source_file)
+    context = _context()
+    abort = context.Event()
+    errors = context.Queue()
+
+    rings = []
+    processes = []
+    try:
+        channels, frame_rate = info.channels, info.frame_rate
+        rings.append(RingBuffer(context, abort, channels, block_frames))
+        for stage in stages:
+            channels, frame_rate = stage.setup(channels, frame_rate)
+            frames = stage.max_frames(rings[-1].block_frames)
+            rings.append(RingBuffer(context, abort, channels, frames))
+
+        processes.append(context.Process(target=_decode_worker, args=(source_file, rings[0], errors), daemon=True))
+        for i, stage in enumerate(stages):
+            processes.append(context.Process(target=_stage_worker, args=(stage, rings[i], rings[i + 1], errors), daemon=True))
+        for process in processes:
+            process.start()
+        watcher = threading.Thread(target=_watch, args=(processes, abort), daemon=True)
+        watcher.start()
+
+        try:
+            with sound_api.atomic_output(destination_file, overwrite) as temp_file:
+                if dst_ext == '.wav':
+                    _encode_wav(_ring_blocks(rings[-1]), temp_file, channels, frame_rate, info.sample_width)
+                    tags.copy_info_tags(source_file, temp_file)
+                else:
+                    _encode_mp3(_ring_blocks(rings[-1]), temp_file, channels, frame_rate, source_file)
+        except Aborted:
+            try:
+                raise errors.get(timeout=1.0) from None
+            except queue.Empty:
+                raise SoundFileError('A process of the pipeline has failed.') from None
+        except BaseException:
+            abort.set()
+            raise
+    finally:
+        for process in processes:
+            process.join(timeout=5.0)
+            if process.is_alive():
+                process.terminate()
+        for ring in rings:
+            ring.close()
+
+    return sound_api._result('chain', [source_file], destination_file)
+
+
+def chain_file(source_file, destination_file, dB=None, ch=None, samrate=None, overwrite=False, block_frames=BLOCK_FRAMES):
+    """
+    Change the volume, the channels and the sampling rate in one pass, in this order,
+    each operation in its own process
+    """
+    stages = []
+    if dB is not None:
+        stages.append(Gain(dB))
+    if ch is not None:
+        stages.append(Channels(ch))
+    if samrate is not None:
+        stages.append(Resample(samrate))
+    if not stages:
+        raise ParameterError('No operation is specified.')
+    return run(source_file, destination_file, stages, overwrite, block_frames)
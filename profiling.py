@@ -0,0 +1,385 @@
+# 
+# Per-job profiling and tracing hooks
+# 
+# Nothing is wrapped until instrument() is called, so the converter functions
+# and the ffmpeg calls run untouched when profiling is disabled.
+# While the profiler runs, subprocess.Popen is replaced to count every ffmpeg started
+# (run_ffmpeg, the streamed decoders / encoders and pydub), and the memory (PSS) of the
+# process and its children is sampled, so each phase gets its own peak memory.
+# 
+
+import cProfile
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import wraps
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+
+SAMPLE_SEC = 0.05               # interval of the memory sampling
+_POPEN_MODULES = ('subprocess', 'pydub.utils')      # modules whose Popen is replaced while profiling
+
+
+@dataclass
+class PhaseRecord:
+    name: str
+    category: str
+    depth: int
+    tid: int
+    start: float                        # sec from the profiler start
+    wall: float = 0.0                   # sec
+    cpu: float = 0.0                    # sec, this process
+    child_cpu: float | None = None      # sec, subprocesses (ffmpeg)
+    bytes_read: int = 0                 # process-wide, see io_shared
+    bytes_written: int = 0
+    io_shared: bool = False             # phases of other threads ran at the same time, their I/O is counted too
+    subprocesses: int = 0
+    peak_memory: int | None = None      # bytes, peak memory (PSS) of this process and its children during the phase
+    error: str | None = None
+    args: dict = field(default_factory=dict)
+
+
+def _io_counters():
+    """
+    Bytes read / written by this process and its reaped children so far,
+    None if the platform can not tell
+    """
+    try:
+        with open('/proc/self/io', 'rb') as f:
+            counters = dict(line.split(b':') for line in f.read().splitlines())
+        return int(counters[b'rchar']), int(counters[b'wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _child_cpu():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _max_rss():
+    """
+    High-water mark of the RSS of this process or a reaped child over the whole run, not of a phase
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is kB on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * scale
+
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def _children(pid):
+    children = []
+    try:
+        for tid in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{tid}/children', 'rb') as f:
+                children += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    return children
+
+
+def _rss(pid):
+    """
+    Proportional set size of the process (the shared pages are divided among the processes
+    sharing them, such as forked workers and shared memory), RSS on the older kernels
+    """
+    try:
+        with open(f'/proc/{pid}/smaps_rollup', 'rb') as f:
+            for line in f:
+                if line.startswith(b'Pss:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    with open(f'/proc/{pid}/statm', 'rb') as f:
+        return int(f.read().split()[1]) * _PAGE_SIZE
+
+
+def _tree_rss():
+    """
+    Current memory of this process and its descendants (ffmpeg, pipeline workers),
+    None if the platform can not tell (no procfs)
+    """
+    total = 0
+    pending = [os.getpid()]
+    while pending:
+        pid = pending.pop()
+        try:
+            total += _rss(pid)
+        except (OSError, IndexError, ValueError):
+            if pid == os.getpid():
+                return None
+            # exited meanwhile
+            continue
+        pending += _children(pid)
+    return total
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError, ValueError):
+        return 0
+
+
+def _ffmpeg_paths(command):
+    """
+    Input files ('-i' arguments) and output file (last argument) of a ffmpeg command list
+    """
+    inputs = [command[i + 1] for i, arg in enumerate(command[:-1]) if arg == '-i']
+    output = command[-1] if command else None
+    return inputs, output
+
+
+class Profiler:
+    def __init__(self, cprofile=False):
+        self.records = []
+        self.origin = time.perf_counter()
+        self.subprocess_count = 0
+        self.max_rss = None
+        self.cprofile = cProfile.Profile() if cprofile else None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._active = {}           # id -> record of the running phases, of all the threads
+        self._popen = {}            # module -> original Popen
+        self._sampler = None
+        self._stopped = threading.Event()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _hook_popen(self):
+        profiler = self
+
+        class CountedPopen(subprocess.Popen):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                with profiler._lock:
+                    profiler.subprocess_count += 1
+
+        for name in _POPEN_MODULES:
+            module = sys.modules.get(name)
+            if module is not None and getattr(module, 'Popen', None) is subprocess.Popen:
+                self._popen[module] = module.Popen
+        for module in self._popen:
+            module.Popen = CountedPopen
+
+    def _unhook_popen(self):
+        for module, popen in self._popen.items():
+            module.Popen = popen
+        self._popen = {}
+
+    def _sample(self):
+        """
+        Raise the peak memory of the running phases to the current RSS
+        """
+        rss = _tree_rss()
+        if rss is None:
+            return
+        with self._lock:
+            for record in self._active.values():
+                record.peak_memory = max(record.peak_memory or 0, rss)
+
+    def _sample_loop(self):
+        while not self._stopped.wait(SAMPLE_SEC):
+            self._sample()
+
+    def start(self):
+        self._hook_popen()
+        if _tree_rss() is not None:
+            self._stopped.clear()
+            self._sampler = threading.Thread(target=self._sample_loop, name='profiler-memory', daemon=True)
+            self._sampler.start()
+        if self.cprofile is not None:
+            self.cprofile.enable()
+
+    def stop(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        if self._sampler is not None:
+            self._stopped.set()
+            self._sampler.join()
+            self._sampler = None
+        self._unhook_popen()
+        self.max_rss = _max_rss()
+
+    def run(self, name, category, func, args, kwargs):
+        """
+        Call func(*args, **kwargs) and record it as one phase
+        """
+        stack = self._stack()
+        record = PhaseRecord(
+            name=name,
+            category=category,
+            depth=len(stack),
+            tid=threading.get_ident(),
+            start=time.perf_counter() - self.origin,
+        )
+
+        io_0 = _io_counters()
+        child_cpu_0 = _child_cpu()
+        subprocess_0 = self.subprocess_count
+
+        # Without procfs the ffmpeg I/O is invisible, so account for it by file sizes
+        extra_read = extra_written = 0
+        if category == 'subprocess':
+            command = args[0] if args else kwargs.get('command', [])
+            inputs, output = _ffmpeg_paths(command)
+            if io_0 is None:
+                extra_read = sum(_file_size(path) for path in inputs)
+            record.args['command'] = ' '.join(str(arg) for arg in command)
+
+        cpu_0 = time.process_time()
+        wall_0 = time.perf_counter()
+
+        stack.append(record)
+        with self._lock:
+            # the I/O counters are of the whole process, a phase of another thread is counted in both
+            for other in self._active.values():
+                if other.tid != record.tid:
+                    other.io_shared = record.io_shared = True
+            self._active[id(record)] = record
+        self._sample()
+        try:
+            return func(*args, **kwargs)
+        except BaseException as e:
+            record.error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            stack.pop()
+            self._sample()
+            with self._lock:
+                del self._active[id(record)]
+
+            record.wall = time.perf_counter() - wall_0
+            record.cpu = time.process_time() - cpu_0
+            child_cpu_1 = _child_cpu()
+            if child_cpu_0 is not None and child_cpu_1 is not None:
+                record.child_cpu = child_cpu_1 - child_cpu_0
+            io_1 = _io_counters()
+            if io_0 is not None and io_1 is not None:
+                record.bytes_read += io_1[0] - io_0[0]
+                record.bytes_written += io_1[1] - io_0[1]
+            elif category == 'subprocess':
+                extra_written = _file_size(output)
+            record.bytes_read += extra_read
+            record.bytes_written += extra_written
+            record.subprocesses += self.subprocess_count - subprocess_0
+
+            # the estimated subprocess I/O is invisible to the parent phases' counters too
+            for parent in stack:
+                parent.bytes_read += extra_read
+                parent.bytes_written += extra_written
+
+            with self._lock:
+                self.records.append(record)
+
+    def summary(self, file=sys.stderr):
+        """
+        Print a human readable summary, one line per phase in start order
+        """
+        header = f'{"phase":<32} {"wall(s)":>9} {"cpu(s)":>9} {"child(s)":>9} {"read":>11} {"written":>11} {"proc":>5} {"peak mem":>10}'
+        print(header, file=file)
+        print('-' * len(header), file=file)
+        for r in sorted(self.records, key=lambda r: r.start):
+            name = ('  ' * r.depth + r.name)[:32]
+            child = '-' if r.child_cpu is None else f'{r.child_cpu:.3f}'
+            peak = '-' if r.peak_memory is None else _human_bytes(r.peak_memory)
+            mark = '*' if r.io_shared else ' '
+            line = (f'{name:<32} {r.wall:>9.3f} {r.cpu:>9.3f} {child:>9} {_human_bytes(r.bytes_read):>10}{mark} '
+                    f'{_human_bytes(r.bytes_written):>10}{mark} {r.subprocesses:>5} {peak:>10}')
+            if r.error:
+                line += f'  ({r.error})'
+            print(line, file=file)
+        print('read / written : process-wide I/O during the phase (this process and its finished ffmpeg)', file=file)
+        if any(r.io_shared for r in self.records):
+            print('  * phases of other threads ran at the same time, their I/O is included', file=file)
+        if self.max_rss is not None:
+            print(f'Process high-water mark (ru_maxrss of this process or a child, whole run) : {_human_bytes(self.max_rss)}', file=file)
+
+    def trace_events(self):
+        """
+        Records as Chrome trace-event 'complete' events (chrome://tracing, Perfetto)
+        """
+        pid = os.getpid()
+        events = []
+        for r in self.records:
+            args = dict(r.args)
+            args.update({
+                'cpu_s': r.cpu,
+                'child_cpu_s': r.child_cpu,
+                'bytes_read': r.bytes_read,
+                'bytes_written': r.bytes_written,
+                'io_scope': 'process',
+                'io_shared': r.io_shared,
+                'subprocesses': r.subprocesses,
+                'peak_memory': r.peak_memory,
+            })
+            if r.error:
+                args['error'] = r.error
+            events.append({
+                'name': r.name,
+                'cat': r.category,
+                'ph': 'X',
+                'ts': r.start * 1e6,
+                'dur': r.wall * 1e6,
+                'pid': pid,
+                'tid': r.tid,
+                'args': args,
+            })
+        return events
+
+    def write_trace(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}, f)
+
+    def dump_cprofile(self, path):
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(path)
+
+
+def _human_bytes(n):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(n) < 1024 or unit == 'GiB':
+            return f'{n:.0f}{unit}' if unit == 'B' else f'{n:.1f}{unit}'
+        n /= 1024
+
+
+def wrap(profiler, func, name=None, category='function'):
+    name = name or func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return profiler.run(name, category, func, args, kwargs)
+
+    wrapper.__wrapped_by_profiler__ = True
+    return wrapper
+
+
+def instrument(profiler, namespace, names, category='function'):
+    """
+    Replace the functions namespace[name] with profiled wrappers.
+    Call sites which look the function up through the namespace (module globals) are profiled.
+    """
+    for name in names:
+        func = namespace.get(name)
+        if func is None or getattr(func, '__wrapped_by_profiler__', False):
+            continue
+        namespace[name] = wrap(profiler, func, name, category)
@@ -1,6 +1,9 @@
 import os
+import shutil
+import struct
+import tempfile
 import wave
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
 class WavError(Exception):
@@ -17,6 +20,12 @@ class RIFFHeader:           # 12 bytes
 class ChunkHeader:          # 8 bytes
     chunk_id: str           # 4 bytes strings
     chunk_size: int         # 4 byte integer
+    offset: int = 0         # file position of the chunk header (not in the file)
+
+    @property
+    def total_size(self):
+        # header + data + padding byte
+        return 8 + self.chunk_size + self.chunk_size % 2
 
 @dataclass
 class FmtChunk:             # 16 bytes
@@ -30,6 +39,21 @@ class FmtChunk:             # 16 bytes
 @dataclass
 class InfoTag:              # 4 bytes
     info_tag: str           # 4 bytes strings
+    items: dict = field(default_factory=dict)   # sub chunks, 4 bytes id -> text
+
+@dataclass
+class BextChunk:            # 602 bytes + coding history, EBU Tech 3285
+    description: str        # 256 bytes strings
+    originator: str         # 32 bytes strings
+    originator_reference: str   # 32 bytes strings
+    origination_date: str   # 10 bytes strings, yyyy-mm-dd
+    origination_time: str   # 8 bytes strings, hh:mm:ss
+    time_reference: int     # 8 byte integer, samples since midnight
+    version: int            # 2 byte integer
+    umid: bytes             # 64 bytes
+    loudness: bytes         # 10 bytes, loudness values of version 2
+    reserved: bytes         # 180 bytes
+    coding_history: str     # variable length
 
 @dataclass
 class SubChunk:
@@ -150,3 +174,266 @@ def remove_chunk(src_file, dst_file):
     pass
 
 
+# 
+# LIST/INFO and bext tags
+# 
+# The tags are edited in the header region of the file : a new chunk is written over
+# the old one and the JUNK / PAD / FLLR chunks next to it, the rest of the space stays as JUNK.
+# The file is rewritten only when the tags do not fit there, and then a padding
+# chunk is left after them for the later edits.
+# 
+
+INFO_IDS = {
+    'title': b'INAM',
+    'artist': b'IART',
+    'album': b'IPRD',
+    'comment': b'ICMT',
+    'date': b'ICRD',
+    'genre': b'IGNR',
+    'track': b'ITRK',
+    'copyright': b'ICOP',
+    'software': b'ISFT',
+    'engineer': b'IENG',
+}
+
+BEXT_FIELDS = ('description', 'originator', 'originator_reference', 'origination_date',
+               'origination_time', 'time_reference', 'coding_history')
+
+PADDING_IDS = (b'JUNK', b'PAD ', b'FLLR')
+PADDING_SIZE = 1024         # padding chunk left behind by a rewrite (truncated file)
+
+_bext_struct = struct.Struct('<256s32s32s10s8sQH64s10s180s')
+
+
+def read_chunks(f):
+    """
+    Top level chunk headers of a wav file with their offsets
+    """
+    f.seek(0)
+    if (databuf := read_data(f, 12)) is None:
+        raise WavError('read error')
+    analize_riff_header(databuf)
+
+    chunks = []
+    offset = 12
+    while databuf := f.read(8):
+        if len(databuf) != 8:
+            # trailing garbage shorter than a header
+            break
+        chunk = ChunkHeader(*struct.unpack('<4sI', databuf), offset)
+        chunks.append(chunk)
+        offset += chunk.total_size
+        f.seek(offset)
+    return chunks
+
+
+def _text(databuf):
+    return databuf.split(b'\0', 1)[0].decode('utf-8', errors='replace')
+
+
+def analize_info_list(databuf):
+    info = InfoTag(databuf[:4])
+    position = 4
+    while position + 8 <= len(databuf):
+        item_id, size = struct.unpack_from('<4sI', databuf, position)
+        info.items[item_id] = _text(databuf[position + 8:position + 8 + size])
+        position += 8 + size + size % 2
+    return info
+
+
+def analize_bext_chunk(databuf):
+    if len(databuf) < _bext_struct.size:
+        raise WavError('bext chunk error')
+    fields = _bext_struct.unpack_from(databuf)
+    return BextChunk(
+        *(_text(x) for x in fields[:5]),
+        *fields[5:],
+        _text(databuf[_bext_struct.size:]),
+    )
+
+
+def pack_info_list(info):
+    databuf = bytearray(info.info_tag)
+    for item_id, text in info.items.items():
+        value = text.encode('utf-8') + b'\0'
+        databuf += struct.pack('<4sI', item_id, len(value)) + value
+        if len(value) % 2 == 1:
+            databuf += b'\0'
+    return bytes(databuf)
+
+
+def pack_bext_chunk(bext):
+    encode = lambda text: text.encode('utf-8')
+    return _bext_struct.pack(
+        encode(bext.description), encode(bext.originator), encode(bext.originator_reference),
+        encode(bext.origination_date), encode(bext.origination_time),
+        bext.time_reference, bext.version, bext.umid, bext.loudness, bext.reserved,
+    ) + encode(bext.coding_history)
+
+
+def empty_bext_chunk():
+    return BextChunk('', '', '', '', '', 0, 1, bytes(64), bytes(10), bytes(180), '')
+
+
+def _find_info_list(f, chunks):
+    for chunk in chunks:
+        if chunk.chunk_id == b'LIST':
+            f.seek(chunk.offset + 8)
+            if f.read(4) == b'INFO':
+                return chunk
+    return None
+
+
+def read_tags(src_file):
+    """
+    (InfoTag or None, BextChunk or None) of a wav file
+    """
+    with open(src_file, 'rb') as src:
+        chunks = read_chunks(src)
+        info = bext = None
+        if (chunk := _find_info_list(src, chunks)) is not None:
+            src.seek(chunk.offset + 8)
+            info = analize_info_list(src.read(chunk.chunk_size))
+        for chunk in chunks:
+            if chunk.chunk_id == b'bext':
+                src.seek(chunk.offset + 8)
+                bext = analize_bext_chunk(src.read(chunk.chunk_size))
+                break
+    return info, bext
+
+
+def _pack_chunk(chunk_id, databuf):
+    return struct.pack('<4sI', chunk_id, len(databuf)) + databuf + b'\0' * (len(databuf) % 2)
+
+
+def _junk(size):
+    return struct.pack('<4sI', b'JUNK', size - 8) + bytes(size - 8)
+
+
+def _free_regions(chunks, old):
+    """
+    (start, end) of the runs of padding chunks in file order, the old chunk counts as padding
+    """
+    regions = []
+    for chunk in chunks:
+        if chunk is not old and chunk.chunk_id not in PADDING_IDS:
+            continue
+        end = chunk.offset + chunk.total_size
+        if regions and regions[-1][1] == chunk.offset:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((chunk.offset, end))
+    return regions
+
+
+def _write_chunk(path, chunks, old, chunk_id, databuf):
+    """
+    Replace the chunk old (None for a new chunk) by chunk_id, or remove it if databuf is None.
+    The old chunk becomes a padding chunk, the new one goes to the first padding it fits,
+    else after the last chunk.
+    Returns 'in place', 'append' or 'rewrite'.
+    """
+    new = _pack_chunk(chunk_id, databuf) if databuf is not None else b''
+    if not new and old is None:
+        return 'in place'
+    data_chunk = next((c for c in chunks if c.chunk_id == b'data'), None)
+
+    file_size = os.path.getsize(path)
+    file_end = chunks[-1].offset + chunks[-1].total_size if chunks else 12
+    regions = _free_regions(chunks, old)
+
+    for start, end in regions:
+        if end > file_size or not (end - start == len(new) or end - start - len(new) >= 8):
+            continue
+        # in place, the rest of the space is a padding chunk
+        rest = end - start - len(new)
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            f.write(new + (_junk(rest) if rest else b''))
+            if old is not None and not start <= old.offset < end:
+                f.seek(old.offset)
+                f.write(_junk(old.total_size))
+        return 'in place'
+
+    if file_end <= file_size:
+        # after the last chunk, the padding at the end of the file is reused, the data is not moved
+        start = regions[-1][0] if regions and regions[-1][1] == file_end else file_end
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            f.write(new)
+            f.truncate()
+            f.seek(4)
+            f.write(struct.pack('<I', start + len(new) - 8))
+            if old is not None and old.offset < start:
+                f.seek(old.offset)
+                f.write(_junk(old.total_size))
+        return 'append'
+
+    # the last chunk is truncated, rewrite the file,
+    # the new chunk and a padding chunk are placed before the data chunk
+    truncated = chunks[-1]
+    if truncated is not data_chunk and truncated is not old and truncated.chunk_id not in PADDING_IDS:
+        # the chunk would be copied shorter than its header says
+        raise WavError(f'{truncated.chunk_id.decode("latin-1").strip()} chunk is truncated')
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_file = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with open(path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            dst.write(b'RIFF\0\0\0\0WAVE')
+            for chunk in chunks:
+                if chunk is data_chunk and new:
+                    dst.write(new + _junk(PADDING_SIZE))
+                    new = b''
+                if chunk is old or chunk.chunk_id in PADDING_IDS:
+                    continue
+                src.seek(chunk.offset)
+                shutil.copyfileobj(_LimitedReader(src, min(chunk.total_size, file_size - chunk.offset)), dst)
+            if new:
+                dst.write(new)
+            size = dst.tell()
+            dst.seek(4)
+            dst.write(struct.pack('<I', size - 8))
+        shutil.copymode(path, temp_file)
+        os.replace(temp_file, path)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+    return 'rewrite'
+
+
+class _LimitedReader:
+    """
+    File object which reads up to size bytes, for shutil.copyfileobj
+    """
+    def __init__(self, f, size):
+        self.f = f
+        self.size = size
+
+    def read(self, n=-1):
+        n = self.size if n < 0 else min(n, self.size)
+        databuf = self.f.read(n)
+        self.size -= len(databuf)
+        return databuf
+
+
+def write_tags(dst_file, info=None, bext=None):
+    """
+    Write the InfoTag and / or the BextChunk to a wav file, an InfoTag without items or
+    a bext of empty_bext_chunk() removes the chunk. Returns the list of the write modes.
+    """
+    modes = []
+    for chunk_id, value in ((b'LIST', info), (b'bext', bext)):
+        if value is None:
+            continue
+        with open(dst_file, 'rb') as f:
+            chunks = read_chunks(f)
+            if chunk_id == b'LIST':
+                old = _find_info_list(f, chunks)
+                databuf = pack_info_list(value) if value.items else None
+            else:
+                old = next((c for c in chunks if c.chunk_id == b'bext'), None)
+                databuf = pack_bext_chunk(value) if value != empty_bext_chunk() else None
+        if old is None and databuf is None:
+            continue
+        modes.append(_write_chunk(dst_file, chunks, old, chunk_id, databuf))
+    return modes
@@ -0,0 +1,333 @@
+# 
+# Resumable segmented processing of long files
+# 
+# A long job is split into segments at PCM frame offsets, each segment is processed into
+# a part file of a work directory next to the destination (.<name>.resume), and a checkpoint
+# is written after each completed segment. A rerun of the same job with resume keeps the completed
+# parts and processes the rest only, then the parts are stitched into the destination.
+# The segments are opt-in (segment_sec or resume), the single run of the other jobs is not changed.
+#   samrate wav -> wav : the segments are aligned to the period of the rate ratio, so each
+#                        segment starts at an exact output frame. Each segment is resampled
+#                        with some extra frames before and after to prime the filter,
+#                        and the extra output frames are dropped.
+#   conv wav -> mp3    : the segments are aligned to the mp3 frames and stitched as parallel_mp3.
+#   conv mp3 -> wav    : the decoded PCM is written by segments, a rerun skips the decoded frames.
+# The checkpoint has the size and the modification time of the source, a changed source
+# or changed parameters start the job over.
+# 
+
+import json
+import math
+import os
+import shutil
+import threading
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import parallel_mp3
+import sound_api
+import tags
+from sound_api import FfmpegError, FormatError
+
+
+SEGMENT_SEC = 600.0             # default segment length
+RESAMPLE_MARGIN = 8192          # input frames before / after a segment to prime the resampling filter
+COPY_BYTES = 1 << 20
+CHECKPOINT_VERSION = 1
+
+# (operation, source format, destination format) processed by segments
+SEGMENTED_PATHS = (
+    ('samrate', '.wav', '.wav'),
+    ('conv', '.wav', '.mp3'),
+    ('conv', '.mp3', '.wav'),
+)
+
+
+def work_directory(destination_file):
+    directory, name = os.path.split(os.path.abspath(destination_file))
+    return os.path.join(directory, f'.{name}.resume')
+
+
+def _durable(path):
+    """
+    fsync the file and its directory, unless the fsync policy is never
+    """
+    if sound_api._committer.policy != 'never':
+        sound_api._fsync_file(path)
+        sound_api._fsync_directory(os.path.dirname(path))
+
+
+class Checkpoint:
+    """
+    Completed segments of a job in its work directory.
+    job identifies the job (operation, source and parameters), a checkpoint of another job is discarded.
+    """
+    def __init__(self, destination_file, job):
+        self.directory = work_directory(destination_file)
+        self.job = job
+        self.done = {}          # segment index -> record {'index', 'file', 'bytes', 'skip', 'frames'}
+        self.resumed = 0        # segments kept from an earlier run
+        self.lock = threading.Lock()
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, 'checkpoint.json')
+
+    def part(self, index, suffix):
+        return os.path.join(self.directory, f'part{index:05}{suffix}')
+
+    def load(self, resume=False):
+        """
+        Keep the completed parts of the same job with resume, or start over with an empty work directory
+        """
+        state = None
+        if resume:
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+        if not isinstance(state, dict) or state.get('job') != self.job:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.directory)
+            return self
+
+        for record in state.get('done', []):
+            part_file = os.path.join(self.directory, record['file'])
+            if os.path.isfile(part_file) and os.path.getsize(part_file) == record['bytes']:
+                self.done[record['index']] = record
+        self.resumed = len(self.done)
+        return self
+
+    def complete(self, index, part_file, skip, frames):
+        """
+        Record the completed part file of the segment, which has been written to part_file + '.tmp'
+        """
+        os.replace(part_file + '.tmp', part_file)
+        _durable(part_file)
+        record = {
+            'index': index,
+            'file': os.path.basename(part_file),
+            'bytes': os.path.getsize(part_file),
+            'skip': skip,           # leading frames of the part which are not output
+            'frames': frames,       # frames of the part to output, None for the rest of the part
+        }
+        with self.lock:
+            self.done[index] = record
+            state = {'job': self.job, 'done': [self.done[i] for i in sorted(self.done)]}
+            temp_file = self.path + '.tmp'
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(state, f, indent=1)
+            os.replace(temp_file, self.path)
+            _durable(self.path)
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _source_identity(source_file):
+    stat = os.stat(source_file)
+    return {'source': os.path.abspath(source_file), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def applies(operation, source_file, destination_file, segment_sec=None, resume=False):
+    """
+    True if the job is processed by segments : a segmented path and segment_sec > 0,
+    or resume (segments of SEGMENT_SEC) without segment_sec
+    """
+    path = (operation, sound_api._extension(source_file), sound_api._extension(destination_file))
+    if path not in SEGMENTED_PATHS:
+        return False
+    if segment_sec is not None:
+        return segment_sec > 0
+    return resume
+
+
+def _wav_params(source_file):
+    try:
+        with wave.open(source_file, 'rb') as w:
+            params = w.getparams()
+    except sound_api._WAV_ERRORS as e:
+        raise FormatError(f'Invalid wav data. {e}') from None
+    if params.sampwidth not in parallel_mp3._PCM_FORMATS:
+        raise FormatError(f'Unsupported sample width: {params.sampwidth} bytes.')
+    return params
+
+
+def _bounds(nframes, step, segment_frames):
+    """
+    Segments [start, end) of nframes, the starts are multiples of step
+    """
+    segment_frames = max(step, round(segment_frames / step) * step)
+    return [(start, min(start + segment_frames, nframes)) for start in range(0, nframes, segment_frames)]
+
+
+def _run_segments(checkpoint, segments, work, jobs=None):
+    """
+    work(index, start, end) for the segments which are not completed yet
+    """
+    pending = [(i, start, end) for i, (start, end) in enumerate(segments) if i not in checkpoint.done]
+    if not jobs or jobs <= 1:
+        for job in pending:
+            work(*job)
+        return
+
+    # ffmpeg does the work, threads only feed the pipes
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(work, *job) for job in pending]
+        for future in futures:
+            future.result()
+
+
+def _stitch_wav(checkpoint, count, channels, frame_rate, sample_width, destination_file):
+    frame_size = channels * sample_width
+    with wave.open(destination_file, 'wb') as w:
+        w.setnchannels(channels)
+        w.setsampwidth(sample_width)
+        w.setframerate(frame_rate)
+        for i in range(count):
+            record = checkpoint.done[i]
+            with open(os.path.join(checkpoint.directory, record['file']), 'rb') as src:
+                src.seek(record['skip'] * frame_size)
+                remaining = record['bytes'] if record['frames'] is None else record['frames'] * frame_size
+                while remaining > 0:
+                    buf = src.read(min(COPY_BYTES, remaining))
+                    if not buf:
+                        if record['frames'] is not None:
+                            raise FfmpegError(f'Segment {i} is shorter than expected.')
+                        break
+                    w.writeframesraw(buf)
+                    remaining -= len(buf)
+
+
+def _finish(checkpoint, destination_file, overwrite, stitch):
+    with sound_api.atomic_output(destination_file, overwrite) as temp_file:
+        stitch(temp_file)
+    checkpoint.remove()
+    return checkpoint
+
+
+# 
+# samrate wav -> wav
+# 
+
+def _resample_segment(source_file, checkpoint, params, samrate, period, margin, index, start, end, last):
+    first = max(0, start - margin)
+    command = [
+        'ffmpeg', '-vn', '-y', '-loglevel', 'fatal',
+        '-f', parallel_mp3._PCM_FORMATS[params.sampwidth], '-ar', str(params.framerate), '-ac', str(params.nchannels),
+        '-i', 'pipe:0', '-ar', str(samrate), '-f', 's16le',
+    ]
+    part_file = checkpoint.part(index, '.pcm')
+    parallel_mp3.feed_ffmpeg(command + [part_file + '.tmp'], source_file, params, first, min(params.nframes, end + margin))
+
+    # first and start are multiples of the period, so the output frames are exact
+    skip = (start - first) // period * (samrate * period // params.framerate)
+    frames = None if last else (end - start) // period * (samrate * period // params.framerate)
+    checkpoint.complete(index, part_file, skip, frames)
+
+
+def change_samrate(source_file, destination_file, samrate, overwrite=False, segment_sec=None, resume=False):
+    """
+    Resample the wav source_file into destination_file by segments, returns the Checkpoint.
+    resume keeps the completed segments of an interrupted run of the same job.
+    """
+    params = _wav_params(source_file)
+    period = params.framerate // math.gcd(params.framerate, samrate)
+    margin = math.ceil(RESAMPLE_MARGIN / period) * period
+    segments = _bounds(params.nframes, period, (segment_sec or SEGMENT_SEC) * params.framerate)
+
+    job = {'version': CHECKPOINT_VERSION, 'operation': 'samrate', **_source_identity(source_file),
+           'samrate': samrate, 'segments': [list(segment) for segment in segments]}
+    checkpoint = Checkpoint(destination_file, job).load(resume)
+
+    def work(index, start, end):
+        _resample_segment(source_file, checkpoint, params, samrate, period, margin, index, start, end, index == len(segments) - 1)
+    _run_segments(checkpoint, segments, work)
+
+    def stitch(temp_file):
+        # ffmpeg writes 16 bit PCM for wav
+        _stitch_wav(checkpoint, len(segments), params.nchannels, samrate, 2, temp_file)
+        tags.copy_info_tags(source_file, temp_file)
+    return _finish(checkpoint, destination_file, overwrite, stitch)
+
+
+# 
+# conv wav -> mp3
+# 
+
+def encode(source_file, destination_file, overwrite=False, jobs=None, segment_sec=None, resume=False):
+    """
+    Encode the wav source_file into the mp3 destination_file by segments on jobs threads, returns the Checkpoint.
+    resume keeps the completed segments of an interrupted run of the same job.
+    """
+    params = _wav_params(source_file)
+    spf = parallel_mp3.samples_per_frame(params.framerate)
+    overlap = parallel_mp3.OVERLAP_FRAMES * spf
+    segments = _bounds(params.nframes, spf, (segment_sec or SEGMENT_SEC) * params.framerate)
+
+    job = {'version': CHECKPOINT_VERSION, 'operation': 'conv', **_source_identity(source_file),
+           'segments': [list(segment) for segment in segments]}
+    checkpoint = Checkpoint(destination_file, job).load(resume)
+
+    def work(index, start, end):
+        part_file = checkpoint.part(index, '.mpa')
+        first = max(0, start - overlap)
+        last = min(params.nframes, end + overlap)
+        parallel_mp3._encode_segment(source_file, part_file + '.tmp', params, first, last, None, index == 0)
+        checkpoint.complete(index, part_file, 0, None)
+    _run_segments(checkpoint, segments, work, jobs)
+
+    def stitch(temp_file):
+        parts = [os.path.join(checkpoint.directory, checkpoint.done[i]['file']) for i in range(len(segments))]
+        parallel_mp3._stitch(parts, segments, params, temp_file, overlap)
+    return _finish(checkpoint, destination_file, overwrite, stitch)
+
+
+# 
+# conv mp3 -> wav
+# 
+
+def decode(source_file, destination_file, overwrite=False, segment_sec=None, resume=False):
+    """
+    Decode the mp3 source_file into the wav destination_file by segments, returns the Checkpoint.
+    resume keeps the completed segments of an interrupted run of the same job.
+    """
+    segment_sec = segment_sec or SEGMENT_SEC
+    job = {'version': CHECKPOINT_VERSION, 'operation': 'conv', **_source_identity(source_file),
+           'segment_sec': segment_sec}
+    checkpoint = Checkpoint(destination_file, job).load(resume)
+
+    # the segments are consecutive, a part after a missing one is decoded again
+    count = 0
+    while count in checkpoint.done:
+        count += 1
+    start = sum(checkpoint.done[i]['frames'] for i in range(count))
+
+    with sound_api.BlockReader(source_file, start_frame=start) as reader:
+        info = reader.info
+        frame_size = info.channels * info.sample_width
+        segment_frames = round(segment_sec * info.frame_rate)
+        while True:
+            part_file = checkpoint.part(count, '.pcm')
+            frames = 0
+            with open(part_file + '.tmp', 'wb') as f:
+                while frames < segment_frames:
+                    buf = reader.read_raw(min(reader.block_frames, segment_frames - frames))
+                    if not buf:
+                        break
+                    f.write(buf)
+                    frames += len(buf) // frame_size
+            if frames == 0:
+                os.remove(part_file + '.tmp')
+                break
+            checkpoint.complete(count, part_file, 0, frames)
+            count += 1
+            if frames < segment_frames:
+                break
+
+    def stitch(temp_file):
+        _stitch_wav(checkpoint, count, info.channels, info.frame_rate, info.sample_width, temp_file)
+        tags.copy_info_tags(source_file, temp_file)
+    return _finish(checkpoint, destination_file, overwrite, stitch)
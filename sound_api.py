@@ -0,0 +1,1161 @@
+# 
+# Library API of the sound file converter
+# 
+# In-memory operations work on Audio (a NumPy array of samples with its format),
+# which can be loaded from a path, bytes, a file object or a NumPy array.
+# File operations call ffmpeg directly to keep ID3 tags, as the CLI does.
+# Errors are raised as SoundFileError subclasses instead of being printed.
+# Output files are written to a temporary file and renamed, so a killed job
+# never leaves a partial file under the destination name.
+# 
+
+import io
+import math
+import os
+import struct
+import subprocess
+import tempfile
+import threading
+import wave
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import numpy as np
+
+
+class SoundFileError(Exception):
+    pass
+
+class SourceNotFoundError(SoundFileError):
+    pass
+
+class DestinationExistsError(SoundFileError):
+    pass
+
+class FormatError(SoundFileError):
+    pass
+
+class ParameterError(SoundFileError):
+    pass
+
+class FfmpegError(SoundFileError):
+    pass
+
+class MemoryLimitError(SoundFileError):
+    pass
+
+
+def error_message(e):
+    """
+    Message of an exception for a report, an unexpected one is prefixed by its type
+    """
+    if isinstance(e, (SoundFileError, OSError)):
+        return str(e)
+    return f'{type(e).__name__}: {e}' if str(e) else type(e).__name__
+
+
+SUPPORTED_FORMATS = ('.wav', '.mp3')
+
+# sample width (bytes) -> dtype of Audio.samples, 24 bit samples are held in int32
+_DTYPES = {1: np.uint8, 2: np.int16, 3: np.int32, 4: np.int32}
+
+# errors of the wave module on corrupt data, a truncated chunk raises a bare RuntimeError
+_WAV_ERRORS = (wave.Error, EOFError, RuntimeError)
+
+
+@dataclass
+class AudioInfo:
+    channels: int
+    frame_rate: int         # Hz
+    sample_width: int       # bytes
+    frames: int | None      # None if unknown before decoding (mp3 stream)
+
+    @property
+    def duration_ms(self):
+        if self.frames is None:
+            return None
+        return round(self.frames * 1000 / self.frame_rate)
+
+
+@dataclass
+class Audio:
+    samples: np.ndarray     # shape (frames, channels)
+    frame_rate: int         # Hz
+    sample_width: int       # bytes
+
+    @property
+    def channels(self):
+        return self.samples.shape[1]
+
+    @property
+    def frames(self):
+        return self.samples.shape[0]
+
+    @property
+    def duration_ms(self):
+        return round(self.frames * 1000 / self.frame_rate)
+
+    @property
+    def info(self):
+        return AudioInfo(self.channels, self.frame_rate, self.sample_width, self.frames)
+
+    def __len__(self):
+        # same as pydub.AudioSegment, length in msec
+        return self.duration_ms
+
+
+@dataclass
+class FileResult:
+    operation: str
+    sources: tuple
+    destination: str
+    bytes_written: int
+
+
+# 
+# ffmpeg
+# 
+
+def run_ffmpeg(command):
+    """
+    Run ffmpeg with the common options, command is a list of the rest arguments
+    """
+    try:
+        completed = subprocess.run(['ffmpeg', '-vn', '-y', '-loglevel', 'fatal', *command], capture_output=True)
+    except FileNotFoundError:
+        raise FfmpegError('ffmpeg is not found.') from None
+    if completed.returncode != 0:
+        message = completed.stderr.decode(errors='replace').strip()
+        raise FfmpegError(f'ffmpeg failed ({completed.returncode}). {message}'.strip())
+
+
+# 
+# PCM helpers
+# 
+
+def _from_pcm_bytes(buf, channels, sample_width):
+    if sample_width not in _DTYPES:
+        raise FormatError(f'Unsupported sample width: {sample_width} bytes.')
+
+    if sample_width == 3:
+        raw = np.frombuffer(buf, dtype=np.uint8)
+        raw = raw[:len(raw) - len(raw) % 3].reshape(-1, 3)
+        samples = (raw[:, 0].astype(np.int32) | (raw[:, 1].astype(np.int32) << 8) | (raw[:, 2].astype(np.int32) << 16))
+        samples = np.where(samples & 0x800000, samples - 0x1000000, samples).astype(np.int32)
+    else:
+        dtype = np.dtype(_DTYPES[sample_width]).newbyteorder('<')
+        samples = np.frombuffer(buf, dtype=dtype, count=len(buf) // sample_width).astype(_DTYPES[sample_width], copy=False)
+
+    frames = len(samples) // channels
+    return samples[:frames * channels].reshape(frames, channels)
+
+
+def _to_pcm_bytes(audio):
+    samples = np.ascontiguousarray(audio.samples)
+    if audio.sample_width == 3:
+        return samples.astype('<i4').view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    return samples.astype(np.dtype(_DTYPES[audio.sample_width]).newbyteorder('<'), copy=False).tobytes()
+
+
+def _full_scale(sample_width):
+    return float(1 << (8 * sample_width - 1))
+
+
+def to_float(audio):
+    """
+    Samples as float32 in the range of [-1.0, 1.0)
+    """
+    samples = audio.samples.astype(np.float32)
+    if audio.sample_width == 1:
+        samples -= 128.0
+    return samples / np.float32(_full_scale(audio.sample_width))
+
+
+def from_float(samples, frame_rate, sample_width):
+    """
+    Audio from float samples in the range of [-1.0, 1.0), out of range values are clipped
+    """
+    samples = np.asarray(samples, dtype=np.float32)
+    if samples.ndim == 1:
+        samples = samples[:, np.newaxis]
+    scale = _full_scale(sample_width)
+    values = np.clip(np.rint(samples * scale), -scale, scale - 1)
+    if sample_width == 1:
+        values += 128
+    return Audio(values.astype(_DTYPES[sample_width]), frame_rate, sample_width)
+
+
+# 
+# Load / save
+# 
+
+def _extension(path):
+    _, ext = os.path.splitext(os.fspath(path))
+    return ext.lower()
+
+
+def _check_format(fmt, what='source file'):
+    if fmt not in SUPPORTED_FORMATS:
+        raise FormatError(f'Invalid {what} format.')
+    return fmt
+
+
+def _is_path(source):
+    return isinstance(source, (str, os.PathLike))
+
+
+def _read_wav(f):
+    try:
+        with wave.open(f, 'rb') as w:
+            channels = w.getnchannels()
+            sample_width = w.getsampwidth()
+            frame_rate = w.getframerate()
+            buf = w.readframes(w.getnframes())
+    except _WAV_ERRORS as e:
+        raise FormatError(f'Invalid wav data. {e}') from None
+    return Audio(_from_pcm_bytes(buf, channels, sample_width), frame_rate, sample_width)
+
+
+def _read_mp3(f):
+    from pydub import AudioSegment
+
+    try:
+        sound = AudioSegment.from_file(f, format='mp3')
+    except Exception as e:
+        raise FfmpegError(f'Can not decode mp3 data. {e}') from None
+    return Audio(_from_pcm_bytes(sound.raw_data, sound.channels, sound.sample_width), sound.frame_rate, sound.sample_width)
+
+
+def load(source, format=None, frame_rate=None, sample_width=2):
+    """
+    Decode source into Audio.
+    source : path, bytes, binary file object, NumPy array (frames[, channels]) or Audio.
+    format : '.wav' or '.mp3', needed for bytes / file objects without a name.
+    frame_rate, sample_width : format of a NumPy array source.
+    """
+    if isinstance(source, Audio):
+        return source
+
+    if isinstance(source, np.ndarray):
+        if frame_rate is None:
+            raise ParameterError('frame_rate is required for a NumPy array source.')
+        if source.ndim not in (1, 2):
+            raise ParameterError('NumPy array source must be (frames,) or (frames, channels).')
+        if sample_width not in _DTYPES:
+            raise ParameterError(f'Unsupported sample width: {sample_width} bytes.')
+        if np.issubdtype(source.dtype, np.floating):
+            return from_float(source, frame_rate, sample_width)
+        samples = source if source.ndim == 2 else source[:, np.newaxis]
+        return Audio(samples.astype(_DTYPES[sample_width], copy=False), frame_rate, sample_width)
+
+    if _is_path(source):
+        if not os.path.exists(source):
+            raise SourceNotFoundError('Source file does not exist.')
+        fmt = _check_format(format or _extension(source))
+        check_memory(source)
+        with open(source, 'rb') as f:
+            return _read_wav(f) if fmt == '.wav' else _read_mp3(f)
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+
+    fmt = format or _extension(getattr(source, 'name', ''))
+    if not fmt:
+        raise FormatError('format is required for a buffer or file object source.')
+    fmt = _check_format(fmt)
+    return _read_wav(source) if fmt == '.wav' else _read_mp3(source)
+
+
+def save(audio, destination, format=None, overwrite=False):
+    """
+    Encode Audio into destination, a path or a binary file object.
+    Returns the number of bytes written.
+    """
+    if _is_path(destination):
+        check_destination(destination, overwrite)
+        fmt = _check_format(format or _extension(destination), 'destination file')
+        with atomic_output(destination, overwrite) as temp_file:
+            with open(temp_file, 'wb') as f:
+                _write(audio, f, fmt)
+        return _committer.size(destination)
+
+    fmt = format or _extension(getattr(destination, 'name', ''))
+    if not fmt:
+        raise FormatError('format is required for a file object destination.')
+    fmt = _check_format(fmt, 'destination file')
+    start = destination.tell() if destination.seekable() else 0
+    _write(audio, destination, fmt)
+    return destination.tell() - start if destination.seekable() else 0
+
+
+def to_bytes(audio, format='.wav'):
+    f = io.BytesIO()
+    _write(audio, f, _check_format(format, 'destination file'))
+    return f.getvalue()
+
+
+def _write(audio, f, fmt):
+    if fmt == '.wav':
+        with wave.open(f, 'wb') as w:
+            w.setnchannels(audio.channels)
+            w.setsampwidth(audio.sample_width)
+            w.setframerate(audio.frame_rate)
+            w.writeframes(_to_pcm_bytes(audio))
+    else:
+        from pydub import AudioSegment
+
+        sound = AudioSegment(
+            data=_to_pcm_bytes(audio),
+            sample_width=audio.sample_width,
+            frame_rate=audio.frame_rate,
+            channels=audio.channels,
+        )
+        try:
+            sound.export(f, format='mp3')
+        except Exception as e:
+            raise FfmpegError(f'Can not encode mp3 data. {e}') from None
+
+
+def probe(source):
+    """
+    Format of source without keeping the decoded samples.
+    Wav files are probed from the header only, mp3 files are decoded by blocks.
+    """
+    if isinstance(source, Audio):
+        return source.info
+
+    if _is_path(source):
+        if not os.path.exists(source):
+            raise SourceNotFoundError('Source file does not exist.')
+        fmt = _check_format(_extension(source))
+        if fmt == '.wav':
+            try:
+                with wave.open(os.fspath(source), 'rb') as w:
+                    return AudioInfo(w.getnchannels(), w.getframerate(), w.getsampwidth(), w.getnframes())
+            except _WAV_ERRORS as e:
+                raise FormatError(f'Invalid wav data. {e}') from None
+        return _stream_info(source)
+
+    return load(source).info
+
+
+def _header_info(source_file):
+    """
+    Format of the source file from the header, mp3 files are not decoded (the frames are estimated)
+    """
+    if _check_format(_extension(source_file)) == '.wav':
+        return probe(source_file)
+    import parallel_mp3
+    info = parallel_mp3.estimate_info(source_file)
+    if info is None:
+        raise FormatError('Invalid mp3 data.')
+    return info
+
+
+def _stream_info(source_file):
+    """
+    AudioInfo with the frames counted by a streamed decode
+    """
+    frames = 0
+    with BlockReader(source_file) as reader:
+        info = reader.info
+        frame_size = info.channels * info.sample_width
+        while buf := reader.read_raw(reader.block_frames):
+            frames += len(buf) // frame_size
+    return AudioInfo(info.channels, info.frame_rate, info.sample_width, frames)
+
+
+# 
+# Memory budget
+# 
+
+_SIZE_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+# copies of the PCM held by load() : the bytes read (and decoded by pydub for mp3) and the NumPy array
+_LOAD_COPIES = {'.wav': 2, '.mp3': 3}
+
+# PCM bytes / mp3 bytes of 128 kbps, for a file without a readable frame header
+_MP3_EXPANSION = 11
+
+COPY_BLOCK_BYTES = 16 << 20     # largest block of a streamed copy
+
+_max_memory = None
+
+
+def parse_size(text):
+    """
+    Bytes of a size such as 512M, 2G or 1048576
+    """
+    number = text.strip().upper().removesuffix('B')
+    unit = 1
+    if number[-1:] in _SIZE_UNITS:
+        unit = _SIZE_UNITS[number[-1]]
+        number = number[:-1]
+    try:
+        size = int(float(number) * unit)
+    except ValueError:
+        raise ParameterError(f'Invalid size: {text}') from None
+    if size <= 0:
+        raise ParameterError(f'Invalid size: {text}')
+    return size
+
+
+def set_max_memory(size=None):
+    """
+    Memory budget of the operations (bytes), None for no limit
+    """
+    global _max_memory
+    _max_memory = size
+
+
+def max_memory():
+    return _max_memory
+
+
+def fits_in_memory(size):
+    return _max_memory is None or size <= _max_memory
+
+
+def _mb(size):
+    return f'{size / (1 << 20):,.1f} MB'
+
+
+def estimate_memory(source_file):
+    """
+    Bytes held by load() of source_file, estimated from the wav header or the first mp3 frame
+    """
+    fmt = _check_format(_extension(source_file))
+    if fmt == '.wav':
+        info = probe(source_file)
+    else:
+        import parallel_mp3
+        info = parallel_mp3.estimate_info(source_file)
+        if info is None:
+            return _LOAD_COPIES[fmt] * _MP3_EXPANSION * os.path.getsize(source_file)
+    return _LOAD_COPIES[fmt] * info.frames * info.channels * info.sample_width
+
+
+def check_memory(source_file):
+    """
+    Raise MemoryLimitError if load() of source_file exceeds the memory budget
+    """
+    if _max_memory is None:
+        return
+    size = estimate_memory(source_file)
+    if size > _max_memory:
+        raise MemoryLimitError(f'Loading {os.fspath(source_file)} needs about {_mb(size)}, more than the memory budget ({_mb(_max_memory)}).')
+
+
+def copy_block_frames(frame_size):
+    """
+    Frames per block of a streamed copy within the memory budget
+    """
+    block_bytes = COPY_BLOCK_BYTES if _max_memory is None else min(COPY_BLOCK_BYTES, _max_memory // 2)
+    return max(1, block_bytes // frame_size)
+
+
+def waveform_envelope(source_file, points=4096):
+    """
+    (time of the points (sec), lower, upper) : min / max of the samples per point as (points, channels)
+    in the scale of the samples, streamed by blocks for a file which does not fit in the memory budget
+    """
+    info = probe(source_file)
+    step = max(1, -(-info.frames // points))
+    scale = _full_scale(info.sample_width)
+    lower = []
+    upper = []
+    with BlockReader(source_file, block_frames=step * max(1, 65536 // step)) as reader:
+        for samples in reader:
+            starts = np.arange(0, len(samples), step)
+            lower.append(np.minimum.reduceat(samples, starts, axis=0))
+            upper.append(np.maximum.reduceat(samples, starts, axis=0))
+    lower = np.concatenate(lower) * scale if lower else np.zeros((0, info.channels))
+    upper = np.concatenate(upper) * scale if upper else np.zeros((0, info.channels))
+    return np.arange(len(lower)) * step / info.frame_rate, lower, upper
+
+
+# 
+# Streaming
+# 
+
+def find_sound_files(targets, formats=SUPPORTED_FORMATS):
+    """
+    Files of targets, directories are walked recursively for the formats
+    """
+    for target in targets:
+        if os.path.isdir(target):
+            for root, dirs, files in os.walk(target):
+                dirs.sort()
+                for name in sorted(files):
+                    if _extension(name) in formats:
+                        yield os.path.join(root, name)
+        else:
+            yield target
+
+
+def _read_exact(f, size):
+    buf = f.read(size)
+    if len(buf) != size:
+        raise FormatError('Unexpected end of wav stream.')
+    return buf
+
+
+def _read_stream_header(f):
+    """
+    Parse the wav header of a non-seekable stream (ffmpeg pipe output) up to the data chunk.
+    The sizes of the RIFF and data chunks are not reliable in a stream, data is read until EOF.
+    """
+    riff, _, wave_id = struct.unpack('<4sI4s', _read_exact(f, 12))
+    if riff != b'RIFF' or wave_id != b'WAVE':
+        raise FormatError('Invalid wav stream.')
+
+    fmt = None
+    while True:
+        chunk_id, chunk_size = struct.unpack('<4sI', _read_exact(f, 8))
+        if chunk_id == b'data':
+            break
+        body = _read_exact(f, chunk_size + chunk_size % 2)
+        if chunk_id == b'fmt ':
+            fmt = struct.unpack_from('<HHIIHH', body)
+
+    if fmt is None:
+        raise FormatError('No fmt chunk in wav stream.')
+    _, channels, frame_rate, _, _, bits_per_sample = fmt
+    return AudioInfo(channels, frame_rate, bits_per_sample // 8, None)
+
+
+class BlockReader:
+    """
+    Streamed decoding of a sound file as float32 blocks of (frames, channels).
+    Wav is read natively, mp3 is decoded by ffmpeg through a pipe, so memory use
+    depends on block_frames only. channels=1 downmixes the output to monaural.
+    """
+    def __init__(self, source_file, block_frames=65536, channels=None, start_frame=0):
+        check_source(source_file)
+        self.block_frames = block_frames
+        self.downmix = channels == 1
+        self._wave = None
+        self._process = None
+        self._stream = None
+
+        if _check_format(_extension(source_file)) == '.wav':
+            try:
+                self._wave = wave.open(os.fspath(source_file), 'rb')
+            except _WAV_ERRORS as e:
+                raise FormatError(f'Invalid wav data. {e}') from None
+            w = self._wave
+            self.info = AudioInfo(w.getnchannels(), w.getframerate(), w.getsampwidth(), w.getnframes())
+            if start_frame:
+                w.setpos(min(start_frame, w.getnframes()))
+        else:
+            command = ['ffmpeg', '-vn', '-loglevel', 'fatal', '-i', os.fspath(source_file), '-f', 'wav', '-acodec', 'pcm_s16le']
+            if self.downmix:
+                command += ['-ac', '1']
+            command += ['pipe:1']
+            try:
+                self._process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except FileNotFoundError:
+                raise FfmpegError('ffmpeg is not found.') from None
+            self._stream = self._process.stdout
+            try:
+                self.info = _read_stream_header(self._stream)
+            except FormatError:
+                self.close()
+                raise
+            if start_frame:
+                self._skip(start_frame)
+
+    def _skip(self, frames):
+        frame_size = self.info.channels * self.info.sample_width
+        while frames > 0:
+            n = min(frames, self.block_frames)
+            if len(self._stream.read(n * frame_size)) < n * frame_size:
+                break
+            frames -= n
+
+    def read_raw(self, frames):
+        """
+        Next PCM bytes of up to frames, b'' at the end
+        """
+        if self._wave is not None:
+            return self._wave.readframes(frames)
+        return self._stream.read(frames * self.info.channels * self.info.sample_width)
+
+    def __iter__(self):
+        info = self.info
+        while buf := self.read_raw(self.block_frames):
+            samples = _from_pcm_bytes(buf, info.channels, info.sample_width)
+            samples = to_float(Audio(samples, info.frame_rate, info.sample_width))
+            if self.downmix and samples.shape[1] > 1:
+                samples = samples.mean(axis=1, keepdims=True)
+            yield samples
+
+    def close(self):
+        if self._wave is not None:
+            self._wave.close()
+            self._wave = None
+        if self._process is not None:
+            process = self._process
+            self._process = None
+            error = process.stderr.read()
+            process.stdout.close()
+            process.stderr.close()
+            if process.wait() != 0 and not process.returncode < 0:
+                raise FfmpegError(f'ffmpeg failed ({process.returncode}). {error.decode(errors="replace").strip()}'.strip())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # ffmpeg is still writing when the caller stops early
+            if self._process is not None:
+                self._process.kill()
+            try:
+                self.close()
+            except FfmpegError:
+                pass
+
+
+RESAMPLE_ZEROS = 16             # zero crossings of the sinc on each side, at the lower rate
+RESAMPLE_PHASES = 1024          # filter phases at most, finer positions are rounded down as swresample
+RESAMPLE_CUTOFF = 0.97          # of the lower Nyquist frequency
+
+
+class StreamResampler:
+    """
+    Polyphase windowed-sinc (Blackman) resampling of consecutive float blocks (frames, channels),
+    continuous across the block boundaries. The filter cuts off below the lower Nyquist frequency,
+    so a down-sampling does not alias. The output is delayed by the filter, flush() returns the
+    rest at the end of the stream, ceil(input frames * samrate / frame_rate) frames in total.
+    """
+    def __init__(self, frame_rate, samrate):
+        g = math.gcd(frame_rate, samrate)
+        self.up = samrate // g          # output frames per self.down input frames
+        self.down = frame_rate // g
+        ratio = min(1.0, self.up / self.down)
+        self.half = math.ceil(RESAMPLE_ZEROS / ratio)
+        self.phases = min(self.up, RESAMPLE_PHASES)
+
+        # table[q, i] : weight of the input frame i - half + 1 frames from the output position
+        # which is q / phases frames past an input frame
+        d = np.arange(1 - self.half, self.half + 1)[np.newaxis, :] - np.arange(self.phases)[:, np.newaxis] / self.phases
+        cutoff = ratio * RESAMPLE_CUTOFF
+        x = np.clip(d / self.half, -1.0, 1.0)
+        window = 0.42 + 0.5 * np.cos(np.pi * x) + 0.08 * np.cos(2 * np.pi * x)
+        table = cutoff * np.sinc(cutoff * d) * window
+        self.table = (table / table.sum(axis=1, keepdims=True)).astype(np.float32)
+
+        self.buffer = None
+        self.start = 1 - self.half      # input frame of buffer[0], zeros before the first frame
+        self.produced = 0               # output frames
+        self.consumed = 0               # input frames
+
+    def _output(self, count):
+        n = np.arange(self.produced, self.produced + count, dtype=np.int64)
+        k = n * self.down // self.up
+        q = (n * self.down % self.up) * self.phases // self.up if self.phases < self.up else n * self.down % self.up
+        k = k - self.half + 1 - self.start
+        out = np.zeros((count, self.buffer.shape[1]), dtype=np.float32)
+        if self.phases == self.up:
+            # the outputs r, r + up, ... have the same phase and start down input frames apart
+            from numpy.lib.stride_tricks import sliding_window_view
+
+            windows = sliding_window_view(self.buffer, 2 * self.half, axis=0)
+            for r in range(min(self.up, count)):
+                rows = out[r::self.up]
+                rows[:] = windows[k[r]::self.down][:len(rows)] @ self.table[q[r]]
+        else:
+            for i in range(2 * self.half):
+                out += self.table[q, i][:, np.newaxis] * self.buffer[k + i]
+        self.produced += count
+        # the frames before the next output are not needed any more
+        drop = self.produced * self.down // self.up - self.half + 1 - self.start
+        self.buffer = self.buffer[drop:]
+        self.start += drop
+        return out
+
+    def process(self, samples):
+        if self.buffer is None:
+            self.buffer = np.zeros((self.half - 1, samples.shape[1]), dtype=np.float32)
+        self.buffer = np.concatenate([self.buffer, samples.astype(np.float32, copy=False)])
+        self.consumed += len(samples)
+        # an output needs the input frames up to half after its position
+        last = self.start + len(self.buffer) - 1 - self.half
+        count = ((last + 1) * self.up - 1) // self.down + 1 - self.produced if last >= 0 else 0
+        return self._output(max(0, count))
+
+    def flush(self):
+        """
+        Output frames of the end of the stream
+        """
+        if self.buffer is None:
+            return np.zeros((0, 1), dtype=np.float32)
+        total = (self.consumed * self.up + self.down - 1) // self.down
+        self.buffer = np.concatenate([self.buffer, np.zeros((self.half + 1, self.buffer.shape[1]), dtype=np.float32)])
+        return self._output(total - self.produced)
+
+
+def stft_power(blocks, frame, hop):
+    """
+    Power spectra (frames, frame // 2 + 1) of the STFT with Hann window, for each block of
+    monaural float samples. The STFT frames continue across the block boundaries.
+    """
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    window = np.hanning(frame).astype(np.float32)
+    carry = np.zeros(0, dtype=np.float32)
+    for block in blocks:
+        buf = np.concatenate([carry, block[:, 0]])
+        n = (len(buf) - frame) // hop + 1 if len(buf) >= frame else 0
+        if n > 0:
+            frames = sliding_window_view(buf, frame)[::hop][:n]
+            spectrum = np.fft.rfft(frames * window, axis=1)
+            yield (spectrum.real ** 2 + spectrum.imag ** 2).astype(np.float32)
+        carry = buf[n * hop:]
+
+
+# 
+# In-memory operations, each returns a new Audio
+# 
+
+def change_volume(audio, dB):
+    audio = load(audio)
+    return from_float(to_float(audio) * np.float32(10 ** (dB / 20)), audio.frame_rate, audio.sample_width)
+
+
+def change_channels(audio, ch):
+    audio = load(audio)
+    if ch not in (1, 2):
+        raise ParameterError('Channel must be 1 (monaural) or 2 (stereo).')
+    if audio.channels == ch:
+        raise ParameterError('Source file is already monaural.' if ch == 1 else 'Source file is already stereo.')
+
+    samples = to_float(audio)
+    if ch == 1:
+        samples = samples.mean(axis=1, keepdims=True)
+    else:
+        samples = np.repeat(samples[:, :1], 2, axis=1)
+    return from_float(samples, audio.frame_rate, audio.sample_width)
+
+
+def clip_range(length, start, end, name='source'):
+    """
+    Resolve the clip range by msec, None means the beginning / the end, negative value means from the end
+    """
+    # start time check
+    if start is None:   start = 0
+    if start < 0:       start = length + start
+    # end time check
+    if end is None:     end = length
+    if end < 0:         end = length + end
+
+    # time range check
+    if start < 0 or start > length:
+        raise ParameterError(f'Start time is out of range.\nLength of {name}: {length} msec')
+    if end < 0 or end > length:
+        raise ParameterError(f'End time is out of range.\nLength of {name}: {length} msec')
+    if start >= end:
+        raise ParameterError(f'Start time is later than end time.\nLength of {name}: {length} msec')
+    if start == 0 and end == length:
+        raise ParameterError('Clip size is the same as original length.')
+
+    return start, end
+
+
+def clip(audio, start=None, end=None):
+    audio = load(audio)
+    start, end = clip_range(audio.duration_ms, start, end)
+    first = round(start * audio.frame_rate / 1000)
+    last = round(end * audio.frame_rate / 1000)
+    return Audio(audio.samples[first:last].copy(), audio.frame_rate, audio.sample_width)
+
+
+def join(audio_1, audio_2):
+    audio_1 = load(audio_1)
+    audio_2 = load(audio_2)
+    if (audio_1.channels, audio_1.frame_rate, audio_1.sample_width) != (audio_2.channels, audio_2.frame_rate, audio_2.sample_width):
+        raise FormatError('Source 1 and source 2 are not same channels, sampling rate and sample width.')
+    return Audio(np.concatenate([audio_1.samples, audio_2.samples]), audio_1.frame_rate, audio_1.sample_width)
+
+
+def resample(samples, frame_rate, samrate):
+    """
+    Windowed-sinc resampling of float samples (frames, channels) by StreamResampler
+    """
+    new_frames = round(samples.shape[0] * samrate / frame_rate)
+    resampler = StreamResampler(frame_rate, samrate)
+    return np.concatenate([resampler.process(samples), resampler.flush()])[:new_frames]
+
+
+def change_samrate(audio, samrate):
+    audio = load(audio)
+    if samrate <= 0:
+        raise ParameterError('Sampling rate must be positive.')
+    if audio.frame_rate == samrate:
+        raise ParameterError('Source file is already the same sampling rate.')
+    return from_float(resample(to_float(audio), audio.frame_rate, samrate), samrate, audio.sample_width)
+
+
+# 
+# File operations
+# 
+
+def check_source(source_file, name='Source file'):
+    if not os.path.exists(source_file):
+        raise SourceNotFoundError(f'{name} does not exist.')
+
+
+def check_destination(destination_file, overwrite=False):
+    if not overwrite and output_exists(destination_file):
+        raise DestinationExistsError('Destination file already exists.')
+
+
+def check_same_format(source_file, destination_file):
+    """
+    Both files must be mp3 or wav, and the same format
+    """
+    src_ext = _check_format(_extension(source_file), 'source file')
+    dst_ext = _check_format(_extension(destination_file), 'destination file')
+    if src_ext != dst_ext:
+        raise FormatError('Source file and destination file are different format.')
+    return src_ext
+
+
+# 
+# Atomic output
+# 
+
+FSYNC_POLICIES = ('always', 'batch', 'never')
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _fsync_file(path):
+    with open(path, 'rb+') as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_directory(directory):
+    # the rename is durable when the directory is synced, not possible on Windows
+    if os.name != 'posix':
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _default_mode():
+    # mkstemp creates the file as 0600, the outputs get the usual permission
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+class OutputCommitter:
+    """
+    Renames the temporary output files to the destinations by the fsync policy
+      always : fsync each output and its directory around the rename
+      batch  : keep the outputs as temporary files, and fsync and rename them every batch_size
+               outputs and at flush(). A crash loses the outputs of the last batch,
+               but never leaves a partial destination file.
+      never  : rename at once without fsync, safe against a killed process but not a power loss
+    """
+    def __init__(self, policy='always', batch_size=64):
+        if policy not in FSYNC_POLICIES:
+            raise ParameterError(f'Invalid fsync policy: {policy}')
+        if batch_size < 1:
+            raise ParameterError('Batch size must be positive.')
+        self.policy = policy
+        self.batch_size = batch_size
+        self.pending = {}           # destination -> (temporary file, overwrite)
+        self.lock = threading.Lock()
+
+    def commit(self, temp_file, destination_file, overwrite=False):
+        destination_file = os.path.abspath(destination_file)
+        if os.path.exists(destination_file):
+            os.chmod(temp_file, os.stat(destination_file).st_mode & 0o7777)
+        else:
+            os.chmod(temp_file, _default_mode())
+
+        if self.policy != 'batch':
+            if self.policy == 'always':
+                _fsync_file(temp_file)
+            self._rename(temp_file, destination_file, overwrite)
+            if self.policy == 'always':
+                _fsync_directory(os.path.dirname(destination_file))
+            return
+
+        with self.lock:
+            if destination_file in self.pending and not overwrite:
+                _remove_quietly(temp_file)
+                raise DestinationExistsError('Destination file already exists.')
+            if destination_file in self.pending:
+                _remove_quietly(self.pending[destination_file][0])
+            self.pending[destination_file] = (temp_file, overwrite)
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Commit the pending outputs of the batch policy
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+
+        for temp_file, _ in pending.values():
+            _fsync_file(temp_file)
+        error = None
+        for destination_file, (temp_file, overwrite) in pending.items():
+            try:
+                self._rename(temp_file, destination_file, overwrite)
+            except SoundFileError as e:
+                error = error or e
+        for directory in {os.path.dirname(destination_file) for destination_file in pending}:
+            _fsync_directory(directory)
+        if error is not None:
+            raise error
+
+    def exists(self, destination_file):
+        """
+        Whether the output exists, or is pending by the batch policy
+        """
+        with self.lock:
+            if os.path.abspath(destination_file) in self.pending:
+                return True
+        return os.path.exists(destination_file)
+
+    def size(self, destination_file):
+        """
+        Size of the output, which may be pending
+        """
+        with self.lock:
+            entry = self.pending.get(os.path.abspath(destination_file))
+        return os.path.getsize(entry[0] if entry else destination_file)
+
+    @staticmethod
+    def _rename(temp_file, destination_file, overwrite):
+        if overwrite:
+            os.replace(temp_file, destination_file)
+            return
+
+        # a hard link does not replace a file created after check_destination
+        try:
+            os.link(temp_file, destination_file)
+        except FileExistsError:
+            _remove_quietly(temp_file)
+            raise DestinationExistsError('Destination file already exists.') from None
+        except OSError:
+            # no hard links on the file system (FAT, some network file systems)
+            if os.path.exists(destination_file):
+                _remove_quietly(temp_file)
+                raise DestinationExistsError('Destination file already exists.') from None
+            os.replace(temp_file, destination_file)
+            return
+        os.remove(temp_file)
+
+
+_committer = OutputCommitter()
+
+
+def set_fsync_policy(policy='always', batch_size=64):
+    """
+    fsync policy of the outputs, the pending outputs of the old policy are committed
+    """
+    global _committer
+    committer = OutputCommitter(policy, batch_size)
+    _committer.flush()
+    _committer = committer
+
+
+def flush_outputs():
+    """
+    Commit the pending outputs, call this at the end of a batch with the batch policy
+    """
+    _committer.flush()
+
+
+def output_exists(destination_file):
+    """
+    Whether destination_file exists, or is an output pending by the batch fsync policy
+    """
+    return _committer.exists(destination_file)
+
+
+@contextmanager
+def atomic_output(destination_file, overwrite=False):
+    """
+    Path of a temporary file in the directory of destination_file to write the output to.
+    It is committed to destination_file when the block succeeds, and removed when the block fails.
+    """
+    check_destination(destination_file, overwrite)
+    directory, name = os.path.split(os.path.abspath(destination_file))
+    stem, ext = os.path.splitext(name)
+    # the extension is kept for ffmpeg, which chooses the format by it
+    fd, temp_file = tempfile.mkstemp(prefix=f'.{stem}.', suffix=f'.tmp{ext}', dir=directory)
+    os.close(fd)
+    try:
+        yield temp_file
+    except BaseException:
+        _remove_quietly(temp_file)
+        raise
+    _committer.commit(temp_file, destination_file, overwrite)
+
+
+def _result(operation, sources, destination_file):
+    return FileResult(operation, tuple(sources), destination_file, _committer.size(destination_file))
+
+
+def convert_file(source_file, destination_file, overwrite=False, jobs=None, segment_sec=None, resume=False):
+    """
+    jobs : encode wav to mp3 by the parallel segments, see parallel_mp3
+    segment_sec : process by resumable segments of segment_sec (None or 0 never), see resumable
+    resume : resume an interrupted segmented run, by segments of the default length without segment_sec
+    """
+    check_source(source_file)
+    check_destination(destination_file, overwrite)
+
+    # File format check
+    src_ext = _extension(source_file)
+    dst_ext = _extension(destination_file)
+    if src_ext == dst_ext:
+        raise FormatError('Source file and destination file are the same format.')
+    _check_format(src_ext, 'source file')
+    _check_format(dst_ext, 'destination file')
+
+    import resumable
+    if resumable.applies('conv', source_file, destination_file, segment_sec, resume):
+        if src_ext == '.wav':
+            resumable.encode(source_file, destination_file, overwrite, jobs, segment_sec, resume)
+        else:
+            resumable.decode(source_file, destination_file, overwrite, segment_sec, resume)
+        return _result('conv', [source_file], destination_file)
+
+    with atomic_output(destination_file, overwrite) as temp_file:
+        if src_ext == '.wav' and jobs is not None and jobs > 1:
+            import parallel_mp3
+            parallel_mp3.encode(source_file, temp_file, jobs)
+        elif src_ext == '.mp3':
+            run_ffmpeg(['-i', source_file, '-acodec', 'pcm_s16le', temp_file])
+        else:
+            run_ffmpeg(['-i', source_file, temp_file])
+    return _result('conv', [source_file], destination_file)
+
+
+def change_volume_file(source_file, destination_file, dB, overwrite=False):
+    check_source(source_file)
+    check_destination(destination_file, overwrite)
+    check_same_format(source_file, destination_file)
+
+    with atomic_output(destination_file, overwrite) as temp_file:
+        run_ffmpeg(['-i', source_file, '-af', f'volume={dB}dB', temp_file])
+    return _result('vol', [source_file], destination_file)
+
+
+def change_channels_file(source_file, destination_file, ch, overwrite=False):
+    check_source(source_file)
+    check_destination(destination_file, overwrite)
+    check_same_format(source_file, destination_file)
+
+    c = _header_info(source_file).channels
+    if ch == 1 and c == 1:
+        raise ParameterError('Source file is already monaural.')
+    if ch == 2 and c == 2:
+        raise ParameterError('Source file is already stereo.')
+
+    with atomic_output(destination_file, overwrite) as temp_file:
+        run_ffmpeg(['-i', source_file, '-ac', str(ch), temp_file])
+    return _result('channel', [source_file], destination_file)
+
+
+def remove_chunks_file(source_file, destination_file, overwrite=False):
+    check_source(source_file)
+    check_destination(destination_file, overwrite)
+    if _extension(source_file) != '.wav':
+        raise FormatError('Invalid source file format.')
+    if _extension(destination_file) != '.wav':
+        raise FormatError('Invalid destination file format.')
+
+    # wave module writes the fmt and data chunks only
+    with atomic_output(destination_file, overwrite) as temp_file:
+        try:
+            with wave.open(source_file, 'rb') as s, wave.open(temp_file, 'wb') as d:
+                d.setparams(s.getparams())
+                # streamed copy by blocks, the header is patched when closed
+                block_frames = copy_block_frames(s.getnchannels() * s.getsampwidth())
+                while buf := s.readframes(block_frames):
+                    d.writeframesraw(buf)
+        except _WAV_ERRORS as e:
+            raise FormatError(f'Invalid wav data. {e}') from None
+    return _result('chunk', [source_file], destination_file)
+
+
+def get_length(target_file):
+    """
+    Time length by msec
+    """
+    return probe(target_file).duration_ms
+
+
+def clip_file(source_file, destination_file, start=None, end=None, overwrite=False):
+    check_source(source_file)
+    check_destination(destination_file, overwrite)
+    check_same_format(source_file, destination_file)
+
+    length = get_length(source_file)
+    start, end = clip_range(length, start, end, source_file)
+
+    with atomic_output(destination_file, overwrite) as temp_file:
+        run_ffmpeg(['-i', source_file, '-ss', str(start / 1000), '-to', str(end / 1000), temp_file])
+    return _result('clip', [source_file], destination_file)
+
+
+def join_files(source_file_1, source_file_2, destination_file, overwrite=False):
+    check_source(source_file_1, 'Source file 1')
+    check_source(source_file_2, 'Source file 2')
+    check_destination(destination_file, overwrite)
+
+    # File format check
+    src1_ext = _check_format(_extension(source_file_1), 'source file 1')
+    src2_ext = _check_format(_extension(source_file_2), 'source file 2')
+    dst_ext = _check_format(_extension(destination_file), 'destination file')
+    if not (src1_ext == src2_ext == dst_ext):
+        raise FormatError('Source file 1, source file 2, and destination file are not same format.')
+
+    with atomic_output(destination_file, overwrite) as temp_file:
+        run_ffmpeg(['-i', source_file_1, '-i', source_file_2, '-filter_complex', 'concat=n=2:v=0:a=1', temp_file])
+    return _result('join', [source_file_1, source_file_2], destination_file)
+
+
+def change_samrate_file(source_file, destination_file, samrate, overwrite=False, segment_sec=None, resume=False):
+    """
+    segment_sec : process by resumable segments of segment_sec (None or 0 never), see resumable
+    resume : resume an interrupted segmented run, by segments of the default length without segment_sec
+    """
+    check_source(source_file)
+    check_destination(destination_file, overwrite)
+    check_same_format(source_file, destination_file)
+
+    if _header_info(source_file).frame_rate == samrate:
+        raise ParameterError('Source file is already the same sampling rate.')
+
+    import resumable
+    if resumable.applies('samrate', source_file, destination_file, segment_sec, resume):
+        resumable.change_samrate(source_file, destination_file, samrate, overwrite, segment_sec, resume)
+        return _result('samrate', [source_file], destination_file)
+
+    with atomic_output(destination_file, overwrite) as temp_file:
+        run_ffmpeg(['-i', source_file, '-ar', str(samrate), temp_file])
+    return _result('samrate', [source_file], destination_file)
@@ -3,19 +3,33 @@
 # 
 
 import argparse
+import json
 import os
-import subprocess
+import shlex
+import signal
+import sqlite3
 import sys
 import textwrap
-import wave
+import threading
+import time
 from argparse import ArgumentParser
 from argparse import _SubParsersAction as SubParsersAction  # type: ignore
 
-import matplotlib.pyplot as plt
 import numpy as np
-from pydub import AudioSegment
 
+import batch
+import chunk_index
+import fingerprint
+import mix
+import parallel_mp3
+import pipeline
+import sound_api
+import spectrogram
+import tags
+import verify
+import watch
 from remove_chunk import remove_chunk
+from sound_api import ParameterError, SoundFileError
 
 
 def color_red():
@@ -53,6 +67,31 @@ def sub_command_parser_conv(subparsers: SubParsersAction, parent_parser_0: Argum
         help=textwrap.dedent(help).strip(),
     )
 
+    help = """
+        Encode wav to mp3 by parallel segments on jobs processes.
+        If jobs is omitted, the number of CPUs is used.
+        The bit reservoir of the encoder is disabled to join the segments.
+    """
+    parser_convert.add_argument('--jobs', '-j', type=int, metavar='jobs', nargs='?', const=os.cpu_count(), help=textwrap.dedent(help).strip())
+
+    help = """
+        After the parallel encoding, encode serially too with the same settings and compare the decoded sounds.
+        The cost of the disabled bit reservoir is reported separately. Needs --jobs 2 or more.
+    """
+    parser_convert.add_argument('--check-serial', action='store_true', help=textwrap.dedent(help).strip())
+
+    help = """
+        Process by segments of sec seconds with a checkpoint after each segment.
+        wav to mp3 and mp3 to wav. By default the file is processed in one run.
+    """
+    parser_convert.add_argument('--segment', type=float, metavar='sec', help=textwrap.dedent(help).strip())
+
+    help = """
+        Resume an interrupted segmented job from its last completed segment,
+        by segments of 600 seconds without --segment.
+    """
+    parser_convert.add_argument('--resume', action='store_true', help=textwrap.dedent(help).strip())
+
 
 def sub_command_parser_vol(subparsers: SubParsersAction, parent_parser_0: ArgumentParser, parent_parser_2: ArgumentParser):
     """
@@ -233,6 +272,18 @@ def sub_command_parser_samrate(subparsers: SubParsersAction, parent_parser_0: Ar
     """
     parser_samrate.add_argument('--samrate', '-sr', type=int, metavar='sampling rate', required=True, help=textwrap.dedent(help).strip())
 
+    help = """
+        Process by segments of sec seconds with a checkpoint after each segment.
+        wav files only. By default the file is processed in one run.
+    """
+    parser_samrate.add_argument('--segment', type=float, metavar='sec', help=textwrap.dedent(help).strip())
+
+    help = """
+        Resume an interrupted segmented job from its last completed segment,
+        by segments of 600 seconds without --segment.
+    """
+    parser_samrate.add_argument('--resume', action='store_true', help=textwrap.dedent(help).strip())
+
 
 def sub_command_parser_graph(subparsers: SubParsersAction, parent_parser_0: ArgumentParser, parent_parser_1: ArgumentParser):
     """
@@ -255,7 +306,504 @@ def sub_command_parser_graph(subparsers: SubParsersAction, parent_parser_0: Argu
     )
 
 
-def arguments_parser(argv=None):
+def sub_command_parser_fingerprint(subparsers: SubParsersAction, parent_parser_0: ArgumentParser):
+    """
+    sub command parser : fingerprint
+    """
+    description = """
+        Compute the audio fingerprints of sound files and store them in the index.
+        Only new or changed files are processed, in parallel.
+    """
+    help = """
+        The 'fingerprint' sub-command will compute the audio fingerprints of sound files and store them in the index.
+        Only new or changed files are processed.
+    """
+    parser_fingerprint = subparsers.add_parser('fingerprint',
+        formatter_class=CustomHelpFormatter,
+        add_help=False,
+        parents=[parent_parser_0],
+        description=textwrap.dedent(description).strip(),
+        help=textwrap.dedent(help).strip(),
+    )
+
+    help = """
+        Specify the sound files or directories to process.
+        Directories are searched for wav and mp3 files recursively.
+    """
+    parser_fingerprint.add_argument('targets', type=str, nargs='+', metavar='target', help=textwrap.dedent(help).strip())
+
+    help = f"""
+        Specify the index file (SQLite).
+        Default is '{fingerprint.DEFAULT_INDEX}'.
+    """
+    parser_fingerprint.add_argument('--index', type=str, metavar='index-file', default=fingerprint.DEFAULT_INDEX, help=textwrap.dedent(help).strip())
+
+    help = """
+        Number of worker processes.
+        Default is the number of CPUs.
+    """
+    parser_fingerprint.add_argument('--jobs', '-j', type=int, metavar='jobs', help=textwrap.dedent(help).strip())
+
+
+def sub_command_parser_dedupe(subparsers: SubParsersAction, parent_parser_0: ArgumentParser):
+    """
+    sub command parser : dedupe
+    """
+    description = """
+        Find near-duplicate sound files in the fingerprint index.
+        Run the 'fingerprint' sub-command to build the index first.
+    """
+    help = """
+        The 'dedupe' sub-command will find near-duplicate sound files in the fingerprint index.
+    """
+    parser_dedupe = subparsers.add_parser('dedupe',
+        formatter_class=CustomHelpFormatter,
+        add_help=False,
+        parents=[parent_parser_0],
+        description=textwrap.dedent(description).strip(),
+        help=textwrap.dedent(help).strip(),
+    )
+
+    help = f"""
+        Specify the index file (SQLite).
+        Default is '{fingerprint.DEFAULT_INDEX}'.
+    """
+    parser_dedupe.add_argument('--index', type=str, metavar='index-file', default=fingerprint.DEFAULT_INDEX, help=textwrap.dedent(help).strip())
+
+    help = """
+        Minimum similarity (1 - bit error rate of the fingerprints) of duplicates.
+        Different sounds are around 0.5. Default is 0.65.
+    """
+    parser_dedupe.add_argument('--threshold', type=float, metavar='similarity', default=0.65, help=textwrap.dedent(help).strip())
+
+    help = """
+        Minimum ratio of the overlapped part to the longer file.
+        Default is 0.8, smaller value also finds clipped parts.
+    """
+    parser_dedupe.add_argument('--min-coverage', type=float, metavar='ratio', default=0.8, help=textwrap.dedent(help).strip())
+
+
+def sub_command_parser_spectrogram(subparsers: SubParsersAction, parent_parser_0: ArgumentParser):
+    """
+    sub command parser : spectrogram
+    """
+    description = """
+        Render the spectrogram of sound files to image (png) or NumPy (npy) files without display.
+        The STFT is computed in streamed blocks, the memory use is proportional to the output size.
+        The output file name is '<source file name>_spectrogram.png' (or .npy).
+    """
+    help = """
+        The 'spectrogram' sub-command will render the spectrogram of sound files to image or NumPy files.
+    """
+    parser_spectrogram = subparsers.add_parser('spectrogram',
+        formatter_class=CustomHelpFormatter,
+        add_help=False,
+        parents=[parent_parser_0],
+        description=textwrap.dedent(description).strip(),
+        help=textwrap.dedent(help).strip(),
+    )
+
+    help = """
+        Specify the sound files or directories to process.
+        Directories are searched for wav and mp3 files recursively.
+    """
+    parser_spectrogram.add_argument('targets', type=str, nargs='+', metavar='target', help=textwrap.dedent(help).strip())
+
+    help = """
+        Overwrite destination file if the file exists.
+    """
+    parser_spectrogram.add_argument('--overwrite', action='store_true', help=textwrap.dedent(help).strip())
+
+    help = """
+        Specify the directory to save.
+        If not specified, the files are saved to the directory of each source file.
+    """
+    parser_spectrogram.add_argument('--output-dir', '-o', type=str, metavar='directory', help=textwrap.dedent(help).strip())
+
+    help = """
+        Output format, png or npy. Default is png.
+    """
+    parser_spectrogram.add_argument('--format', type=str, metavar='format', choices=['png', 'npy'], default='png', help=textwrap.dedent(help).strip())
+
+    help = """
+        Width (time) of the output in pixels. Default is 1024.
+    """
+    parser_spectrogram.add_argument('--width', type=int, metavar='pixels', default=1024, help=textwrap.dedent(help).strip())
+
+    help = """
+        Height (frequency) of the output in pixels. Default is 256.
+    """
+    parser_spectrogram.add_argument('--height', type=int, metavar='pixels', default=256, help=textwrap.dedent(help).strip())
+
+    help = """
+        Frequency scale, mel, log or linear. Default is mel.
+    """
+    parser_spectrogram.add_argument('--scale', type=str, metavar='scale', choices=spectrogram.SCALES, default='mel', help=textwrap.dedent(help).strip())
+
+    help = """
+        FFT size in samples, the hop size is 1/4 of it. Default is 2048.
+    """
+    parser_spectrogram.add_argument('--fft', type=int, metavar='size', default=2048, help=textwrap.dedent(help).strip())
+
+    help = """
+        Number of worker processes.
+        Default is the number of CPUs.
+    """
+    parser_spectrogram.add_argument('--jobs', '-j', type=int, metavar='jobs', help=textwrap.dedent(help).strip())
+
+
+def sub_command_parser_inspect(subparsers: SubParsersAction, parent_parser_0: ArgumentParser):
+    """
+    sub command parser : inspect
+    """
+    description = """
+        Print the chunks (id, offset, size) of wav files as JSON lines, one line per file.
+        Only the chunk headers are read, the audio data is not.
+        Odd chunks without padding byte, extensible fmt, fact chunk, RF64 and trailing junk
+        are reported in the 'issues' of the line instead of an error.
+    """
+    help = """
+        The 'inspect' sub-command will print the chunks of wav files as JSON lines.
+    """
+    parser_inspect = subparsers.add_parser('inspect',
+        formatter_class=CustomHelpFormatter,
+        add_help=False,
+        parents=[parent_parser_0],
+        description=textwrap.dedent(description).strip(),
+        help=textwrap.dedent(help).strip(),
+    )
+
+    help = """
+        Specify the wav files or directories to process.
+        Directories are searched for wav files recursively.
+    """
+    parser_inspect.add_argument('targets', type=str, nargs='+', metavar='target', help=textwrap.dedent(help).strip())
+
+    help = """
+        Number of worker processes.
+        Default is the number of CPUs.
+    """
+    parser_inspect.add_argument('--jobs', '-j', type=int, metavar='jobs', help=textwrap.dedent(help).strip())
+
+
+def sub_command_parser_verify(subparsers: SubParsersAction, parent_parser_0: ArgumentParser):
+    """
+    sub command parser : verify
+    """
+    description = """
+        Verify sound files and print the reports as JSON lines, one line per file.
+        The SHA-256 hash is computed over the decoded PCM in a single streamed pass,
+        so it does not change with the chunks or tags of the file.
+        The frames of mp3 files are checked for broken or truncated frames and the Xing frame count.
+    """
+    help = """
+        The 'verify' sub-command will verify sound files and print the reports as JSON lines.
+    """
+    parser_verify = subparsers.add_parser('verify',
+        formatter_class=CustomHelpFormatter,
+        add_help=False,
+        parents=[parent_parser_0],
+        description=textwrap.dedent(description).strip(),
+        help=textwrap.dedent(help).strip(),
+    )
+
+    help = """
+        Specify the sound files or directories to process.
+        Directories are searched for wav and mp3 files recursively.
+    """
+    parser_verify.add_argument('targets', type=str, nargs='+', metavar='target', help=textwrap.dedent(help).strip())
+
+    help = """
+        Expected number of frames (samples per channel) of each file.
+    """
+    parser_verify.add_argument('--expect-frames', type=int, metavar='frames', help=textwrap.dedent(help).strip())
+
+    help = """
+        Allowed difference from --expect-frames. Default is 0.
+    """
+    parser_verify.add_argument('--tolerance', type=int, metavar='frames', default=0, help=textwrap.dedent(help).strip())
+
+    help = """
+        Specify the reference file, the decoded PCM of each file must be the same as it.
+    """
+    parser_verify.add_argument('--same-as', type=str, metavar='reference-file', help=textwrap.dedent(help).strip())
+
+    help = """
+        Number of worker processes.
+        Default is the number of CPUs.
+    """
+    parser_verify.add_argument('--jobs', '-j', type=int, metavar='jobs', help=textwrap.dedent(help).strip())
+
+
+def sub_command_parser_batch(subparsers: SubParsersAction, parent_parser_0: ArgumentParser):
+    """
+    sub command parser : batch
+    """
+    description = """
+        Run the jobs of the batch file. Each line of the batch file is a sub-command line
+        (conv, vol, channel, chunk, clip, join, samrate, chain) as on the command line,
+        empty lines and lines starting with '#' are ignored.
+        The jobs are sent to the I/O queue (wav to wav operations) or the CPU queue
+        (mp3 encodes / decodes and resampling), each with its own number of workers,
+        and larger files are started first. The utilization of each queue is reported at the end.
+    """
+    help = """
+        The 'batch' sub-command will run the jobs of the batch file across the I/O and CPU queues.
+    """
+    parser_batch = subparsers.add_parser('batch',
+        formatter_class=CustomHelpFormatter,
+        add_help=False,
+        parents=[parent_parser_0],
+        description=textwrap.dedent(description).strip(),
+        help=textwrap.dedent(help).strip(),
+    )
+
+    help = """
+        Specify the batch file.
+    """
+    parser_batch.add_argument('batch_file', type=str, metavar='batch-file', help=textwrap.dedent(help).strip())
+
+    help = """
+        Number of the workers of the CPU queue, and the cores they share.
+        A conv --jobs N job takes N of them. Default is the number of CPUs.
+    """
+    parser_batch.add_argument('--cpu-jobs', type=int, metavar='jobs', help=textwrap.dedent(help).strip())
+
+    help = f"""
+        Number of the workers of the I/O queue. Default is {batch.DEFAULT_IO_JOBS}.
+    """
+    parser_batch.add_argument('--io-jobs', type=int, metavar='jobs', default=batch.DEFAULT_IO_JOBS, help=textwrap.dedent(help).strip())
+
+    help = """
+        Skip the jobs whose destination file exists, to resume an interrupted batch.
+        The outputs are renamed only when complete, so an existing file is a finished job.
+    """
+    parser_batch.add_argument('--skip-existing', action='store_true', help=textwrap.dedent(help).strip())
+
+
+def sub_command_parser_tags(subparsers: SubParsersAction, parent_parser_0: ArgumentParser, parent_parser_1: ArgumentParser):
+    """
+    sub command parser : tags
+    """
+    description = """
+        Read or write the tags of sound file.
+        LIST/INFO and bext chunks of wav file, ID3v2 and ID3v1 tags of mp3 file.
+        Without --set and --delete, the tags are printed.
+        The tags are edited in place if they fit in the old tags or in any padding chunk,
+        otherwise they are appended after the audio data, the old tags become padding.
+        Names are title, artist, album, comment, date, genre, track, copyright, software, engineer,
+        bext.<field> for wav file, and raw ids (INAM, TIT2, ...).
+    """
+    help = """
+        The 'tags' sub-command will read or write the tags of sound file.
+    """
+    parser_tags = subparsers.add_parser('tags',
+        formatter_class=CustomHelpFormatter,
+        add_help=False,
+        parents=[parent_parser_0, parent_parser_1],
+        description=textwrap.dedent(description).strip(),
+        help=textwrap.dedent(help).strip(),
+    )
+
+    help = """
+        Set the tag. It can be specified multiple times.
+    """
+    parser_tags.add_argument('--set', type=str, action='append', metavar='name=value', help=textwrap.dedent(help).strip())
+
+    help = """
+        Delete the tag. It can be specified multiple times.
+    """
+    parser_tags.add_argument('--delete', type=str, action='append', metavar='name', help=textwrap.dedent(help).strip())
+
+    help = """
+        Add ID3v1 tag to mp3 file. The existing ID3v1 tag is always updated.
+    """
+    parser_tags.add_argument('--id3v1', action='store_true', help=textwrap.dedent(help).strip())
+
+
+def sub_command_parser_chain(subparsers: SubParsersAction, parent_parser_0: ArgumentParser, parent_parser_2: ArgumentParser):
+    """
+    sub command parser : chain
+    """
+    description = """
+        Change volume level, channel and sampling rate in one pass.
+        The decoder, each operation and the encoder run in their own processes, in this order,
+        and the sound is handed over by blocks through shared memory.
+        The sampling rate is changed by a windowed-sinc filter.
+    """
+    help = """
+        The 'chain' sub-command will run the operations on the file, each in its own process.
+    """
+    parser_chain = subparsers.add_parser('chain',
+        formatter_class=CustomHelpFormatter,
+        add_help=False,
+        parents=[parent_parser_0, parent_parser_2],
+        description=textwrap.dedent(description).strip(),
+        help=textwrap.dedent(help).strip(),
+    )
+
+    help = """
+        Change volume level by dB.
+    """
+    parser_chain.add_argument('--dB', '--db', type=float, metavar='dB', help=textwrap.dedent(help).strip())
+
+    help = """
+        Change channel. The value 1 means monaural, and the value 2 means stereo.
+    """
+    parser_chain.add_argument('--ch', type=int, metavar='channel', choices=[1,2], help=textwrap.dedent(help).strip())
+
+    help = """
+        Change sampling rate by Hz.
+    """
+    parser_chain.add_argument('--samrate', '-sr', type=int, metavar='sampling rate', help=textwrap.dedent(help).strip())
+
+    help = """
+        Frames per block handed over between the processes. Default is 16384.
+    """
+    parser_chain.add_argument('--block', type=int, metavar='frames', default=pipeline.BLOCK_FRAMES, help=textwrap.dedent(help).strip())
+
+
+def sub_command_parser_mix(subparsers: SubParsersAction, parent_parser_0: ArgumentParser):
+    """
+    sub command parser : mix
+    """
+    description = """
+        Mix the source files into the destination file, with the gain and the offset of each source.
+        The sources are summed in float32 by blocks, and converted to the channels and the sampling rate
+        of the destination file on the fly. By default the destination file has the most channels
+        of the sources (up to stereo) and the sampling rate of the first source.
+        The mix is the same as the ffmpeg graph of volume, adelay and amix (without normalization),
+        except for the resampling.
+    """
+    help = """
+        The 'mix' sub-command will mix the source files with the gain and the offset of each.
+    """
+    parser_mix = subparsers.add_parser('mix',
+        formatter_class=CustomHelpFormatter,
+        add_help=False,
+        parents=[parent_parser_0],
+        description=textwrap.dedent(description).strip(),
+        help=textwrap.dedent(help).strip(),
+    )
+
+    help = """
+        Overwrite destination file if the file exists.
+    """
+    parser_mix.add_argument('--overwrite', action='store_true', help=textwrap.dedent(help).strip())
+
+    help = """
+        Verify the destination file after the operation : decode it, and print the report as a JSON line.
+    """
+    parser_mix.add_argument('--verify', action='store_true', help=textwrap.dedent(help).strip())
+
+    help = """
+        Gain of a source by dB. Specify it for each source, in the order of the source files.
+        Default is 0 for all.
+    """
+    parser_mix.add_argument('--gain', type=float, action='append', metavar='dB', help=textwrap.dedent(help).strip())
+
+    help = """
+        Start time of a source in the mix by milli-seconds. Specify it for each source,
+        in the order of the source files. Default is 0 for all.
+    """
+    parser_mix.add_argument('--offset', type=int, action='append', metavar='msec', help=textwrap.dedent(help).strip())
+
+    help = """
+        Channel of the mix. The value 1 means monaural, and the value 2 means stereo.
+    """
+    parser_mix.add_argument('--ch', type=int, metavar='channel', choices=[1,2], help=textwrap.dedent(help).strip())
+
+    help = """
+        Sampling rate of the mix by Hz. The sources are resampled by a windowed-sinc filter.
+    """
+    parser_mix.add_argument('--samrate', '-sr', type=int, metavar='sampling rate', help=textwrap.dedent(help).strip())
+
+    help = f"""
+        Soft limit the mix to dBFS, such as -1. The peaks over {mix.KNEE_DB:g} dB below the limit are compressed.
+        Without it, the samples over the full scale are clipped.
+    """
+    parser_mix.add_argument('--limit', type=float, metavar='dBFS', help=textwrap.dedent(help).strip())
+
+    help = f"""
+        After the mix, mix by the ffmpeg graph too and compare the decoded sounds and the times.
+        A mix of sources of the same sampling rate is the same to {mix.MAX_DIFF_LSB} LSB. A resampled mix is not
+        the same to the sample (the resamplers are different), and passes at {mix.MIN_SNR_DB:g} dB SNR or more.
+    """
+    parser_mix.add_argument('--check-ffmpeg', action='store_true', help=textwrap.dedent(help).strip())
+
+    help = """
+        Specify the source file names to mix.
+    """
+    parser_mix.add_argument('source_files', type=str, nargs='+', metavar='source-file', help=textwrap.dedent(help).strip())
+
+    help = """
+        Specify the destination file name to save.
+    """
+    parser_mix.add_argument('destination_file', type=str, metavar='destination-file', help=textwrap.dedent(help).strip())
+
+
+def sub_command_parser_watch(subparsers: SubParsersAction, parent_parser_0: ArgumentParser):
+    """
+    sub command parser : watch
+    """
+    description = """
+        Watch the directory tree and process the new or modified sound files.
+        The changes are detected by inotify (polling on other systems), and a file is processed
+        when it has not changed for the settle time. The --do lines run in order on each file,
+        several files at once. The processed files are kept in the state file, so a restart
+        does not process them again. The outputs of the --do lines and the hidden files are ignored.
+    """
+    help = """
+        The 'watch' sub-command will process the new or modified files of the directory.
+    """
+    parser_watch = subparsers.add_parser('watch',
+        formatter_class=CustomHelpFormatter,
+        add_help=False,
+        parents=[parent_parser_0],
+        description=textwrap.dedent(description).strip(),
+        help=textwrap.dedent(help).strip(),
+    )
+
+    help = """
+        Specify the directory to watch.
+    """
+    parser_watch.add_argument('directory', type=str, metavar='directory', help=textwrap.dedent(help).strip())
+
+    help = """
+        Sub-command line (conv, vol, channel, chunk, clip, samrate, chain) to run on each file.
+        It can be specified multiple times, and the lines run in order. The placeholders are
+        {source} (the file), {prev} (the destination of the previous line, the file for the first line),
+        {dir}, {name}, {stem}, {ext} of the file, and {rel} (the directory of the file relative to the watched directory).
+    """
+    parser_watch.add_argument('--do', type=str, action='append', required=True, metavar='line', help=textwrap.dedent(help).strip())
+
+    help = f"""
+        Specify the state file of the processed files. Default is {watch.DEFAULT_STATE}.
+    """
+    parser_watch.add_argument('--state', type=str, metavar='state-file', default=watch.DEFAULT_STATE, help=textwrap.dedent(help).strip())
+
+    help = """
+        Number of the files processed at once. Default is the number of CPUs.
+    """
+    parser_watch.add_argument('--jobs', '-j', type=int, metavar='jobs', help=textwrap.dedent(help).strip())
+
+    help = f"""
+        Seconds without change before a file is processed. Default is {watch.SETTLE_SEC}.
+    """
+    parser_watch.add_argument('--settle', type=float, metavar='sec', default=watch.SETTLE_SEC, help=textwrap.dedent(help).strip())
+
+    help = """
+        Detect the changes by polling instead of inotify.
+    """
+    parser_watch.add_argument('--poll', action='store_true', help=textwrap.dedent(help).strip())
+
+    help = f"""
+        Seconds between the polls. Default is {watch.POLL_SEC}.
+    """
+    parser_watch.add_argument('--interval', type=float, metavar='sec', default=watch.POLL_SEC, help=textwrap.dedent(help).strip())
+
+
+def create_parser():
     # 
     # parent parser 0 : for help message
     # 
@@ -280,6 +828,12 @@ def arguments_parser(argv=None):
     """
     parent_parser_2.add_argument('--overwrite', action='store_true', help=textwrap.dedent(help).strip())
 
+    help = """
+        Verify the destination file after the operation : decode it, check the frames
+        against the source file(s), and print the report as a JSON line.
+    """
+    parent_parser_2.add_argument('--verify', action='store_true', help=textwrap.dedent(help).strip())
+
     help = """
         Specify the source file name to process.
     """
@@ -299,6 +853,12 @@ def arguments_parser(argv=None):
     """
     parent_parser_3.add_argument('--overwrite', action='store_true', help=textwrap.dedent(help).strip())
 
+    help = """
+        Verify the destination file after the operation : decode it, check the frames
+        against the source file(s), and print the report as a JSON line.
+    """
+    parent_parser_3.add_argument('--verify', action='store_true', help=textwrap.dedent(help).strip())
+
     help = """
         Specify the source file name 1 to process.
     """
@@ -320,6 +880,45 @@ def arguments_parser(argv=None):
     parser = argparse.ArgumentParser(formatter_class=CustomHelpFormatter, add_help=False)
     parser.add_argument('-h', '--help', action='help', help='Show this help message and exit.')
 
+    help = """
+        Print the profiling summary of the job to stderr.
+        Wall time, CPU time, bytes read / written, subprocess count and peak memory per phase.
+        The bytes are of the whole process, with parallel phases (batch, watch) they include the others.
+    """
+    parser.add_argument('--profile', action='store_true', help=textwrap.dedent(help).strip())
+
+    help = """
+        Save the profiling result as Chrome trace-event JSON (chrome://tracing, Perfetto).
+    """
+    parser.add_argument('--trace-json', type=str, metavar='trace-file', help=textwrap.dedent(help).strip())
+
+    help = """
+        Save the cProfile statistics of the job (for pstats, snakeviz, etc.).
+    """
+    parser.add_argument('--cprofile', type=str, metavar='pstats-file', help=textwrap.dedent(help).strip())
+
+    help = """
+        When the output files are flushed to the disk. The outputs are always written to
+        a temporary file and renamed, so a killed job never leaves a partial output file.
+        always : fsync each output (default),
+        batch : fsync and rename the outputs every --fsync-batch files,
+        never : leave it to the OS (not safe against a power loss).
+    """
+    parser.add_argument('--fsync', type=str, metavar='policy', choices=sound_api.FSYNC_POLICIES, default='always', help=textwrap.dedent(help).strip())
+
+    help = """
+        Number of the output files per fsync of the batch policy. Default is 64.
+    """
+    parser.add_argument('--fsync-batch', type=int, metavar='files', default=64, help=textwrap.dedent(help).strip())
+
+    help = """
+        Memory budget of the operations, such as 512M or 2G. The memory of a job is estimated
+        from the header of the source file, and the files which do not fit are streamed by blocks
+        (graph) or rejected. batch runs the large jobs fewer at once within the budget.
+        No limit by default.
+    """
+    parser.add_argument('--max-memory', type=str, metavar='size', help=textwrap.dedent(help).strip())
+
     # 
     # sub parser
     # 
@@ -334,446 +933,149 @@ def arguments_parser(argv=None):
     sub_command_parser_join(subparsers, parent_parser_0, parent_parser_3)
     sub_command_parser_samrate(subparsers, parent_parser_0, parent_parser_2)
     sub_command_parser_graph(subparsers, parent_parser_0, parent_parser_1)
+    sub_command_parser_fingerprint(subparsers, parent_parser_0)
+    sub_command_parser_dedupe(subparsers, parent_parser_0)
+    sub_command_parser_spectrogram(subparsers, parent_parser_0)
+    sub_command_parser_tags(subparsers, parent_parser_0, parent_parser_1)
+    sub_command_parser_inspect(subparsers, parent_parser_0)
+    sub_command_parser_verify(subparsers, parent_parser_0)
+    sub_command_parser_batch(subparsers, parent_parser_0)
+    sub_command_parser_chain(subparsers, parent_parser_0, parent_parser_2)
+    sub_command_parser_watch(subparsers, parent_parser_0)
+    sub_command_parser_mix(subparsers, parent_parser_0)
 
+    return parser
+
+
+def arguments_parser(argv=None):
+    parser = create_parser()
     args = parser.parse_args(argv)
 
     return args
 
 
-def format_converter(source_file, destination_file, overwrite=False):
-    # File exists check
-    if not os.path.exists(source_file):
-        color_red()
-        print('Error: Source file does not exist.', file=sys.stderr)
-        color_normal()
-        return
-    if os.path.exists(destination_file) and not overwrite:
-        color_red()
-        print('Error: Destination file already exists.', file=sys.stderr)
-        color_normal()
-        return
-
-    # File format check
-    _, src_ext = os.path.splitext(source_file)
-    _, dst_ext = os.path.splitext(destination_file)
-    if src_ext == dst_ext:
-        color_red()
-        print('Error: Source file and destination file are the same format.', file=sys.stderr)
-        color_normal()
-        return
-    elif not src_ext == '.mp3' and not src_ext == '.wav':
-        color_red()
-        print('Error: Invalid source file format.', file=sys.stderr)
-        color_normal()
-        return
-    elif not dst_ext == '.wav' and not dst_ext == '.mp3':
-        color_red()
-        print('Error: Invalid destination file format.', file=sys.stderr)
-        color_normal()
-        return
-
-    # File format conversion
-    # AudioSegment.from_file(source_file).export(destination_file, format=dst_ext[1:])
-    if src_ext == '.mp3' and dst_ext == '.wav':
-        command = f'ffmpeg -vn -y -loglevel fatal -i {source_file} -acodec pcm_s16le {destination_file}'
-    elif src_ext == '.wav' and dst_ext == '.mp3':
-        command = f'ffmpeg -vn -y -loglevel fatal -i {source_file} {destination_file}'
-    else:
-        return
-    subprocess.run(command, shell=True)
+def print_error(e):
+    color_red()
+    print(f'Error: {e}', file=sys.stderr)
+    color_normal()
+
+
+def format_converter(source_file, destination_file, overwrite=False, jobs=None, check_serial=False, segment_sec=None, resume=False):
+    try:
+        if check_serial and (jobs is None or jobs < 2 or sound_api._extension(destination_file) != '.mp3'):
+            raise ParameterError('--check-serial needs a wav to mp3 conversion with --jobs 2 or more.')
+        result = sound_api.convert_file(source_file, destination_file, overwrite, jobs, segment_sec, resume)
+        if check_serial:
+            # the output may be pending by the batch fsync policy
+            sound_api.flush_outputs()
+            check = parallel_mp3.check_against_serial(source_file, destination_file)
+            message = (f'{check.parallel_frames:,} samples, SNR {check.parallel_snr:.1f} dB / '
+                       f'serial encode {check.serial_frames:,} samples, SNR {check.serial_snr:.1f} dB / '
+                       f'source {check.source_frames:,} samples\n'
+                       f'Bit reservoir (disabled in both) : serial encode with it SNR {check.reservoir_snr:.1f} dB, '
+                       f'cost {check.reservoir_cost:.1f} dB')
+            if check.ok:
+                print(f'Parallel encode: {message}')
+            else:
+                print_error(f'Parallel encode is worse than serial encode.\n{message}')
+        return result
+    except SoundFileError as e:
+        print_error(e)
 
 
 def volume_changer(source_file, destination_file, dB, overwrite=False):
-    # File exists check
-    if not os.path.exists(source_file):
-        color_red()
-        print('Error: Source file does not exist.', file=sys.stderr)
-        color_normal()
-        return
-    if os.path.exists(destination_file) and not overwrite:
-        color_red()
-        print('Error: Destination file already exists.', file=sys.stderr)
-        color_normal()
-        return
-
-    # File format check
-    _, src_ext = os.path.splitext(source_file)
-    _, dst_ext = os.path.splitext(destination_file)
-    if not src_ext == '.mp3' and not src_ext == '.wav':
-        color_red()
-        print('Error: Invalid source file format.', file=sys.stderr)
-        color_normal()
-        return
-    elif not dst_ext == '.wav' and not dst_ext == '.mp3':
-        color_red()
-        print('Error: Invalid destination file format.', file=sys.stderr)
-        color_normal()
-        return
-
-    if src_ext != dst_ext:
-        color_red()
-        print('Error: Source file and destination file are different format.', file=sys.stderr)
-        color_normal()
-        return
-
-    # Volume level change
-    # sound = AudioSegment.from_file(source_file)
-    # sound += dB
-    # sound.export(destination_file, format=dst_ext[1:])
-    if src_ext == '.mp3' and dst_ext == '.mp3':
-        command = f'ffmpeg -vn -y -loglevel fatal -i {source_file} -af volume={dB}dB {destination_file}'
-    elif src_ext == '.wav' and dst_ext == '.wav':
-        command = f'ffmpeg -vn -y -loglevel fatal -i {source_file} -af volume={dB}dB {destination_file}'
-    else:
-        return
-    subprocess.run(command, shell=True)
+    try:
+        return sound_api.change_volume_file(source_file, destination_file, dB, overwrite)
+    except SoundFileError as e:
+        print_error(e)
 
 
 def channel_changer(source_file, destination_file, ch, overwrite=False):
-    # File exists check
-    if not os.path.exists(source_file):
-        color_red()
-        print('Error: Source file does not exist.', file=sys.stderr)
-        color_normal()
-        return
-    if os.path.exists(destination_file) and not overwrite:
-        color_red()
-        print('Error: Destination file already exists.', file=sys.stderr)
-        color_normal()
-        return
-
-    # File format check
-    _, src_ext = os.path.splitext(source_file)
-    _, dst_ext = os.path.splitext(destination_file)
-    if not src_ext == '.mp3' and not src_ext == '.wav':
-        color_red()
-        print('Error: Invalid source file format.', file=sys.stderr)
-        color_normal()
-        return
-    elif not dst_ext == '.wav' and not dst_ext == '.mp3':
-        color_red()
-        print('Error: Invalid destination file format.', file=sys.stderr)
-        color_normal()
-        return
-
-    if src_ext != dst_ext:
-        color_red()
-        print('Error: Source file and destination file are different format.', file=sys.stderr)
-        color_normal()
-        return
-
-    # Channel change
-    sound = AudioSegment.from_file(source_file)
-    c = sound.channels
-
-    if ch == 1:
-        if c == 1:
-            color_red()
-            print('Error: Source file is already monaural.', file=sys.stderr)
-            color_normal()
-            return
-        # sound = sound.set_channels(1)
-    elif ch == 2:
-        if c == 2:
-            color_red()
-            print('Error: Source file is already stereo.', file=sys.stderr)
-            color_normal()
-            return
-        # sound = sound.set_channels(2)
-
-    # sound.export(destination_file, format=dst_ext[1:])
-    if src_ext == '.mp3' and dst_ext == '.mp3':
-        command = f'ffmpeg -vn -y -loglevel fatal -i {source_file} -ac {ch} {destination_file}'
-    elif src_ext == '.wav' and dst_ext == '.wav':
-        command = f'ffmpeg -vn -y -loglevel fatal -i {source_file} -ac {ch} {destination_file}'
-    else:
-        return
-    subprocess.run(command, shell=True)
+    try:
+        return sound_api.change_channels_file(source_file, destination_file, ch, overwrite)
+    except SoundFileError as e:
+        print_error(e)
 
 
 def chunk_remover(source_file, destination_file, overwrite=False):
-    # File exists check
-    if not os.path.exists(source_file):
-        color_red()
-        print('Error: Source file does not exist.', file=sys.stderr)
-        color_normal()
-        return
-    if os.path.exists(destination_file) and not overwrite:
-        color_red()
-        print('Error: Destination file already exists.', file=sys.stderr)
-        color_normal()
-        return
-
-    # File format check
-    _, src_ext = os.path.splitext(source_file)
-    _, dst_ext = os.path.splitext(destination_file)
-    if not src_ext == '.wav':
-        color_red()
-        print('Error: Invalid source file format.', file=sys.stderr)
-        color_normal()
-        return
-    elif not dst_ext == '.wav':
-        color_red()
-        print('Error: Invalid destination file format.', file=sys.stderr)
-        color_normal()
-        return
-
-    # Chunk remove
-    # remove_chunk(source_file, destination_file)
-    # easier way
-    import wave
-    with wave.open(source_file, 'rb') as s, wave.open(destination_file, 'wb') as d:
-        d.setparams(s.getparams())
-        d.writeframes(s.readframes(s.getnframes()))
+    # remove_chunk(source_file, destination_file) is the hand-written way,
+    # sound_api uses the wave module as the easier way
+    try:
+        return sound_api.remove_chunks_file(source_file, destination_file, overwrite)
+    except SoundFileError as e:
+        print_error(e)
 
 
 def length_getter(target_file):
-    # File exists check
-    if not os.path.exists(target_file):
-        color_red()
-        print('Error: Source file does not exist.', file=sys.stderr)
-        color_normal()
+    try:
+        length = sound_api.get_length(target_file)
+    except SoundFileError as e:
+        print_error(e)
         return
-
-    # get length of source file
-    sound = AudioSegment.from_file(target_file)
-    length = len(sound)
     print(f'Time length of {target_file}: {length:,} msec')
+    return length
 
 
 def clipper(source_file, destination_file, start, end, overwrite=False):
-    # File exists check
-    if not os.path.exists(source_file):
-        color_red()
-        print('Error: Source file does not exist.', file=sys.stderr)
-        color_normal()
-        return
-
-    if os.path.exists(destination_file) and not overwrite:
-        color_red()
-        print('Error: Destination file already exists.', file=sys.stderr)
-        color_normal()
-        return
-
-    # File format check
-    _, src_ext = os.path.splitext(source_file)
-    _, dst_ext = os.path.splitext(destination_file)
-    if not src_ext == '.mp3' and not src_ext == '.wav':
-        color_red()
-        print('Error: Invalid source file format.', file=sys.stderr)
-        color_normal()
-        return
-    elif not dst_ext == '.wav' and not dst_ext == '.mp3':
-        color_red()
-        print('Error: Invalid destination file format.', file=sys.stderr)
-        color_normal()
-        return
-
-    if src_ext != dst_ext:
-        color_red()
-        print('Error: Source file and destination file are different format.', file=sys.stderr)
-        color_normal()
-        return
-
-    # get length of source file
-    sound = AudioSegment.from_file(source_file)
-    length = len(sound)
-
-    # start time check
-    if start is None:   start = 0
-    if start < 0:       start = length + start
-    # end time check
-    if end is None:     end = length
-    if end < 0:         end = length + end
-
-    # time range check
-    if start < 0 or start > length:
-        color_red()
-        print('Error: Start time is out of range.', file=sys.stderr)
-        print(f'Length of {source_file}: {length} msec', file=sys.stderr)
-        color_normal()
-        return
-    if end < 0 or end > length:
-        color_red()
-        print('Error: End time is out of range.', file=sys.stderr)
-        print(f'Length of {source_file}: {length} msec', file=sys.stderr)
-        color_normal()
-        return
-    if start >= end:
-        color_red()
-        print('Error: Start time is later than end time.', file=sys.stderr)
-        print(f'Length of {source_file}: {length} msec', file=sys.stderr)
-        color_normal()
-        return
-    if start == 0 and end == length:
-        color_red()
-        print('Error: Clip size is the same as original length.', file=sys.stderr)
-        color_normal()
-        return
-
-    # Clip
-    # sound = sound[start:end]
-    # sound.export(destination_file, format=dst_ext[1:])
-    start = start / 1000
-    end = end / 1000
-    if src_ext == '.mp3' and dst_ext == '.mp3':
-        command = f'ffmpeg -vn -y -loglevel fatal -i {source_file} -ss {start} -to {end} {destination_file}'
-    elif src_ext == '.wav' and dst_ext == '.wav':
-        command = f'ffmpeg -vn -y -loglevel fatal -i {source_file} -ss {start} -to {end} {destination_file}'
-    else:
-        return
-    subprocess.run(command, shell=True)
+    try:
+        return sound_api.clip_file(source_file, destination_file, start, end, overwrite)
+    except SoundFileError as e:
+        print_error(e)
 
 
 def joiner(source_file_1, source_file_2, destination_file, overwrite=False):
-    # File exists check
-    if not os.path.exists(source_file_1):
-        color_red()
-        print('Error: Source file 1 does not exist.', file=sys.stderr)
-        color_normal()
-        return
-    if not os.path.exists(source_file_2):
-        color_red()
-        print('Error: Source file 2 does not exist.', file=sys.stderr)
-        color_normal()
-        return
-    if os.path.exists(destination_file) and not overwrite:
-        color_red()
-        print('Error: Destination file already exists.', file=sys.stderr)
-        color_normal()
-        return
+    try:
+        return sound_api.join_files(source_file_1, source_file_2, destination_file, overwrite)
+    except SoundFileError as e:
+        print_error(e)
 
-    # File format check
-    _, src1_ext = os.path.splitext(source_file_1)
-    _, src2_ext = os.path.splitext(source_file_2)
-    _, dst_ext = os.path.splitext(destination_file)
-    if not src1_ext == '.wav' and not src1_ext == '.mp3':
-        color_red()
-        print('Error: Invalid source file 1 format.', file=sys.stderr)
-        color_normal()
-        return
-    elif not src2_ext == '.wav' and not src2_ext == '.mp3':
-        color_red()
-        print('Error: Invalid source file 2 format.', file=sys.stderr)
-        color_normal()
-        return
-    elif not dst_ext == '.wav' and not dst_ext == '.mp3':
-        color_red()
-        print('Error: Invalid destination file format.', file=sys.stderr)
-        color_normal()
-        return
 
-    if not (src1_ext == src2_ext and src1_ext == dst_ext and src2_ext == dst_ext):
-        color_red()
-        print('Error: Source file 1, source file 2, and destination file are not same format.', file=sys.stderr)
-        color_normal()
-        return
+def samrate_changer(source_file, destination_file, samrate, overwrite=False, segment_sec=None, resume=False):
+    try:
+        return sound_api.change_samrate_file(source_file, destination_file, samrate, overwrite, segment_sec, resume)
+    except SoundFileError as e:
+        print_error(e)
 
-    # Join
-    # sound1 = AudioSegment.from_file(source_file_1)
-    # sound2 = AudioSegment.from_file(source_file_2)
-    # sound = sound1 + sound2
-    # sound.export(destination_file, format=dst_ext[1:])
-    if src1_ext == '.mp3' and src2_ext == '.mp3' and dst_ext == '.mp3':
-        command = f'ffmpeg -vn -y -loglevel fatal -i {source_file_1} -i {source_file_2} -filter_complex  concat=n=2:v=0:a=1 {destination_file}'
-    elif src1_ext == '.wav' and src2_ext == '.wav' and dst_ext == '.wav':
-        command = f'ffmpeg -vn -y -loglevel fatal -i {source_file_1} -i {source_file_2} -filter_complex  concat=n=2:v=0:a=1 {destination_file}'
-    else:
-        return
-    subprocess.run(command, shell=True)
 
-
-def samrate_changer(source_file, destination_file, samrate, overwrite=False):
-    # File exists check
-    if not os.path.exists(source_file):
-        color_red()
-        print('Error: Source file does not exist.', file=sys.stderr)
-        color_normal()
-        return
-    if os.path.exists(destination_file) and not overwrite:
-        color_red()
-        print('Error: Destination file already exists.', file=sys.stderr)
-        color_normal()
-        return
-
-    # File format check
-    _, src_ext = os.path.splitext(source_file)
-    _, dst_ext = os.path.splitext(destination_file)
-    if not src_ext == '.mp3' and not src_ext == '.wav':
-        color_red()
-        print('Error: Invalid source file format.', file=sys.stderr)
-        color_normal()
-        return
-    elif not dst_ext == '.wav' and not dst_ext == '.mp3':
-        color_red()
-        print('Error: Invalid destination file format.', file=sys.stderr)
-        color_normal()
-        return
-
-    if src_ext != dst_ext:
-        color_red()
-        print('Error: Source file and destination file are different format.', file=sys.stderr)
-        color_normal()
-        return
-
-    # Current sampling rate
-    sound = AudioSegment.from_file(source_file)
-    current_samrate = sound.frame_rate
-
-    if current_samrate == samrate:
-        color_red()
-        print('Error: Source file is already the same sampling rate.', file=sys.stderr)
-        color_normal()
-        return
-
-    # Sampling rate change
-    # sound = sound.set_frame_rate(samrate)
-    # sound.export(destination_file, format=dst_ext[1:])
-    if src_ext == '.mp3' and dst_ext == '.mp3':
-        command = f'ffmpeg -vn -y -loglevel fatal -i {source_file} -ar {samrate} {destination_file}'
-    elif src_ext == '.wav' and dst_ext == '.wav':
-        command = f'ffmpeg -vn -y -loglevel fatal -i {source_file} -ar {samrate} {destination_file}'
+def _plot_channel(ax, t, data, channel):
+    if isinstance(data, tuple):
+        # (lower, upper) envelope
+        ax.fill_between(t, data[0][:, channel], data[1][:, channel])
     else:
-        return
-    subprocess.run(command, shell=True)
+        ax.plot(t, data[:, channel])
 
 
 def graph_drawer(target_file):
-    # File exists check
-    if not os.path.exists(target_file):
-        color_red()
-        print('Error: Source file does not exist.', file=sys.stderr)
-        color_normal()
-        return
-
-    # File format check
-    _, ext = os.path.splitext(target_file)
-    if not ext == '.wav':
-        color_red()
-        print('Error: Invalid source file format.', file=sys.stderr)
-        color_normal()
+    # File exists and format check, and load data
+    try:
+        sound_api.check_source(target_file)
+        _, ext = os.path.splitext(target_file)
+        if not ext == '.wav':
+            raise sound_api.FormatError('Invalid source file format.')
+        if sound_api.fits_in_memory(sound_api.estimate_memory(target_file)):
+            sound = sound_api.load(target_file)
+            # numpy array of (frames, channels)
+            data = sound.samples
+            t = np.arange(0, sound.frames)/sound.frame_rate
+        else:
+            # min / max envelope streamed by blocks, the samples do not fit in the memory budget
+            t, lower, upper = sound_api.waveform_envelope(target_file)
+            data = (lower, upper)
+    except SoundFileError as e:
+        print_error(e)
         return
 
-    # Open and load data
-    wf = wave.open(target_file, 'rb')
-    buf = wf.readframes(wf.getnframes())
-
-    # Transfer from binary data to 16bit integer numpy array
-    data = np.frombuffer(buf, dtype='int16')
+    channels = data[0].shape[1] if isinstance(data, tuple) else data.shape[1]
 
-    samplerate = wf.getframerate()
-
-    if wf.getnchannels() == 2:
-        left  = data[::2]  # Left channel
-        right = data[1::2] # Right channel
-
-        t = np.arange(0, len(left))/samplerate
+    # imported here, the processes of the pipeline import this module and do not need it
+    import matplotlib.pyplot as plt
 
+    if channels == 2:
         fig = plt.figure(f'Waveform : {target_file}')
 
         # Left channel
         axL = fig.add_subplot(2, 1, 1)
-        axL.plot(t, left)
+        _plot_channel(axL, t, data, 0)
         axL.set_title('Left channel')
         axL.set_xlabel('Time(s)')
         axL.set_ylabel('Sound Amplitude')
@@ -781,7 +1083,7 @@ def graph_drawer(target_file):
 
         # Right channel
         axR = fig.add_subplot(2, 1, 2)
-        axR.plot(t, right)
+        _plot_channel(axR, t, data, 1)
         axR.set_title('Right channel')
         axR.set_xlabel('Time(s)')
         axR.set_ylabel('Sound Amplitude')
@@ -791,11 +1093,9 @@ def graph_drawer(target_file):
         plt.show()
 
     else:
-        t = np.arange(0, len(data))/samplerate
-
         fig = plt.figure(f'Waveform : {target_file}')
         ax = fig.add_subplot(1, 1, 1)
-        ax.plot(t, data)
+        _plot_channel(ax, t, data, 0)
         ax.set_title('Waveform')
         ax.set_xlabel('Time(s)')
         ax.set_ylabel('Sound Amplitude')
@@ -805,41 +1105,477 @@ def graph_drawer(target_file):
         plt.show()
 
 
-def main():
-    argv = ['-h']
+def fingerprinter(targets, index_file, jobs=None):
+    def on_error(path, message):
+        print_error(f'{path}: {message}')
 
-    if len(sys.argv) > 1:
-        argv = sys.argv[1:]
-    args = arguments_parser(argv)
-    pass
+    try:
+        processed, skipped, removed = fingerprint.update_index(index_file, targets, jobs, on_error)
+    except (SoundFileError, sqlite3.Error) as e:
+        print_error(e)
+        return
+    print(f'Fingerprinted: {processed:,} files, unchanged: {skipped:,} files, removed: {removed:,} files')
+    return processed
+
+
+def duplicate_finder(index_file, threshold, min_coverage):
+    if not os.path.exists(index_file):
+        print_error('Index file does not exist.')
+        return
+
+    try:
+        duplicates = fingerprint.find_duplicates(index_file, threshold, min_coverage)
+    except sqlite3.Error as e:
+        print_error(e)
+        return
+
+    pairs = {}
+    for d in duplicates:
+        pairs[d.file_1, d.file_2] = d
+        pairs[d.file_2, d.file_1] = d
+
+    groups = fingerprint.group_duplicates(duplicates)
+    for n, group in enumerate(groups, 1):
+        print(f'Group {n}:')
+        first = group[0]
+        print(f'    {first}')
+        for path in group[1:]:
+            d = pairs.get((first, path))
+            note = f'similarity {d.similarity:.3f}, coverage {d.coverage:.2f}' if d else 'via other files'
+            print(f'    {path}  ({note})')
+    print(f'Duplicate groups: {len(groups):,}')
+    return groups
+
+
+def spectrogram_drawer(targets, output_dir, output_format, width, height, scale, n_fft, jobs=None, overwrite=False):
+    results = []
+    try:
+        for result, error in spectrogram.spectrogram_files(targets, output_dir, f'.{output_format}', jobs,
+                width=width, height=height, scale=scale, n_fft=n_fft, overwrite=overwrite):
+            if error is not None:
+                print_error(error)
+                continue
+            print(f'Spectrogram of {result.source}: {result.destination} ({result.width} x {result.height})')
+            results.append(result)
+    except (SoundFileError, OSError) as e:
+        print_error(e)
+    return results
+
+
+def tag_editor(target_file, set_tags=None, delete_tags=None, id3v1=False):
+    changes = {}
+    for item in set_tags or []:
+        name, sep, value = item.partition('=')
+        if not sep or not name:
+            print_error(f'Invalid tag: {item} (name=value is expected)')
+            return
+        changes[name] = value
+    for name in delete_tags or []:
+        changes[name] = None
+
+    try:
+        if changes:
+            modes = tags.write_tags(target_file, changes, id3v1)
+            print(f'Tags of {target_file} are written ({", ".join(modes)}).')
+        result = tags.read_tags(target_file)
+    except (SoundFileError, OSError) as e:
+        print_error(e)
+        return
+
+    if not changes:
+        for name, value in result.items():
+            print(f'{name}: {value}')
+    return result
+
+
+def chunk_inspector(targets, jobs=None):
+    count = 0
+    try:
+        for line in chunk_index.index_files(targets, jobs):
+            print(line)
+            count += 1
+    except OSError as e:
+        print_error(e)
+    return count
+
+
+def file_verifier(targets, expected_frames=None, tolerance=0, reference_file=None, jobs=None):
+    same_as = None
+    if reference_file is not None:
+        try:
+            same_as, _, _ = verify.pcm_digest(reference_file)
+        except SoundFileError as e:
+            print_error(f'{reference_file}: {e}')
+            return
+
+    failed = 0
+    try:
+        for report in verify.verify_files(targets, jobs, expected_frames, tolerance, same_as):
+            print(json.dumps(report))
+            if not report['ok']:
+                failed += 1
+    except OSError as e:
+        print_error(e)
+    if failed:
+        print_error(f'{failed:,} files failed verification.')
+    return failed
+
+
+def output_verifier(result, start=None, end=None):
+    try:
+        # the output may be pending by the batch fsync policy
+        sound_api.flush_outputs()
+        report = verify.verify_result(result, start, end)
+    except SoundFileError as e:
+        print_error(e)
+        return
+    print(json.dumps(report))
+    if not report['ok']:
+        print_error(f'Verification of {result.destination} failed. {" / ".join(report["issues"])}')
+    return report
+
+
+def chain_runner(source_file, destination_file, dB=None, ch=None, samrate=None, overwrite=False, block_frames=pipeline.BLOCK_FRAMES):
+    try:
+        return pipeline.chain_file(source_file, destination_file, dB, ch, samrate, overwrite, block_frames)
+    except SoundFileError as e:
+        print_error(e)
+
+
+def mixer(source_files, destination_file, gains=None, offsets=None, ch=None, samrate=None, limit=None, overwrite=False, check_ffmpeg=False):
+    try:
+        start = time.perf_counter()
+        result = mix.mix_files(source_files, destination_file, gains, offsets, ch, samrate, limit, overwrite)
+        seconds = time.perf_counter() - start
+        if check_ffmpeg:
+            # the output may be pending by the batch fsync policy
+            sound_api.flush_outputs()
+            check = mix.ffmpeg_check(source_files, destination_file, gains, offsets, ch, samrate, limit)
+            message = (f'{check.frames:,} samples, {seconds:.2f} sec / ffmpeg {check.ffmpeg_frames:,} samples, '
+                       f'{check.ffmpeg_seconds:.2f} sec / max difference {check.max_diff} LSB, SNR {check.snr:.1f} dB')
+            if check.resampled:
+                message += f' (different resamplers, {mix.MIN_SNR_DB:g} dB SNR or more)'
+            if check.ok:
+                print(f'Mix: {message}')
+            else:
+                print_error(f'Mix is different from ffmpeg.\n{message}')
+        return result
+    except SoundFileError as e:
+        print_error(e)
+
+
+def batch_job(args, line):
+    """
+    batch.Job of the parsed sub-command line
+    """
+    name = args.sub_command_name
+    params = {'overwrite': args.overwrite}
+    if name == 'conv' and args.jobs:
+        params['jobs'] = args.jobs
+    elif name == 'vol':
+        params['dB'] = args.dB
+    elif name == 'channel':
+        params['ch'] = args.ch
+    elif name == 'clip':
+        params.update(start=args.start, end=args.end)
+    elif name == 'samrate':
+        params['samrate'] = args.samrate
+    elif name == 'chain':
+        params.update(dB=args.dB, ch=args.ch, samrate=args.samrate, block_frames=args.block)
+    if name in ('conv', 'samrate') and args.segment is not None:
+        params['segment_sec'] = args.segment
+    if name in ('conv', 'samrate') and args.resume:
+        params['resume'] = True
+
+    if name == 'join':
+        sources = (args.source_file_1, args.source_file_2)
+    else:
+        sources = (args.source_file,)
+    return batch.Job(name, sources, args.destination_file, params, args.verify,
+                     getattr(args, 'start', None), getattr(args, 'end', None), line)
+
+
+def read_batch_file(batch_file):
+    parser = create_parser()
+    jobs = []
+    with open(batch_file, encoding='utf-8') as f:
+        for n, text in enumerate(f, 1):
+            text = text.strip()
+            if not text or text.startswith('#'):
+                continue
+            try:
+                args = parser.parse_args(shlex.split(text))
+            except (SystemExit, ValueError):
+                # argparse has printed the reason
+                raise SoundFileError(f'{batch_file}:{n}: Invalid job line.') from None
+            if args.sub_command_name not in batch.OPERATIONS:
+                raise SoundFileError(f'{batch_file}:{n}: {args.sub_command_name} can not be a job.')
+            jobs.append(batch_job(args, n))
+    return jobs
+
+
+def batch_runner(batch_file, cpu_jobs=None, io_jobs=batch.DEFAULT_IO_JOBS, skip_existing=False):
+    try:
+        jobs = read_batch_file(batch_file)
+    except (SoundFileError, OSError) as e:
+        print_error(e)
+        return
+
+    def on_done(job_result):
+        job = job_result.job
+        name = f'line {job.line}: {job.operation} {job.destination}'
+        if job_result.skipped:
+            print(f'[{job.queue}] {name}: skipped (exists)')
+        elif job_result.error is not None:
+            print_error(f'[{job.queue}] {name}: {job_result.error}')
+        else:
+            print(f'[{job.queue}] {name}: {job_result.seconds:.2f} sec')
+        if job_result.report is not None:
+            print(json.dumps(job_result.report))
+
+    scheduler = batch.Scheduler(cpu_jobs, io_jobs, skip_existing, sound_api.max_memory())
+    start = time.perf_counter()
+    results = scheduler.run(jobs, on_done)
+    wall = time.perf_counter() - start
+
+    for stats in scheduler.stats.values():
+        print(f'Queue {stats.name:3}: {stats.jobs:,} jobs ({stats.failed:,} failed), {stats.workers} workers, '
+              f'busy {stats.busy:.2f} sec / wall {stats.wall:.2f} sec, utilization {stats.utilization:.0%}, '
+              f'{stats.bytes / 1e6:,.1f} MB')
+    if scheduler.gate is not None:
+        gate = scheduler.gate
+        print(f'Memory: peak {gate.peak / (1 << 20):,.1f} MB of {gate.budget / (1 << 20):,.1f} MB budget, '
+              f'{gate.waits:,} jobs waited for the budget')
+    cores = scheduler.cores
+    print(f'Cores: peak {cores.peak:,} of {cores.budget:,} slots, {cores.waits:,} jobs waited for the cores')
+    failed = sum(r.error is not None for r in results)
+    skipped = sum(r.skipped for r in results)
+    print(f'Batch: {len(results):,} jobs, {failed:,} failed, {skipped:,} skipped, {wall:.2f} sec')
+    return results
+
+
+def watch_jobs(parser, directory, actions, source_file):
+    """
+    batch.Jobs of the --do lines for the file, the placeholders are filled by the file
+    """
+    stem, ext = os.path.splitext(os.path.basename(source_file))
+    fields = {
+        'source': source_file,
+        'dir': os.path.dirname(source_file),
+        'name': os.path.basename(source_file),
+        'stem': stem,
+        'ext': ext,
+        'rel': os.path.relpath(os.path.dirname(source_file), directory),
+    }
+    jobs = []
+    for n, action in enumerate(actions, 1):
+        fields['prev'] = jobs[-1].destination if jobs else source_file
+        try:
+            argv = [token.format(**fields) for token in shlex.split(action)]
+        except (KeyError, IndexError, ValueError) as e:
+            raise SoundFileError(f'--do {n}: Invalid placeholder {e} in "{action}".') from None
+        try:
+            args = parser.parse_args(argv)
+        except SystemExit:
+            # argparse has printed the reason
+            raise SoundFileError(f'--do {n}: Invalid job line "{action}".') from None
+        if args.sub_command_name not in batch.OPERATIONS or args.sub_command_name == 'join':
+            raise SoundFileError(f'--do {n}: {args.sub_command_name} can not be a job.')
+        job = batch_job(args, n)
+        # {rel} is '.' for the files at the top
+        job.destination = os.path.normpath(job.destination)
+        jobs.append(job)
+    return jobs
+
+
+def watch_runner(directory, actions, state_file=watch.DEFAULT_STATE, jobs=None, settle=watch.SETTLE_SEC, poll=False, interval=watch.POLL_SEC):
+    parser = create_parser()
+
+    def make_jobs(source_file):
+        return watch_jobs(parser, directory, actions, source_file)
+
+    try:
+        if not os.path.isdir(directory):
+            raise SoundFileError(f'{directory} is not a directory.')
+        # the lines are checked once before watching
+        make_jobs(os.path.join(os.path.abspath(directory), 'example.wav'))
+    except SoundFileError as e:
+        print_error(e)
+        return
+
+    counts = {'done': 0, 'failed': 0}
+
+    def on_start(watcher):
+        method = 'inotify' if isinstance(watcher, watch.Inotify) else f'polling every {interval} sec'
+        print(f'Watching {directory} by {method}, settle {settle} sec. Ctrl+C to stop.')
+
+    def on_done(watch_result):
+        name = os.path.relpath(watch_result.path, directory)
+        for job_result in watch_result.results:
+            if job_result.report is not None:
+                print(json.dumps(job_result.report))
+        if watch_result.ok:
+            counts['done'] += 1
+            outputs = ', '.join(r.job.destination for r in watch_result.results)
+            print(f'{name}: {outputs} ({watch_result.seconds:.2f} sec after the last change)')
+        else:
+            counts['failed'] += 1
+            error = watch_result.error or next(r.error for r in watch_result.results if r.error is not None)
+            print_error(f'{name}: {error}')
+
+    stop = threading.Event()
+    previous = signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    scheduler = batch.Scheduler(jobs, max_memory=sound_api.max_memory())
+    ingest = watch.Ingest(directory, make_jobs, scheduler, state_file, jobs, settle, poll, interval, on_start, on_done)
+    try:
+        ingest.run(stop)
+    except KeyboardInterrupt:
+        pass
+    except (OSError, sqlite3.Error) as e:
+        print_error(e)
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+    print(f'Watch: {counts["done"]:,} files processed, {counts["failed"]:,} failed')
+
+
+# Functions recorded as phases by --profile / --trace-json / --cprofile
+PROFILED_FUNCTIONS = [
+    'format_converter',
+    'volume_changer',
+    'channel_changer',
+    'chunk_remover',
+    'length_getter',
+    'clipper',
+    'joiner',
+    'samrate_changer',
+    'graph_drawer',
+    'fingerprinter',
+    'duplicate_finder',
+    'spectrogram_drawer',
+    'tag_editor',
+    'chunk_inspector',
+    'file_verifier',
+    'output_verifier',
+    'batch_runner',
+    'chain_runner',
+    'watch_runner',
+    'mixer',
+]
+
+
+def dispatch(args):
+    result = None
 
     if args.sub_command_name == 'conv':
-        format_converter(args.source_file, args.destination_file, args.overwrite)
+        result = format_converter(args.source_file, args.destination_file, args.overwrite, args.jobs, args.check_serial, args.segment, args.resume)
         pass
     elif args.sub_command_name == 'vol':
-        volume_changer(args.source_file, args.destination_file, args.dB, args.overwrite)
+        result = volume_changer(args.source_file, args.destination_file, args.dB, args.overwrite)
         pass
     elif args.sub_command_name == 'channel':
-        channel_changer(args.source_file, args.destination_file, args.ch, args.overwrite)
+        result = channel_changer(args.source_file, args.destination_file, args.ch, args.overwrite)
         pass
     elif args.sub_command_name == 'chunk':
-        chunk_remover(args.source_file, args.destination_file, args.overwrite)
+        result = chunk_remover(args.source_file, args.destination_file, args.overwrite)
         pass
     elif args.sub_command_name == 'len':
         length_getter(args.target_file)
         pass
     elif args.sub_command_name == 'clip':
-        clipper(args.source_file, args.destination_file, args.start, args.end, args.overwrite)
+        result = clipper(args.source_file, args.destination_file, args.start, args.end, args.overwrite)
         pass
     elif args.sub_command_name == 'join':
-        joiner(args.source_file_1, args.source_file_2, args.destination_file, args.overwrite)
+        result = joiner(args.source_file_1, args.source_file_2, args.destination_file, args.overwrite)
         pass
     elif args.sub_command_name == 'samrate':
-        samrate_changer(args.source_file, args.destination_file, args.samrate, args.overwrite)
+        result = samrate_changer(args.source_file, args.destination_file, args.samrate, args.overwrite, args.segment, args.resume)
         pass
     elif args.sub_command_name == 'graph':
         graph_drawer(args.target_file)
         pass
+    elif args.sub_command_name == 'fingerprint':
+        fingerprinter(args.targets, args.index, args.jobs)
+        pass
+    elif args.sub_command_name == 'dedupe':
+        duplicate_finder(args.index, args.threshold, args.min_coverage)
+        pass
+    elif args.sub_command_name == 'spectrogram':
+        spectrogram_drawer(args.targets, args.output_dir, args.format, args.width, args.height, args.scale, args.fft, args.jobs, args.overwrite)
+        pass
+    elif args.sub_command_name == 'tags':
+        tag_editor(args.target_file, args.set, args.delete, args.id3v1)
+        pass
+    elif args.sub_command_name == 'inspect':
+        chunk_inspector(args.targets, args.jobs)
+        pass
+    elif args.sub_command_name == 'verify':
+        file_verifier(args.targets, args.expect_frames, args.tolerance, args.same_as, args.jobs)
+        pass
+    elif args.sub_command_name == 'batch':
+        batch_runner(args.batch_file, args.cpu_jobs, args.io_jobs, args.skip_existing)
+        pass
+    elif args.sub_command_name == 'chain':
+        result = chain_runner(args.source_file, args.destination_file, args.dB, args.ch, args.samrate, args.overwrite, args.block)
+        pass
+    elif args.sub_command_name == 'watch':
+        watch_runner(args.directory, args.do, args.state, args.jobs, args.settle, args.poll, args.interval)
+        pass
+    elif args.sub_command_name == 'mix':
+        result = mixer(args.source_files, args.destination_file, args.gain, args.offset, args.ch, args.samrate, args.limit, args.overwrite, args.check_ffmpeg)
+        pass
+
+    if getattr(args, 'verify', False) and result is not None:
+        output_verifier(result, getattr(args, 'start', None), getattr(args, 'end', None))
+    pass
+
+
+def profiled_dispatch(args):
+    """
+    Run the sub command with the profiling hooks installed
+    """
+    import profiling
+
+    profiler = profiling.Profiler(cprofile=args.cprofile is not None)
+    profiling.instrument(profiler, globals(), PROFILED_FUNCTIONS)
+    profiling.instrument(profiler, vars(sound_api), ['run_ffmpeg'], category='subprocess')
+    job = profiling.wrap(profiler, dispatch, name=args.sub_command_name or 'job', category='job')
+
+    profiler.start()
+    try:
+        job(args)
+    finally:
+        profiler.stop()
+
+        if args.profile:
+            profiler.summary()
+        if args.trace_json:
+            profiler.write_trace(args.trace_json)
+        if args.cprofile:
+            profiler.dump_cprofile(args.cprofile)
+
+
+def main():
+    argv = ['-h']
+
+    if len(sys.argv) > 1:
+        argv = sys.argv[1:]
+    args = arguments_parser(argv)
+    pass
+
+    try:
+        sound_api.set_fsync_policy(args.fsync, args.fsync_batch)
+        sound_api.set_max_memory(sound_api.parse_size(args.max_memory) if args.max_memory else None)
+        if args.profile or args.trace_json or args.cprofile:
+            profiled_dispatch(args)
+        else:
+            dispatch(args)
+    except SoundFileError as e:
+        print_error(e)
+    finally:
+        try:
+            sound_api.flush_outputs()
+        except (SoundFileError, OSError) as e:
+            print_error(e)
     pass
 
 
@@ -0,0 +1,232 @@
+# 
+# Spectrogram with chunked STFT and bounded memory
+# 
+# The STFT is computed over streamed overlapping blocks, and every block is
+# reduced to the output pixel grid at once: frequency by a filterbank matrix
+# (mel / log / linear bands), time by averaging the frames into columns.
+# When the columns exceed twice the width, neighbouring columns are merged,
+# so the memory is proportional to the output image even for multi-hour files
+# whose length is unknown before decoding (mp3).
+# 
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+
+import sound_api
+from sound_api import SoundFileError
+
+
+SCALES = ('mel', 'log', 'linear')
+OUTPUT_FORMATS = ('.png', '.npy')
+DYNAMIC_RANGE_DB = 80.0
+
+
+@dataclass
+class SpectrogramResult:
+    source: str
+    destination: str
+    width: int
+    height: int
+    duration_ms: int
+
+
+def _hz_to_mel(hz):
+    return 2595.0 * np.log10(1.0 + np.asarray(hz) / 700.0)
+
+
+def _mel_to_hz(mel):
+    return 700.0 * (10.0 ** (np.asarray(mel) / 2595.0) - 1.0)
+
+
+def filterbank(n_fft, frame_rate, height, scale='mel', fmin=None, fmax=None):
+    """
+    (rfft bins, height) matrix of triangular filters, row 0 is the lowest frequency
+    """
+    fmax = fmax or frame_rate / 2
+    if fmin is None:
+        fmin = 20.0 if scale == 'log' else 0.0
+
+    if scale == 'mel':
+        edges = _mel_to_hz(np.linspace(_hz_to_mel(fmin), _hz_to_mel(fmax), height + 2))
+    elif scale == 'log':
+        edges = np.geomspace(fmin, fmax, height + 2)
+    elif scale == 'linear':
+        edges = np.linspace(fmin, fmax, height + 2)
+    else:
+        raise sound_api.ParameterError(f'Invalid scale: {scale}')
+
+    freqs = np.fft.rfftfreq(n_fft, 1 / frame_rate)
+    lower, center, upper = edges[:-2, np.newaxis], edges[1:-1, np.newaxis], edges[2:, np.newaxis]
+    rising = (freqs - lower) / np.maximum(center - lower, 1e-9)
+    falling = (upper - freqs) / np.maximum(upper - center, 1e-9)
+    weights = np.maximum(0.0, np.minimum(rising, falling))
+
+    # bands narrower than the bin spacing take the nearest bin
+    empty = weights.sum(axis=1) == 0
+    nearest = np.abs(freqs[np.newaxis, :] - center[empty]).argmin(axis=1)
+    weights[np.nonzero(empty)[0], nearest] = 1.0
+
+    return weights.T.astype(np.float32)
+
+
+class ColumnReducer:
+    """
+    Average of the STFT frames into at most 2 * width columns, in constant memory
+    """
+    def __init__(self, width, height):
+        self.width = width
+        self.frames_per_column = 1
+        self.columns = np.zeros((2 * width, height), dtype=np.float64)
+        self.count = 0                      # complete columns
+        self.partial = np.zeros(height)     # sum of the frames of the next column
+        self.partial_frames = 0
+
+    def _merge(self):
+        # halve the time resolution
+        self.columns[:self.width] = (self.columns[0:2 * self.width:2] + self.columns[1:2 * self.width:2]) / 2
+        self.columns[self.width:] = 0
+        self.count = self.width
+        self.frames_per_column *= 2
+
+    def add(self, frames):
+        position = 0
+        while position < len(frames):
+            n = min(self.frames_per_column - self.partial_frames, len(frames) - position)
+            self.partial += frames[position:position + n].sum(axis=0)
+            self.partial_frames += n
+            position += n
+
+            if self.partial_frames == self.frames_per_column:
+                self.columns[self.count] = self.partial / self.partial_frames
+                self.count += 1
+                self.partial[:] = 0
+                self.partial_frames = 0
+                if self.count == len(self.columns):
+                    self._merge()
+
+    def result(self):
+        """
+        (width, height) columns, or fewer if the input is shorter than width frames
+        """
+        columns = self.columns[:self.count]
+        if self.partial_frames:
+            columns = np.vstack([columns, self.partial / self.partial_frames])
+        if len(columns) <= self.width:
+            return columns
+
+        # resample the columns to the width
+        x = np.linspace(0, len(columns) - 1, self.width)
+        i = np.minimum(x.astype(np.int64), len(columns) - 2)
+        frac = (x - i)[:, np.newaxis]
+        return columns[i] * (1 - frac) + columns[i + 1] * frac
+
+
+def compute(source_file, width=1024, height=256, scale='mel', n_fft=2048, block_frames=1 << 16):
+    """
+    Spectrogram of source_file as dB (height, width), row 0 is the lowest frequency.
+    Returns (spectrogram, duration_ms).
+    """
+    if width <= 0 or height <= 0:
+        raise sound_api.ParameterError('Width and height must be positive.')
+    if n_fft < 16:
+        raise sound_api.ParameterError('FFT size is too small.')
+
+    with sound_api.BlockReader(source_file, block_frames=block_frames, channels=1) as reader:
+        frame_rate = reader.info.frame_rate
+        matrix = filterbank(n_fft, frame_rate, height, scale)
+        reducer = ColumnReducer(width, height)
+        samples = 0
+
+        def counted(blocks):
+            nonlocal samples
+            for block in blocks:
+                samples += len(block)
+                yield block
+
+        for power in sound_api.stft_power(counted(reader), n_fft, n_fft // 4):
+            reducer.add(power @ matrix)
+
+    columns = reducer.result()
+    db = 10.0 * np.log10(np.maximum(columns, 1e-12))
+    if db.size:
+        db = np.maximum(db, db.max() - DYNAMIC_RANGE_DB)
+    return db.T.astype(np.float32), round(samples * 1000 / frame_rate)
+
+
+def render(spectrogram, destination_file, cmap='magma'):
+    """
+    Save as an image of exactly (height, width) pixels without a display, or as .npy
+    """
+    _, ext = os.path.splitext(destination_file)
+    if ext.lower() == '.npy':
+        np.save(destination_file, spectrogram)
+        return
+
+    from matplotlib import image
+
+    image.imsave(destination_file, spectrogram, cmap=cmap, origin='lower')
+
+
+def destination_for(source_file, output_dir=None, output_format='.png'):
+    directory, name = os.path.split(source_file)
+    stem, _ = os.path.splitext(name)
+    return os.path.join(output_dir if output_dir else directory, f'{stem}_spectrogram{output_format}')
+
+
+def spectrogram_file(source_file, destination_file, width=1024, height=256, scale='mel', n_fft=2048, overwrite=False):
+    sound_api.check_source(source_file)
+    sound_api.check_destination(destination_file, overwrite)
+    _, ext = os.path.splitext(destination_file)
+    if ext.lower() not in OUTPUT_FORMATS:
+        raise sound_api.FormatError('Invalid destination file format.')
+
+    spectrogram, duration_ms = compute(source_file, width, height, scale, n_fft)
+    with sound_api.atomic_output(destination_file, overwrite) as temp_file:
+        render(spectrogram, temp_file)
+    return SpectrogramResult(source_file, destination_file, spectrogram.shape[1], spectrogram.shape[0], duration_ms)
+
+
+def _spectrogram_job(job):
+    """
+    Worker process : errors are returned as a message
+    """
+    source_file, destination_file, options = job
+    try:
+        result = spectrogram_file(source_file, destination_file, **options)
+        # the pending outputs of the batch policy would be lost with the worker
+        sound_api.flush_outputs()
+        return result, None
+    except (SoundFileError, OSError) as e:
+        return None, f'{source_file}: {e}'
+
+
+def spectrogram_files(targets, output_dir=None, output_format='.png', jobs=None, **options):
+    """
+    Spectrograms of the sound files of targets across a process pool.
+    Yields (SpectrogramResult or None, error message or None) in the order of the files.
+    """
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    work = []
+    destinations = set()
+    for source_file in sound_api.find_sound_files(targets):
+        destination_file = destination_for(source_file, output_dir, output_format)
+        if destination_file in destinations:
+            # same file name in different directories, the workers would race on it
+            yield None, f'{source_file}: Destination file {destination_file} is duplicated.'
+            continue
+        destinations.add(destination_file)
+        work.append((source_file, destination_file, options))
+
+    if not work:
+        return
+
+    if len(work) == 1:
+        yield _spectrogram_job(work[0])
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        yield from pool.map(_spectrogram_job, work)
@@ -0,0 +1,226 @@
+# 
+# Tags of sound files
+# 
+# The common tag names (title, artist, ...) are mapped to the LIST/INFO items of wav files
+# and to the ID3v2 frames and the ID3v1 fields of mp3 files.
+# The bext fields of wav files are named bext.<field>, the ID3v1 fields id3v1.<field> (read only),
+# and the raw ids (INAM, TIT2, ...) can be used as names too.
+# All the edits are done in the header region of the file when the new tags fit there.
+# 
+
+import id3
+import remove_chunk
+import sound_api
+from id3 import Id3Error
+from remove_chunk import WavError
+
+
+ID3_IDS = {
+    'title': b'TIT2',
+    'artist': b'TPE1',
+    'album': b'TALB',
+    'comment': b'COMM',
+    'date': b'TDRC',
+    'genre': b'TCON',
+    'track': b'TRCK',
+    'copyright': b'TCOP',
+    'software': b'TSSE',
+    'engineer': b'TPE4',
+    'album_artist': b'TPE2',
+    'composer': b'TCOM',
+}
+
+ID3V1_FIELDS = ('title', 'artist', 'album', 'date', 'comment', 'track', 'genre')
+
+
+def _raw_id(name):
+    if len(name) == 4 and name.isalnum() and name.upper() == name:
+        return name.encode('ascii')
+    return None
+
+
+def _name_of(raw_id, ids):
+    for name, value in ids.items():
+        if value == raw_id:
+            return name
+    return raw_id.decode('latin-1')
+
+
+def _frame_id(name, version):
+    frame_id = ID3_IDS.get(name) or _raw_id(name)
+    if frame_id is None:
+        raise sound_api.ParameterError(f'Unknown tag name: {name}')
+    if frame_id == b'TDRC' and version == 3:
+        # no recording time in ID3v2.3
+        frame_id = b'TYER'
+    return frame_id
+
+
+def _genre_number(text):
+    for number, genre in enumerate(id3.GENRES):
+        if genre.lower() == text.lower():
+            return number
+    return 255
+
+
+def _track_number(text):
+    digits = text.split('/')[0].strip()
+    return int(digits) if digits.isdigit() and int(digits) < 256 else 0
+
+
+# 
+# wav
+# 
+
+def _read_wav_tags(source_file):
+    info, bext = remove_chunk.read_tags(source_file)
+    tags = {}
+    if info is not None:
+        for item_id, text in info.items.items():
+            tags[_name_of(item_id, remove_chunk.INFO_IDS)] = text
+    if bext is not None:
+        for name in remove_chunk.BEXT_FIELDS:
+            value = getattr(bext, name)
+            if value:
+                tags[f'bext.{name}'] = str(value)
+    return tags
+
+
+def _write_wav_tags(destination_file, changes):
+    info, bext = remove_chunk.read_tags(destination_file)
+    info = info or remove_chunk.InfoTag(b'INFO')
+    bext = bext or remove_chunk.empty_bext_chunk()
+    info_changed = bext_changed = False
+
+    for name, text in changes.items():
+        if name.startswith('bext.'):
+            field = name[5:]
+            if field not in remove_chunk.BEXT_FIELDS:
+                raise sound_api.ParameterError(f'Unknown tag name: {name}')
+            if field == 'time_reference':
+                if text is not None and not text.isdigit():
+                    raise sound_api.ParameterError('bext.time_reference must be a number of samples.')
+                text = int(text) if text is not None else 0
+            setattr(bext, field, text if text is not None else '')
+            bext_changed = True
+            continue
+
+        item_id = remove_chunk.INFO_IDS.get(name) or _raw_id(name)
+        if item_id is None:
+            raise sound_api.ParameterError(f'Unknown tag name: {name}')
+        if text is None:
+            info.items.pop(item_id, None)
+        else:
+            info.items[item_id] = text
+        info_changed = True
+
+    return remove_chunk.write_tags(destination_file, info if info_changed else None, bext if bext_changed else None)
+
+
+# 
+# mp3
+# 
+
+def _read_mp3_tags(source_file):
+    tags = {}
+    with open(source_file, 'rb') as src:
+        tag = id3.read_id3v2(src)
+        v1 = id3.read_id3v1(src)
+
+    if tag is not None:
+        for frame in tag.frames:
+            text = id3.frame_text(frame, tag.version)
+            if text is None:
+                continue
+            if frame.frame_id == b'COMM' and id3.comment_description(frame):
+                # comments with a description are the data of applications
+                continue
+            frame_id = b'TDRC' if frame.frame_id == b'TYER' else frame.frame_id
+            tags[_name_of(frame_id, ID3_IDS)] = text
+
+    if v1 is not None:
+        values = {
+            'title': v1.title, 'artist': v1.artist, 'album': v1.album, 'date': v1.year, 'comment': v1.comment,
+            'track': str(v1.track) if v1.track else '',
+            'genre': id3.GENRES[v1.genre] if v1.genre < len(id3.GENRES) else '',
+        }
+        for name in ID3V1_FIELDS:
+            if values[name]:
+                tags[f'id3v1.{name}'] = values[name]
+    return tags
+
+
+def _write_mp3_tags(destination_file, changes, id3v1=False):
+    with open(destination_file, 'rb') as dst:
+        tag = id3.read_id3v2(dst) or id3.Id3Tag(4)
+        v1 = id3.read_id3v1(dst)
+
+    for name, text in changes.items():
+        frame_id = _frame_id(name, tag.version)
+        tag.frames = [
+            frame for frame in tag.frames
+            if frame.frame_id != frame_id or (frame_id == b'COMM' and id3.comment_description(frame))
+        ]
+        if text is not None:
+            tag.frames.append(id3.text_frame(frame_id, text, tag.version))
+    modes = [id3.write_id3v2(destination_file, tag)]
+
+    if v1 is None and not id3v1:
+        return modes
+    v1 = v1 or id3.Id3v1Tag()
+    for name, text in changes.items():
+        text = text or ''
+        if name in ('title', 'artist', 'album', 'comment'):
+            setattr(v1, name, text)
+        elif name == 'date':
+            v1.year = text[:4]
+        elif name == 'track':
+            v1.track = _track_number(text)
+        elif name == 'genre':
+            v1.genre = _genre_number(text) if text else 255
+    modes.append(id3.write_id3v1(destination_file, v1))
+    return modes
+
+
+def read_tags(source_file):
+    """
+    Tags of a wav or mp3 file as {name: text}
+    """
+    sound_api.check_source(source_file)
+    fmt = sound_api._extension(source_file)
+    sound_api._check_format(fmt)
+    try:
+        if fmt == '.wav':
+            return _read_wav_tags(source_file)
+        return _read_mp3_tags(source_file)
+    except (WavError, Id3Error) as e:
+        raise sound_api.FormatError(f'Invalid tags. {e}') from None
+
+
+def copy_info_tags(source_file, destination_file):
+    """
+    Copy the common tags of a wav or mp3 file to the LIST/INFO of a wav file, as ffmpeg does
+    """
+    changes = {name: text for name, text in read_tags(source_file).items() if name in remove_chunk.INFO_IDS}
+    if changes:
+        write_tags(destination_file, changes)
+
+
+def write_tags(destination_file, changes, id3v1=False):
+    """
+    Set the tags {name: text} of a wav or mp3 file, a text of None removes the tag.
+    id3v1 adds an ID3v1 tag to an mp3 file, an existing one is always updated.
+    Returns the list of the write modes ('in place', 'append' or 'rewrite').
+    """
+    sound_api.check_source(destination_file, 'Destination file')
+    fmt = sound_api._extension(destination_file)
+    sound_api._check_format(fmt, 'destination file')
+    for name in changes:
+        if name.startswith('id3v1.'):
+            raise sound_api.ParameterError(f'{name} is read only, ID3v1 is updated by the common names.')
+    try:
+        if fmt == '.wav':
+            return _write_wav_tags(destination_file, changes)
+        return _write_mp3_tags(destination_file, changes, id3v1)
+    except (WavError, Id3Error) as e:
+        raise sound_api.FormatError(f'Invalid tags. {e}') from None
@@ -0,0 +1,103 @@
+import os
+import shutil
+import subprocess
+import sys
+import wave
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import sound_api
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'ffmpeg: the test runs ffmpeg')
+
+
+def pytest_collection_modifyitems(config, items):
+    if shutil.which('ffmpeg') is not None:
+        return
+    skip = pytest.mark.skip(reason='ffmpeg is not found')
+    for item in items:
+        if 'ffmpeg' in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture(autouse=True)
+def default_settings():
+    """
+    The fsync policy and the memory budget are module settings, each test starts from the defaults
+    """
+    yield
+    sound_api.set_fsync_policy('always')
+    sound_api.set_max_memory(None)
+
+
+def tone(seconds=1.0, frame_rate=44100, channels=2, freq=440.0, amplitude=0.5):
+    """
+    float32 samples (frames, channels) of a sine, a different phase per channel
+    """
+    t = np.arange(round(seconds * frame_rate)) / frame_rate
+    return np.stack([amplitude * np.sin(2 * np.pi * freq * t + ch) for ch in range(channels)], axis=1).astype(np.float32)
+
+
+def write_wav(path, samples, frame_rate=44100, sample_width=2):
+    audio = sound_api.from_float(samples, frame_rate, sample_width)
+    with wave.open(os.fspath(path), 'wb') as w:
+        w.setnchannels(audio.channels)
+        w.setsampwidth(sample_width)
+        w.setframerate(frame_rate)
+        w.writeframes(sound_api._to_pcm_bytes(audio))
+    return os.fspath(path)
+
+
+def read_wav(path):
+    with wave.open(os.fspath(path), 'rb') as w:
+        return sound_api.Audio(
+            sound_api._from_pcm_bytes(w.readframes(w.getnframes()), w.getnchannels(), w.getsampwidth()),
+            w.getframerate(),
+            w.getsampwidth(),
+        )
+
+
+@pytest.fixture
+def make_wav(tmp_path):
+    """
+    make_wav(name, seconds, frame_rate, channels, freq, sample_width) writes a tone wav in tmp_path
+    """
+    def make(name='tone.wav', seconds=1.0, frame_rate=44100, channels=2, freq=440.0, sample_width=2):
+        return write_wav(tmp_path / name, tone(seconds, frame_rate, channels, freq), frame_rate, sample_width)
+    return make
+
+
+@pytest.fixture
+def corrupt_wavs(tmp_path, make_wav):
+    """
+    Paths of a wav with a truncated chunk, a file which is not RIFF and a 30 byte head of a wav
+    """
+    with open(make_wav('whole.wav', 0.5), 'rb') as f:
+        data = f.read()
+    files = {
+        'truncated': b'RIFF$\x00\x00\x00WAVE' + b'junk' * 3,
+        'not_riff': b'not a wav file at all' * 8,
+        'head': data[:30],
+    }
+    for name, content in files.items():
+        (tmp_path / f'{name}.wav').write_bytes(content)
+    return [os.fspath(tmp_path / f'{name}.wav') for name in files]
+
+
+@pytest.fixture
+def cli(tmp_path):
+    """
+    cli(*arguments) runs sound_file_converter.py in tmp_path, returns CompletedProcess with text output
+    """
+    def run(*arguments):
+        return subprocess.run(
+            [sys.executable, '-W', 'ignore', os.path.join(ROOT, 'sound_file_converter.py'), *map(str, arguments)],
+            cwd=tmp_path, capture_output=True, text=True, timeout=300,
+        )
+    return run
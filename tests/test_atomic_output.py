@@ -0,0 +1,134 @@
+import os
+import stat
+
+import numpy as np
+import pytest
+
+import batch
+import sound_api
+from conftest import tone
+from sound_api import DestinationExistsError, ParameterError
+
+
+def temp_files(directory):
+    return [name for name in os.listdir(directory) if '.tmp' in name]
+
+
+def test_commit(tmp_path):
+    destination = tmp_path / 'a.txt'
+    with sound_api.atomic_output(destination) as temp_file:
+        assert os.path.dirname(temp_file) == os.fspath(tmp_path)
+        assert temp_file.endswith('.tmp.txt')
+        with open(temp_file, 'w') as f:
+            f.write('done')
+    assert destination.read_text() == 'done'
+    assert temp_files(tmp_path) == []
+
+    umask = os.umask(0)
+    os.umask(umask)
+    assert stat.S_IMODE(destination.stat().st_mode) == 0o666 & ~umask
+
+
+def test_failed_block_leaves_nothing(tmp_path):
+    destination = tmp_path / 'a.txt'
+    with pytest.raises(RuntimeError):
+        with sound_api.atomic_output(destination) as temp_file:
+            with open(temp_file, 'w') as f:
+                f.write('partial')
+            raise RuntimeError
+    assert os.listdir(tmp_path) == []
+
+
+def test_overwrite_keeps_the_mode(tmp_path):
+    destination = tmp_path / 'a.txt'
+    destination.write_text('old')
+    os.chmod(destination, 0o640)
+
+    with pytest.raises(DestinationExistsError):
+        with sound_api.atomic_output(destination):
+            pass
+    with sound_api.atomic_output(destination, overwrite=True) as temp_file:
+        with open(temp_file, 'w') as f:
+            f.write('new')
+    assert destination.read_text() == 'new'
+    assert stat.S_IMODE(destination.stat().st_mode) == 0o640
+
+
+def test_destination_created_meanwhile(tmp_path):
+    destination = tmp_path / 'a.txt'
+    with pytest.raises(DestinationExistsError):
+        with sound_api.atomic_output(destination) as temp_file:
+            destination.write_text('other writer')
+    assert destination.read_text() == 'other writer'
+    assert temp_files(tmp_path) == []
+
+
+def test_committer_parameters():
+    with pytest.raises(ParameterError):
+        sound_api.OutputCommitter('sometimes')
+    with pytest.raises(ParameterError):
+        sound_api.OutputCommitter('batch', 0)
+
+
+@pytest.mark.parametrize('policy', ['always', 'never'])
+def test_policies_rename_at_once(tmp_path, policy):
+    sound_api.set_fsync_policy(policy)
+    audio = sound_api.from_float(tone(0.01, 8000), 8000, 2)
+    sound_api.save(audio, tmp_path / 'a.wav')
+    assert os.listdir(tmp_path) == ['a.wav']
+
+
+def test_batch_policy(tmp_path):
+    sound_api.set_fsync_policy('batch', 3)
+    audio = sound_api.from_float(tone(0.01, 8000), 8000, 2)
+    size = sound_api.save(audio, tmp_path / 'a.wav')
+    sound_api.save(audio, tmp_path / 'b.wav')
+    assert not (tmp_path / 'a.wav').exists()
+    assert size == len(sound_api.to_bytes(audio))
+
+    # the third output fills the batch
+    sound_api.save(audio, tmp_path / 'c.wav')
+    assert sorted(os.listdir(tmp_path)) == ['a.wav', 'b.wav', 'c.wav']
+
+    sound_api.save(audio, tmp_path / 'd.wav')
+    sound_api.flush_outputs()
+    assert np.array_equal(sound_api.load(tmp_path / 'd.wav').samples, audio.samples)
+    assert temp_files(tmp_path) == []
+
+
+def test_pending_output_exists(tmp_path):
+    sound_api.set_fsync_policy('batch')
+    audio = sound_api.from_float(tone(0.01, 8000), 8000, 2)
+    destination = tmp_path / 'a.wav'
+    sound_api.save(audio, destination)
+    assert not destination.exists()
+    assert sound_api.output_exists(destination)
+
+    with pytest.raises(DestinationExistsError):
+        sound_api.save(audio, destination)
+    with pytest.raises(DestinationExistsError):
+        sound_api.check_destination(os.fspath(destination))
+
+    # an overwrite replaces the pending output
+    louder = sound_api.change_volume(audio, 6)
+    sound_api.save(louder, destination, overwrite=True)
+    assert len(temp_files(tmp_path)) == 1
+
+    # a change of the policy commits the pending outputs
+    sound_api.set_fsync_policy('always')
+    assert np.array_equal(sound_api.load(destination).samples, louder.samples)
+    assert temp_files(tmp_path) == []
+
+
+def test_batch_skips_pending_output(tmp_path, make_wav):
+    sound_api.set_fsync_policy('batch')
+    source = make_wav('a.wav', 0.1)
+    destination = os.fspath(tmp_path / 'b.wav')
+    sound_api.remove_chunks_file(source, destination)
+
+    scheduler = batch.Scheduler(skip_existing=True)
+    [result] = scheduler.run([batch.Job('chunk', (source,), destination)])
+    assert result.skipped and result.error is None
+
+    [result] = batch.Scheduler().run([batch.Job('chunk', (source,), destination)])
+    assert result.error == 'Destination file already exists.'
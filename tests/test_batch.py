@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+
+import batch
+
+
+def job(operation, source, destination, **params):
+    return batch.Job(operation, (source,), destination, params)
+
+
+def test_classify():
+    assert batch.classify(job('chunk', 'a.wav', 'b.wav')) == 'io'
+    assert batch.classify(job('vol', 'a.mp3', 'b.mp3')) == 'cpu'
+    assert batch.classify(job('conv', 'a.wav', 'b.MP3')) == 'cpu'
+    assert batch.classify(job('samrate', 'a.wav', 'b.wav')) == 'cpu'
+
+
+def test_plan_larger_first(tmp_path):
+    for name, size in (('s.wav', 10), ('l.wav', 1000), ('m.wav', 100)):
+        (tmp_path / name).write_bytes(bytes(size))
+    jobs = [job('chunk', os.fspath(tmp_path / name), 'x.wav') for name in ('s.wav', 'l.wav', 'm.wav', 'missing.wav')]
+    assert [j.size for j in batch.plan(jobs)] == [1000, 100, 10, 0]
+
+
+def test_core_slots():
+    cpu = job('conv', 'a.wav', 'b.mp3', jobs=3)
+    cpu.queue = 'cpu'
+    assert batch.core_slots(cpu, 8) == 3
+    assert batch.core_slots(cpu, 2) == 2
+    cpu.params['jobs'] = None
+    assert batch.core_slots(cpu, 8) == 1
+    io = job('chunk', 'a.wav', 'b.wav')
+    io.queue = 'io'
+    assert batch.core_slots(io, 8) == 0
+
+
+def test_gate_caps_a_large_reservation():
+    gate = batch.Gate(10)
+    assert gate.acquire(4) == 4
+    gate.release(4)
+    # over the budget, it runs alone
+    assert gate.acquire(25) == 10
+    assert gate.reserved == gate.peak == 10
+    gate.release(10)
+
+
+def test_gate_waits_within_budget():
+    gate = batch.Gate(10)
+    inside = []
+    totals = []
+    lock = threading.Lock()
+
+    def work(size):
+        reserved = gate.acquire(size)
+        with lock:
+            inside.append(reserved)
+            totals.append(sum(inside))
+        time.sleep(0.01)
+        with lock:
+            inside.remove(reserved)
+        gate.release(reserved)
+
+    threads = [threading.Thread(target=work, args=(size,)) for size in (6, 6, 3, 30, 4, 5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(totals) <= 10
+    assert gate.peak <= 10 and gate.reserved == 0
+    assert gate.waits > 0
+
+
+def test_corrupt_job_fails_alone(make_wav, corrupt_wavs, tmp_path):
+    good = make_wav('good.wav', 0.1)
+    jobs = [job('chunk', path, os.fspath(tmp_path / f'out{i}.wav')) for i, path in enumerate([good, *corrupt_wavs])]
+    done = []
+    scheduler = batch.Scheduler(io_jobs=2)
+    results = scheduler.run(jobs, on_done=done.append)
+    assert [r.job for r in results] == jobs
+    assert results[0].error is None and results[0].result.bytes_written > 0
+    assert all(r.error.startswith('Invalid wav data') for r in results[1:])
+    assert len(done) == len(jobs)
+
+    stats = scheduler.stats['io']
+    assert (stats.jobs, stats.failed, stats.workers) == (4, 3, 2)
+    assert 0 < stats.utilization <= 1
+    # no temporary output is left
+    assert not any(name.startswith('.') for name in os.listdir(tmp_path))
+
+
+def test_unexpected_error_fails_the_job(monkeypatch, make_wav, tmp_path):
+    def broken(*args, **kwargs):
+        raise ValueError('unexpected')
+
+    monkeypatch.setitem(batch.OPERATIONS, 'vol', broken)
+    source = make_wav('a.wav', 0.1)
+    scheduler = batch.Scheduler()
+    results = scheduler.run([job('vol', source, os.fspath(tmp_path / 'b.wav'), dB=1),
+                             job('chunk', source, os.fspath(tmp_path / 'c.wav'))])
+    assert results[0].error == 'ValueError: unexpected'
+    assert results[1].error is None
+    assert (scheduler.stats['io'].jobs, scheduler.stats['io'].failed) == (2, 1)
+    assert scheduler.cores.reserved == 0
+
+
+def test_cpu_jobs_take_their_core_slots(monkeypatch, tmp_path):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def encode(source_file, destination_file, jobs=None):
+        with lock:
+            running.append(jobs or 1)
+            peak.append(sum(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(jobs or 1)
+
+    monkeypatch.setitem(batch.OPERATIONS, 'conv', encode)
+    jobs = [job('conv', 'a.wav', f'{i}.mp3', jobs=n) for i, n in enumerate((3, 2, 1, 1, 2))]
+    scheduler = batch.Scheduler(cpu_jobs=4)
+    results = scheduler.run(jobs)
+    assert all(r.error is None for r in results)
+    assert max(peak) <= 4
+    assert scheduler.cores.peak <= 4
+    assert scheduler.cores.waits > 0
+
+
+def test_run_chain_stops_at_failure(make_wav, tmp_path):
+    source = make_wav('a.wav', 0.1)
+    b = os.fspath(tmp_path / 'b.wav')
+    jobs = [job('chunk', source, b), job('chunk', b, b), job('chunk', b, os.fspath(tmp_path / 'c.wav'))]
+    results = batch.Scheduler().run_chain(jobs)
+    assert len(results) == 2
+    assert results[0].error is None
+    assert results[1].error == 'Destination file already exists.'
+
+
+def test_batch_command(cli, make_wav, corrupt_wavs, tmp_path):
+    make_wav('a.wav', 0.1)
+    (tmp_path / 'jobs.txt').write_text('\n'.join([
+        '# comment',
+        'chunk a.wav b.wav',
+        'chunk truncated.wav c.wav',
+        '',
+        'chunk a.wav d.wav --verify',
+    ]))
+    completed = cli('batch', 'jobs.txt')
+    assert 'line 3: chunk c.wav: Invalid wav data.' in completed.stderr
+    assert 'Batch: 3 jobs, 1 failed, 0 skipped' in completed.stdout
+    assert (tmp_path / 'b.wav').exists() and (tmp_path / 'd.wav').exists()
+
+    completed = cli('batch', '--skip-existing', 'jobs.txt')
+    assert 'Batch: 3 jobs, 1 failed, 2 skipped' in completed.stdout
+
+
+def test_batch_file_errors(cli, tmp_path):
+    (tmp_path / 'jobs.txt').write_text('vol a.wav b.wav\n')
+    assert 'jobs.txt:1: Invalid job line.' in cli('batch', 'jobs.txt').stderr
+    (tmp_path / 'jobs.txt').write_text('batch other.txt\n')
+    assert 'jobs.txt:1: batch can not be a job.' in cli('batch', 'jobs.txt').stderr
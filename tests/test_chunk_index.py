@@ -0,0 +1,96 @@
+import json
+import os
+import struct
+
+import pytest
+
+import chunk_index
+
+FMT = struct.pack('<HHIIHH', 1, 2, 44100, 176400, 4, 16)
+
+
+def chunk(chunk_id, data, padding=True):
+    return struct.pack('<4sI', chunk_id, len(data)) + data + (b'\0' if padding and len(data) % 2 else b'')
+
+
+def riff(*chunks, form=b'RIFF', riff_size=None):
+    body = b'WAVE' + b''.join(chunks)
+    return struct.pack('<4sI', form, len(body) if riff_size is None else riff_size) + body
+
+
+def index(tmp_path, data):
+    path = tmp_path / 'a.wav'
+    path.write_bytes(data)
+    return chunk_index.index_file(os.fspath(path))
+
+
+def test_plain_wav(tmp_path):
+    result = index(tmp_path, riff(chunk(b'fmt ', FMT), chunk(b'data', bytes(16))))
+    assert [(c.chunk_id, c.offset, c.size) for c in result.chunks] == [('fmt ', 12, 16), ('data', 36, 16)]
+    assert result.fmt == {'format': 1, 'channels': 2, 'sampling_rate': 44100, 'byte_rate': 176400,
+                          'block_align': 4, 'bits_per_sample': 16}
+    assert result.issues == []
+
+
+def test_same_as_wave_module(make_wav):
+    path = make_wav('a.wav', 0.1, frame_rate=8000, channels=1)
+    result = chunk_index.index_file(path)
+    assert result.issues == []
+    assert result.fmt['sampling_rate'] == 8000
+    assert result.chunks[-1].size == 800 * 2
+
+
+def test_odd_chunk_padding(tmp_path):
+    padded = index(tmp_path, riff(chunk(b'fmt ', FMT), chunk(b'LIST', b'INFOx'), chunk(b'data', bytes(4))))
+    assert padded.issues == []
+    assert padded.chunks[2].offset == 36 + 8 + 6
+
+    unpadded = index(tmp_path, riff(chunk(b'fmt ', FMT), chunk(b'LIST', b'INFOx', padding=False), chunk(b'data', bytes(4))))
+    assert [c.chunk_id for c in unpadded.chunks] == ['fmt ', 'LIST', 'data']
+    assert unpadded.issues == ["'LIST' chunk has no padding byte"]
+
+
+def test_extensible_fmt_and_fact(tmp_path):
+    guid = struct.pack('<H', 3) + bytes(14)
+    fmt = struct.pack('<HHIIHH', 0xFFFE, 2, 48000, 384000, 8, 32) + struct.pack('<HHI16s', 22, 32, 3, guid)
+    result = index(tmp_path, riff(chunk(b'fmt ', fmt), chunk(b'fact', struct.pack('<I', 2)), chunk(b'data', bytes(16))))
+    assert (result.fmt['sub_format'], result.fmt['valid_bits'], result.fmt['channel_mask']) == (3, 32, 3)
+    assert result.fact_samples == 2
+    assert result.issues == []
+
+
+def test_rf64(tmp_path):
+    ds64 = struct.pack('<QQQ', 0, 16, 4)
+    data = riff(chunk(b'ds64', ds64), chunk(b'fmt ', FMT), struct.pack('<4sI', b'data', 0xFFFFFFFF) + bytes(16),
+                form=b'RF64', riff_size=0xFFFFFFFF)
+    ds64 = struct.pack('<QQQ', len(data) - 8, 16, 4)
+    data = data[:20] + ds64 + data[20 + len(ds64):]
+    result = index(tmp_path, data)
+    assert result.form == 'RF64'
+    assert result.chunks[-1].size == 16
+    assert result.issues == []
+
+
+@pytest.mark.parametrize('data, issue', [
+    (b'', 'empty file'),
+    (b'RIFF', 'file is shorter than the RIFF header'),
+    (b'RIFX\x00\x00\x00\x00WAVE', 'not a RIFF WAVE file'),
+    (riff(chunk(b'fmt ', FMT), chunk(b'data', bytes(16)))[:-6], "'data' chunk is truncated (10 of 16 bytes)"),
+    (riff(chunk(b'fmt ', FMT), chunk(b'data', bytes(4))) + b'\x00\x01garbage', 'trailing junk at 48 (9 bytes)'),
+    (riff(chunk(b'fmt ', FMT), chunk(b'data', bytes(4)), riff_size=100), 'RIFF size 100 does not match the chunks (40)'),
+    (riff(chunk(b'data', bytes(4))), 'no fmt chunk'),
+    (riff(chunk(b'fmt ', FMT[:10])), 'fmt chunk is too short (10 bytes)'),
+])
+def test_issues(tmp_path, data, issue):
+    assert issue in index(tmp_path, data).issues
+
+
+def test_index_files(tmp_path, make_wav):
+    make_wav('a.wav', 0.1)
+    make_wav('b.wav', 0.1)
+    (tmp_path / 'c.wav').write_bytes(b'not a wav')
+    for jobs in (1, 2):
+        lines = [json.loads(line) for line in chunk_index.index_files([os.fspath(tmp_path)], jobs=jobs)]
+        assert [os.path.basename(line['file']) for line in lines] == ['a.wav', 'b.wav', 'c.wav']
+        assert lines[0]['issues'] == [] and lines[0]['fmt']['channels'] == 2
+        assert lines[2]['issues'] == ['file is shorter than the RIFF header']
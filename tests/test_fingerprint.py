@@ -0,0 +1,103 @@
+import os
+
+import numpy as np
+import pytest
+
+import fingerprint
+from conftest import write_wav
+
+
+def melody(seconds, seed, frame_rate=44100):
+    """
+    Random notes of 100 msec, the fingerprint bands see the changes of the pitch
+    """
+    frames = round(seconds * frame_rate)
+    notes = 300 * 2 ** (np.random.default_rng(seed).integers(0, 24, frames // 4410 + 1) / 12)
+    phase = 2 * np.pi * np.cumsum(np.repeat(notes, 4410)[:frames]) / frame_rate
+    return np.stack([0.3 * np.sin(phase)] * 2, axis=1).astype(np.float32)
+
+
+@pytest.fixture
+def library(tmp_path):
+    """
+    a.wav, its copy 6 dB lower, and an other sound
+    """
+    sound = melody(6.0, 1)
+    directory = tmp_path / 'library'
+    directory.mkdir()
+    write_wav(directory / 'a.wav', sound)
+    write_wav(directory / 'a_quiet.wav', sound / 2)
+    write_wav(directory / 'other.wav', melody(6.0, 2))
+    return directory
+
+
+def test_fingerprint_file(library):
+    fp = fingerprint.fingerprint_file(os.fspath(library / 'a.wav'))
+    assert fp.codes.dtype == np.uint32
+    assert fp.duration_ms == 6000
+    assert len(fp.codes) == pytest.approx(6.0 / fingerprint.HOP_SEC, abs=10)
+
+
+def test_compare():
+    codes = np.random.default_rng(3).integers(0, 1 << 32, 200, dtype=np.uint64).astype(np.uint32)
+    assert fingerprint.compare(codes, codes) == (1.0, 1.0, 0)
+    similarity, coverage, offset = fingerprint.compare(codes[20:], codes)
+    assert (similarity, offset) == (1.0, 20)
+    assert coverage == pytest.approx(180 / 200)
+    assert fingerprint.compare(codes, np.zeros(0, dtype=np.uint32)) == (0.0, 0.0, 0)
+
+
+def test_sketch():
+    assert fingerprint.sketch(np.array(fingerprint.SILENCE_CODES * 10, dtype=np.uint32)) == []
+    codes = np.arange(1000, dtype=np.uint32)
+    values = fingerprint.sketch(codes)
+    assert len(values) == fingerprint.LSH_BANDS
+    # the min-hash depends on the set of the codes only
+    assert fingerprint.sketch(codes[::-1]) == values
+
+
+def test_group_duplicates():
+    pairs = [fingerprint.Duplicate(a, b, 1.0, 1.0, 0) for a, b in [('a', 'b'), ('b', 'c'), ('x', 'y')]]
+    groups = sorted(sorted(group) for group in fingerprint.group_duplicates(pairs))
+    assert groups == [['a', 'b', 'c'], ['x', 'y']]
+
+
+def test_index_and_duplicates(library, tmp_path):
+    index_file = os.fspath(tmp_path / 'index.sqlite')
+    assert fingerprint.update_index(index_file, [os.fspath(library)], jobs=2) == (3, 0, 0)
+
+    duplicates = fingerprint.find_duplicates(index_file)
+    assert [(os.path.basename(d.file_1), os.path.basename(d.file_2)) for d in duplicates] == [('a.wav', 'a_quiet.wav')]
+    assert duplicates[0].similarity > 0.9
+    assert duplicates[0].offset_ms == 0
+
+    # unchanged files are skipped, deleted files are removed
+    os.remove(library / 'other.wav')
+    assert fingerprint.update_index(index_file, [os.fspath(library)], jobs=2) == (0, 2, 1)
+
+
+def test_corrupt_file_fails_alone(library, corrupt_wavs, tmp_path):
+    index_file = os.fspath(tmp_path / 'index.sqlite')
+    errors = []
+    processed, skipped, removed = fingerprint.update_index(
+        index_file, [os.fspath(library), *corrupt_wavs], jobs=2, on_error=lambda path, message: errors.append(path))
+    assert processed == 3
+    assert sorted(errors) == sorted(os.path.abspath(path) for path in corrupt_wavs)
+
+    db = fingerprint.open_index(index_file)
+    try:
+        assert db.execute('SELECT COUNT(*) FROM files').fetchone()[0] == 3
+    finally:
+        db.close()
+
+
+@pytest.mark.ffmpeg
+def test_mp3_copy_is_duplicate(library, tmp_path):
+    import sound_api
+
+    sound_api.convert_file(os.fspath(library / 'a.wav'), os.fspath(library / 'a.mp3'))
+    index_file = os.fspath(tmp_path / 'index.sqlite')
+    fingerprint.update_index(index_file, [os.fspath(library)], jobs=2)
+    pairs = {frozenset(map(os.path.basename, (d.file_1, d.file_2))) for d in fingerprint.find_duplicates(index_file)}
+    assert frozenset(('a.wav', 'a.mp3')) in pairs
+    assert not any('other.wav' in pair for pair in pairs)
@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import pytest
+
+import batch
+import sound_api
+from conftest import read_wav
+from sound_api import MemoryLimitError, ParameterError
+
+
+@pytest.mark.parametrize('text, size', [
+    ('1048576', 1 << 20), ('512M', 512 << 20), ('2g', 2 << 30), ('1.5K', 1536), ('64MB', 64 << 20),
+])
+def test_parse_size(text, size):
+    assert sound_api.parse_size(text) == size
+
+
+@pytest.mark.parametrize('text', ['', 'M', 'ten', '0', '-1K'])
+def test_parse_size_errors(text):
+    with pytest.raises(ParameterError):
+        sound_api.parse_size(text)
+
+
+def test_load_within_the_budget(make_wav):
+    path = make_wav('a.wav', 1.0)
+    pcm_bytes = 44100 * 2 * 2
+    assert sound_api.estimate_memory(path) == 2 * pcm_bytes
+
+    sound_api.set_max_memory(pcm_bytes)
+    assert not sound_api.fits_in_memory(sound_api.estimate_memory(path))
+    with pytest.raises(MemoryLimitError, match='more than the memory budget'):
+        sound_api.load(path)
+
+    sound_api.set_max_memory(2 * pcm_bytes)
+    assert sound_api.load(path).frames == 44100
+
+
+def test_copy_blocks_follow_the_budget():
+    assert sound_api.copy_block_frames(4) == sound_api.COPY_BLOCK_BYTES // 4
+    sound_api.set_max_memory(4000)
+    assert sound_api.copy_block_frames(4) == 500
+    sound_api.set_max_memory(1)
+    assert sound_api.copy_block_frames(4) == 1
+
+
+def test_streamed_copy_in_a_small_budget(make_wav, tmp_path):
+    source = make_wav('a.wav', 0.5)
+    sound_api.set_max_memory(10000)
+    sound_api.remove_chunks_file(source, os.fspath(tmp_path / 'b.wav'))
+    assert np.array_equal(read_wav(tmp_path / 'b.wav').samples, read_wav(source).samples)
+
+
+def test_block_reader(make_wav):
+    path = make_wav('a.wav', 0.1)
+    whole = sound_api.to_float(read_wav(path))
+    with sound_api.BlockReader(path, block_frames=1000) as reader:
+        blocks = list(reader)
+    assert [len(b) for b in blocks] == [1000] * 4 + [410]
+    assert np.array_equal(np.concatenate(blocks), whole)
+
+    with sound_api.BlockReader(path, block_frames=1000, channels=1, start_frame=4000) as reader:
+        tail = np.concatenate(list(reader))
+    assert tail.shape == (410, 1)
+    assert np.allclose(tail[:, 0], whole[4000:].mean(axis=1))
+
+
+def test_waveform_envelope(make_wav):
+    path = make_wav('a.wav', 0.1)
+    samples = read_wav(path).samples
+    t, lower, upper = sound_api.waveform_envelope(path, points=100)
+    step = -(-len(samples) // 100)
+    assert len(t) == len(lower) == len(upper) == -(-len(samples) // step)
+    assert t[1] == pytest.approx(step / 44100)
+    assert np.array_equal(lower[0], samples[:step].min(axis=0))
+    assert np.array_equal(upper[-1], samples[(len(t) - 1) * step:].max(axis=0))
+
+
+def test_batch_memory_gate(make_wav, tmp_path):
+    source = make_wav('a.wav', 0.2)
+    job = batch.Job('chunk', (source,), os.fspath(tmp_path / 'b.wav'))
+    # the whole PCM of a short file, one block
+    assert batch.footprint(job) == 8820 * 4
+    assert batch.footprint(batch.Job('conv', (source,), 'b.mp3', {'jobs': 3})) == 3 * batch.FFMPEG_MEMORY
+
+    jobs = [batch.Job('chunk', (source,), os.fspath(tmp_path / f'{i}.wav')) for i in range(6)]
+    scheduler = batch.Scheduler(io_jobs=4, max_memory=2 * 8820 * 4)
+    results = scheduler.run(jobs)
+    assert all(r.error is None for r in results)
+    assert scheduler.gate.peak <= 2 * 8820 * 4
+    assert scheduler.gate.reserved == 0
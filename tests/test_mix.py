@@ -0,0 +1,171 @@
+import os
+
+import numpy as np
+import pytest
+
+import mix
+import sound_api
+from conftest import read_wav, tone, write_wav
+from sound_api import FormatError, ParameterError
+
+
+def expected_mix(parts, frames):
+    """
+    float32 sum of (samples, offset frames, dB)
+    """
+    out = np.zeros((frames, parts[0][0].shape[1]), dtype=np.float32)
+    for samples, offset, dB in parts:
+        out[offset:offset + len(samples)] += samples * np.float32(10 ** (dB / 20))
+    return out
+
+
+def test_soft_limit():
+    threshold, width = mix._limit_params(-1.0)
+    ceiling = 10 ** (-1 / 20)
+    assert threshold + width == pytest.approx(ceiling)
+
+    samples = np.linspace(-2.0, 2.0, 4001, dtype=np.float32)[:, np.newaxis]
+    limited = mix.soft_limit(samples.copy(), -1.0)
+    below = np.abs(samples) <= threshold
+    assert np.array_equal(limited[below], samples[below])
+    assert np.abs(limited).max() < ceiling
+    assert (np.diff(limited[:, 0]) >= 0).all()
+
+
+def test_parameters(make_wav, tmp_path):
+    a = make_wav('a.wav', 0.1)
+    destination = os.fspath(tmp_path / 'out.wav')
+    with pytest.raises(ParameterError, match='No source file'):
+        mix.mix_files([], destination)
+    with pytest.raises(ParameterError, match='1 gains for 2 source files'):
+        mix.mix_files([a, a], destination, gains=[1.0])
+    with pytest.raises(ParameterError, match='3 offsets for 2 source files'):
+        mix.mix_files([a, a], destination, offsets=[0, 1, 2])
+    with pytest.raises(ParameterError, match='Offset must not be negative'):
+        mix.mix_files([a, a], destination, offsets=[0, -1])
+    with pytest.raises(ParameterError, match='Channels must be 1 or 2'):
+        mix.mix_files([a], destination, ch=3)
+    with pytest.raises(ParameterError, match='Sampling rate must be positive'):
+        mix.mix_files([a], destination, samrate=0)
+    with pytest.raises(sound_api.SoundFileError, match='Source file 2 does not exist'):
+        mix.mix_files([a, os.fspath(tmp_path / 'missing.wav')], destination)
+    assert not os.path.exists(destination)
+
+
+def test_corrupt_sources(make_wav, corrupt_wavs, tmp_path):
+    a = make_wav('a.wav', 0.1)
+    destination = os.fspath(tmp_path / 'out.wav')
+    for path in corrupt_wavs:
+        with pytest.raises(FormatError, match='Invalid wav data'):
+            mix.mix_files([a, path], destination)
+    assert not os.path.exists(destination)
+
+
+@pytest.mark.parametrize('block_frames', [1000, 4096, mix.BLOCK_FRAMES])
+def test_gains_and_offsets(tmp_path, block_frames):
+    a = tone(0.5, 8000, freq=440.0, amplitude=0.3)
+    b = tone(0.3, 8000, freq=660.0, amplitude=0.3)
+    source_a = write_wav(tmp_path / 'a.wav', a, 8000)
+    source_b = write_wav(tmp_path / 'b.wav', b, 8000)
+    a, b = sound_api.to_float(read_wav(source_a)), sound_api.to_float(read_wav(source_b))
+
+    destination = os.fspath(tmp_path / f'out{block_frames}.wav')
+    # b starts after the end of a, silent in between
+    result = mix.mix_files([source_a, source_b], destination, gains=[-3.0, 2.0], offsets=[0, 750], block_frames=block_frames)
+    assert result.bytes_written == os.path.getsize(destination)
+
+    audio = read_wav(destination)
+    expected = sound_api.from_float(expected_mix([(a, 0, -3.0), (b, 6000, 2.0)], 6000 + len(b)), 8000, 2)
+    assert audio.frames == expected.frames
+    assert np.abs(audio.samples.astype(int) - expected.samples).max() <= 1
+    assert not audio.samples[4000:6000].any()
+
+
+def test_channels_and_resampling(tmp_path):
+    mono = write_wav(tmp_path / 'mono.wav', tone(0.2, 8000, channels=1), 8000)
+    stereo = write_wav(tmp_path / 'stereo.wav', tone(0.1, 16000, channels=2), 16000)
+    destination = os.fspath(tmp_path / 'out.wav')
+    mix.mix_files([mono, stereo], destination, block_frames=500)
+    audio = read_wav(destination)
+    # the channels of the most, the sampling rate of the first
+    assert (audio.channels, audio.frame_rate, audio.frames) == (2, 8000, 1600)
+
+    m = sound_api.to_float(read_wav(mono))
+    s = sound_api.resample(sound_api.to_float(read_wav(stereo)), 16000, 8000)
+    expected = sound_api.from_float(expected_mix([(np.repeat(m, 2, axis=1), 0, 0.0), (s, 0, 0.0)], 1600), 8000, 2)
+    assert np.abs(audio.samples.astype(int) - expected.samples).max() <= 2
+
+    mix.mix_files([mono, stereo], os.fspath(tmp_path / 'mono.out.wav'), ch=1, samrate=16000)
+    audio = read_wav(tmp_path / 'mono.out.wav')
+    assert (audio.channels, audio.frame_rate, audio.frames) == (1, 16000, 3200)
+
+
+def test_clip_and_limit(tmp_path):
+    loud = write_wav(tmp_path / 'a.wav', tone(0.1, 8000, amplitude=0.8), 8000)
+    mix.mix_files([loud, loud], os.fspath(tmp_path / 'clipped.wav'))
+    assert np.abs(read_wav(tmp_path / 'clipped.wav').samples.astype(int)).max() >= 32767
+
+    mix.mix_files([loud, loud], os.fspath(tmp_path / 'limited.wav'), limit=-1.0)
+    samples = read_wav(tmp_path / 'limited.wav').samples
+    assert np.abs(samples.astype(int)).max() <= 32768 * 10 ** (-1 / 20)
+    # the quiet parts are not changed
+    threshold, _ = mix._limit_params(-1.0)
+    quiet = np.abs(read_wav(tmp_path / 'clipped.wav').samples.astype(int)) < threshold * 32768 - 2
+    assert np.abs(samples[quiet].astype(int) - read_wav(tmp_path / 'clipped.wav').samples[quiet]).max() <= 1
+
+
+def test_ffmpeg_graph(make_wav, tmp_path):
+    a = make_wav('a.wav', 0.1, channels=1)
+    b = make_wav('b.wav', 0.1, frame_rate=22050)
+    graph, sample_width = mix.ffmpeg_graph([a, b], gains=[0.0, 6.0], offsets=[0, 100], limit=-1.0)
+    assert sample_width == 2
+    chains = graph.split(';')
+    assert chains[0] == '[0:a]aformat=sample_fmts=flt,pan=stereo|c0=c0|c1=c0,adelay=delays=0S:all=1[a0]'
+    assert 'aresample=44100' in chains[1] and 'volume=' in chains[1] and 'adelay=delays=4410S' in chains[1]
+    assert chains[2].startswith('[a0][a1]amix=inputs=2:duration=longest:dropout_transition=0:normalize=0,aeval=')
+
+
+@pytest.mark.ffmpeg
+@pytest.mark.parametrize('limit', [None, -1.0])
+def test_same_as_ffmpeg(make_wav, tmp_path, limit):
+    a = make_wav('a.wav', 1.0, channels=1, freq=440.0)
+    b = make_wav('b.wav', 0.5, freq=1000.0)
+    destination = os.fspath(tmp_path / 'out.wav')
+    params = dict(gains=[3.0, -2.0], offsets=[0, 700], limit=limit)
+    mix.mix_files([a, b], destination, **params)
+    check = mix.ffmpeg_check([a, b], destination, **params)
+    assert check.ok, check
+    assert not check.resampled and check.frames == check.ffmpeg_frames == 44100 + 4410 * 2
+
+
+@pytest.mark.ffmpeg
+def test_resampled_same_as_ffmpeg(make_wav, tmp_path):
+    a = make_wav('a.wav', 1.0)
+    b = make_wav('b.wav', 1.0, frame_rate=22050, freq=1000.0)
+    destination = os.fspath(tmp_path / 'out.wav')
+    mix.mix_files([a, b], destination, offsets=[0, 250])
+    check = mix.ffmpeg_check([a, b], destination, offsets=[0, 250])
+    assert check.resampled and check.tolerance == 2
+    assert check.snr >= mix.MIN_SNR_DB and check.ok, check
+
+
+def test_mix_check_ok():
+    check = mix.MixCheck(100, 100, 1, 40.0, 0.0, False)
+    assert check.ok
+    check = mix.MixCheck(100, 101, 0, 90.0, 0.0, False)
+    assert not check.ok
+    check = mix.MixCheck(100, 102, 30, mix.MIN_SNR_DB, 0.0, True, tolerance=2)
+    assert check.ok
+    check.snr = mix.MIN_SNR_DB - 1
+    assert not check.ok
+
+
+@pytest.mark.ffmpeg
+def test_mix_command(cli, make_wav, corrupt_wavs, tmp_path):
+    make_wav('a.wav', 0.5)
+    make_wav('b.wav', 0.5, freq=880.0)
+    completed = cli('mix', '--gain', '-3', '--gain', '-3', '--offset', '0', '--offset', '100', '--check-ffmpeg', 'a.wav', 'b.wav', 'c.mp3')
+    assert completed.stderr == ''
+    assert completed.stdout.startswith('Mix: ')
+    assert 'Invalid wav data.' in cli('mix', 'a.wav', 'head.wav', 'd.wav').stderr
+    assert not (tmp_path / 'd.wav').exists()
@@ -0,0 +1,104 @@
+import os
+import struct
+
+import pytest
+
+import parallel_mp3
+import sound_api
+from sound_api import FormatError
+
+# MPEG-1 Layer III, 128 kbps, 44100 Hz, no padding : 417 bytes
+HEADER = 0xFFFB9064
+
+
+def frame(header=HEADER):
+    return struct.pack('>I', header) + bytes(parallel_mp3._frame_size(header) - 4)
+
+
+def test_frame_size():
+    assert parallel_mp3._frame_size(HEADER) == 417
+    assert parallel_mp3._frame_size(HEADER | 0x200) == 418          # padding
+    assert parallel_mp3._frame_size(0x12345678) is None             # no sync
+    assert parallel_mp3._frame_size(HEADER | 0xF000) is None        # bad bitrate
+
+
+def test_scan_frames_stops_at_garbage():
+    buf = frame() * 3 + b'TAG' + bytes(125)
+    frames = parallel_mp3.scan_frames(buf)
+    assert [(f.offset, f.size) for f in frames] == [(0, 417), (417, 417), (834, 417)]
+    # a truncated last frame is not a frame
+    assert len(parallel_mp3.scan_frames(frame() * 2 + frame()[:100])) == 2
+
+
+def test_id3v2_size():
+    assert parallel_mp3.id3v2_size(b'ID3\x04\x00\x00\x00\x00\x01\x00') == 10 + 128
+    assert parallel_mp3.id3v2_size(b'ID3\x04\x00\x10\x00\x00\x00\x10') == 10 + 16 + 10
+    assert parallel_mp3.id3v2_size(frame()[:10]) == 0
+
+
+def test_crc16():
+    # CRC-16/ARC check value
+    assert parallel_mp3._crc16(b'123456789') == 0xBB3D
+
+
+def test_plan_segments():
+    spf = parallel_mp3.samples_per_frame(44100)
+    nframes = 44100 * 100 + 123
+    segments = parallel_mp3.plan_segments(nframes, 44100, 4)
+    assert len(segments) == 3          # 100 sec by MIN_SEGMENT_SEC
+    assert segments[0][0] == 0 and segments[-1][1] == nframes
+    for (_, end), (start, _) in zip(segments, segments[1:]):
+        assert end == start and start % spf == 0
+
+    assert parallel_mp3.plan_segments(44100 * 10, 44100, 8) == [(0, 441000)]
+    assert parallel_mp3.samples_per_frame(22050) == 576
+
+
+def test_encode_corrupt(corrupt_wavs, tmp_path):
+    for path in corrupt_wavs:
+        with pytest.raises(FormatError, match='Invalid wav data'):
+            parallel_mp3.encode(path, os.fspath(tmp_path / 'out.mp3'), 2)
+
+
+@pytest.fixture
+def long_wav(make_wav):
+    # 2 segments of MIN_SEGMENT_SEC at least
+    return make_wav('long.wav', 2 * parallel_mp3.MIN_SEGMENT_SEC + 5, frame_rate=22050, channels=1)
+
+
+@pytest.mark.ffmpeg
+def test_parallel_encode(long_wav, tmp_path):
+    destination = os.fspath(tmp_path / 'long.mp3')
+    result = parallel_mp3.encode(long_wav, destination, 2)
+    assert result.segments == 2
+    # the Xing frame is not an audio frame
+    assert result.frames + 1 == parallel_mp3.count_frames(destination)
+    assert result.bytes_written == os.path.getsize(destination)
+    # no part file is left
+    assert sorted(os.listdir(tmp_path)) == ['long.mp3', 'long.wav']
+
+    # the Xing header counts the stitched stream
+    info = parallel_mp3.estimate_info(destination)
+    assert info.frames == result.frames * 576
+    assert (info.channels, info.frame_rate) == (1, 22050)
+
+    check = parallel_mp3.check_against_serial(long_wav, destination)
+    assert check.source_frames == sound_api.probe(long_wav).frames
+    assert check.ok, check
+
+
+@pytest.mark.ffmpeg
+def test_short_file_is_not_split(make_wav, tmp_path):
+    result = parallel_mp3.encode(make_wav('a.wav', 2.0), os.fspath(tmp_path / 'a.mp3'), 4)
+    assert result.segments == 1
+
+
+@pytest.mark.ffmpeg
+def test_check_serial_option(cli, long_wav):
+    completed = cli('conv', '--check-serial', long_wav, 'a.mp3')
+    assert '--check-serial needs a wav to mp3 conversion with --jobs 2 or more.' in completed.stderr
+    assert not os.path.exists(os.path.join(os.path.dirname(long_wav), 'a.mp3'))
+
+    completed = cli('conv', '--jobs', '2', '--check-serial', long_wav, 'b.mp3')
+    assert 'Error' not in completed.stderr
+    assert os.path.exists(os.path.join(os.path.dirname(long_wav), 'b.mp3'))
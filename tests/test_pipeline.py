@@ -0,0 +1,167 @@
+import os
+
+import numpy as np
+import pytest
+
+import pipeline
+import sound_api
+from conftest import read_wav, tone, write_wav
+from sound_api import FormatError, ParameterError, SoundFileError
+
+
+class Failing(pipeline.Stage):
+    """
+    A stage which fails at its second block
+    """
+    def __init__(self):
+        self.blocks = 0
+
+    def process(self, block, out):
+        self.blocks += 1
+        if self.blocks == 2:
+            raise ValueError('broken stage')
+        out[:len(block)] = block
+        return len(block)
+
+
+def run_stage(stage, samples, frame_rate, block_frames):
+    channels, samrate = stage.setup(samples.shape[1], frame_rate)
+    out = np.zeros((stage.max_frames(block_frames), channels), dtype=np.float32)
+    blocks = []
+    for start in range(0, len(samples), block_frames):
+        frames = stage.process(samples[start:start + block_frames], out)
+        blocks.append(out[:frames].copy())
+    blocks.append(out[:stage.flush(out)].copy())
+    return np.concatenate(blocks), samrate
+
+
+def test_ring_buffer():
+    context = pipeline._context()
+    ring = pipeline.RingBuffer(context, context.Event(), 2, block_frames=4, slots=2)
+    # a copy attaches to the same shared memory, as in a child process
+    reader = pipeline.RingBuffer.__new__(pipeline.RingBuffer)
+    reader.__setstate__(ring.__getstate__())
+    try:
+        for value in (1, 2):
+            slot = ring.reserve()
+            slot[:3] = value
+            ring.commit(3)
+        block = reader.receive()
+        assert block.shape == (3, 2) and (block == 1).all()
+        reader.release()
+
+        # the released slot is written again
+        ring.reserve()[:] = 3
+        ring.commit(4)
+        assert (reader.receive() == 2).all()
+        reader.release()
+        assert reader.receive().shape == (4, 2)
+        reader.release()
+        ring.end()
+        assert reader.receive() is None
+    finally:
+        reader.close()
+        ring.close()
+
+
+def test_ring_buffer_abort():
+    context = pipeline._context()
+    abort = context.Event()
+    ring = pipeline.RingBuffer(context, abort, 1, block_frames=4, slots=1)
+    try:
+        abort.set()
+        with pytest.raises(pipeline.Aborted):
+            ring.receive()
+        ring.reserve()
+        ring.commit(1)
+        # no free slot
+        with pytest.raises(pipeline.Aborted):
+            ring.reserve()
+    finally:
+        ring.close()
+
+
+def test_stage_parameters():
+    with pytest.raises(ParameterError):
+        pipeline.Channels(3)
+    with pytest.raises(ParameterError):
+        pipeline.Resample(0)
+
+
+def test_gain_and_channels():
+    samples = tone(0.01, 8000)
+    louder, _ = run_stage(pipeline.Gain(6), samples, 8000, 32)
+    assert np.allclose(louder, samples * 10 ** (6 / 20))
+
+    mono, _ = run_stage(pipeline.Channels(1), samples, 8000, 32)
+    assert np.allclose(mono[:, 0], samples.mean(axis=1))
+    stereo, _ = run_stage(pipeline.Channels(2), mono, 8000, 32)
+    assert np.array_equal(stereo, np.repeat(mono, 2, axis=1))
+
+
+@pytest.mark.parametrize('frame_rate, samrate', [(44100, 48000), (48000, 22050), (8000, 16000)])
+def test_resample_independent_of_blocks(frame_rate, samrate):
+    samples = tone(0.3, frame_rate)
+    whole = sound_api.resample(samples, frame_rate, samrate)
+    for block_frames in (1000, 4096, len(samples)):
+        out, rate = run_stage(pipeline.Resample(samrate), samples, frame_rate, block_frames)
+        assert rate == samrate
+        assert len(out) == -(-len(samples) * samrate // frame_rate)
+        assert np.allclose(out[:len(whole)], whole, atol=1e-6)
+
+
+def test_chain_wav(make_wav, tmp_path):
+    source = make_wav('a.wav', 1.0)
+    destination = os.fspath(tmp_path / 'b.wav')
+    result = pipeline.chain_file(source, destination, dB=-6, ch=1, samrate=22050, block_frames=4096)
+    assert result.bytes_written == os.path.getsize(destination)
+
+    expected = sound_api.change_volume(source, -6)
+    expected = sound_api.change_samrate(sound_api.change_channels(expected, 1), 22050)
+    audio = read_wav(destination)
+    assert (audio.channels, audio.frame_rate) == (1, 22050)
+    assert abs(audio.frames - expected.frames) <= 1
+    # the in-memory operations round to 16 bits between the steps
+    frames = min(audio.frames, expected.frames)
+    assert np.abs(audio.samples[:frames].astype(int) - expected.samples[:frames]).max() <= 2
+
+
+def test_chain_errors(make_wav, corrupt_wavs, tmp_path):
+    source = make_wav('a.wav', 0.1)
+    with pytest.raises(ParameterError, match='No operation'):
+        pipeline.chain_file(source, os.fspath(tmp_path / 'b.wav'))
+    with pytest.raises(sound_api.DestinationExistsError):
+        pipeline.chain_file(source, source, dB=1)
+    for path in corrupt_wavs:
+        with pytest.raises(FormatError, match='Invalid wav data'):
+            pipeline.chain_file(path, os.fspath(tmp_path / 'b.wav'), dB=1)
+    assert not (tmp_path / 'b.wav').exists()
+
+
+def test_failed_stage_stops_the_pipeline(tmp_path):
+    source = write_wav(tmp_path / 'a.wav', tone(1.0, 8000), 8000)
+    destination = os.fspath(tmp_path / 'b.wav')
+    with pytest.raises(SoundFileError, match='ValueError: broken stage'):
+        pipeline.run(source, destination, [pipeline.Gain(1), Failing()], block_frames=1000)
+    assert sorted(os.listdir(tmp_path)) == ['a.wav']
+
+
+@pytest.mark.ffmpeg
+def test_chain_mp3(make_wav, tmp_path):
+    source = make_wav('a.wav', 1.0)
+    mp3 = os.fspath(tmp_path / 'a.mp3')
+    pipeline.chain_file(source, mp3, dB=-3, ch=1)
+    info = sound_api.probe(mp3)
+    assert (info.channels, info.frame_rate) == (1, 44100)
+
+    destination = os.fspath(tmp_path / 'b.wav')
+    pipeline.chain_file(mp3, destination, samrate=22050)
+    assert sound_api.probe(destination).frame_rate == 22050
+
+
+def test_chain_command(cli, make_wav, tmp_path):
+    make_wav('a.wav', 0.2)
+    completed = cli('chain', '--dB', '-6', '--ch', '1', 'a.wav', 'b.wav')
+    assert completed.stderr == ''
+    assert sound_api.probe(tmp_path / 'b.wav').channels == 1
+    assert 'No operation is specified.' in cli('chain', 'a.wav', 'c.wav').stderr
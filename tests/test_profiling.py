@@ -0,0 +1,114 @@
+import io
+import json
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import profiling
+
+
+def test_nested_phases():
+    profiler = profiling.Profiler()
+
+    def outer():
+        return profiler.run('inner', 'function', lambda: 42, (), {})
+
+    assert profiler.run('outer', 'job', outer, (), {}) == 42
+    records = {r.name: r for r in profiler.records}
+    assert records['outer'].depth == 0
+    assert records['inner'].depth == 1
+    assert records['outer'].wall >= records['inner'].wall
+    assert not profiler._active
+
+
+def test_error_is_recorded_and_raised():
+    profiler = profiling.Profiler()
+
+    def fail():
+        raise ValueError('broken')
+
+    with pytest.raises(ValueError):
+        profiler.run('fail', 'function', fail, (), {})
+    assert profiler.records[0].error == 'ValueError: broken'
+    assert not profiler._stack()
+
+
+def test_io_shared_marks_overlapping_threads_only():
+    profiler = profiling.Profiler()
+    started = threading.Event()
+
+    def long_phase():
+        started.set()
+        time.sleep(0.2)
+
+    thread = threading.Thread(target=profiler.run, args=('long', 'function', long_phase, (), {}))
+    thread.start()
+    started.wait()
+    profiler.run('overlapped', 'function', time.sleep, (0.01,), {})
+    thread.join()
+    profiler.run('alone', 'function', time.sleep, (0.01,), {})
+
+    shared = {r.name: r.io_shared for r in profiler.records}
+    assert shared == {'long': True, 'overlapped': True, 'alone': False}
+
+    out = io.StringIO()
+    profiler.summary(file=out)
+    assert 'process-wide' in out.getvalue()
+    assert '* phases of other threads' in out.getvalue()
+
+
+def test_nested_phases_of_one_thread_are_not_shared():
+    profiler = profiling.Profiler()
+    profiler.run('outer', 'job', profiler.run, ('inner', 'function', time.sleep, (0.01,), {}), {})
+    assert not any(r.io_shared for r in profiler.records)
+
+
+def test_subprocesses_are_counted():
+    profiler = profiling.Profiler()
+    profiler.start()
+    try:
+        command = [sys.executable, '-c', 'pass']
+        profiler.run('two', 'function', lambda: [subprocess.run(command) for _ in range(2)], (), {})
+    finally:
+        profiler.stop()
+    assert profiler.records[0].subprocesses == 2
+    assert subprocess.Popen.__name__ == 'Popen'
+
+
+def test_trace_events(tmp_path):
+    profiler = profiling.Profiler()
+    profiler.run('phase', 'function', time.sleep, (0.01,), {})
+    trace_file = tmp_path / 'trace.json'
+    profiler.write_trace(trace_file)
+
+    events = json.loads(trace_file.read_text())['traceEvents']
+    assert len(events) == 1
+    event = events[0]
+    assert event['ph'] == 'X' and event['name'] == 'phase'
+    assert event['dur'] >= 10000
+    assert event['args']['io_scope'] == 'process'
+    assert event['args']['io_shared'] is False
+
+
+def test_instrument_wraps_once():
+    profiler = profiling.Profiler()
+    namespace = {'work': lambda x: x * 2, 'other': None}
+    profiling.instrument(profiler, namespace, ['work', 'other', 'missing'])
+    wrapped = namespace['work']
+    profiling.instrument(profiler, namespace, ['work'])
+    assert namespace['work'] is wrapped
+    assert namespace['work'](3) == 6
+    assert [r.name for r in profiler.records] == ['work']
+
+
+@pytest.mark.ffmpeg
+def test_profile_option(cli, make_wav, tmp_path):
+    source = make_wav('a.wav', 0.5)
+    completed = cli('--profile', '--trace-json', 'trace.json', 'vol', '--dB', '-3', source, 'b.wav')
+    assert completed.returncode == 0
+    assert 'vol' in completed.stderr
+    events = json.loads((tmp_path / 'trace.json').read_text())['traceEvents']
+    assert any(event['cat'] == 'subprocess' for event in events)
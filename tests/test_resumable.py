@@ -0,0 +1,148 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import resumable
+import sound_api
+from conftest import read_wav
+from sound_api import FormatError
+
+
+@pytest.mark.parametrize('operation, source, destination, segment_sec, resume, expected', [
+    ('samrate', 'a.wav', 'b.wav', None, False, False),
+    ('samrate', 'a.wav', 'b.wav', None, True, True),
+    ('samrate', 'a.wav', 'b.wav', 60, False, True),
+    ('samrate', 'a.wav', 'b.wav', 0, True, False),
+    ('conv', 'a.wav', 'b.mp3', 60, False, True),
+    ('conv', 'a.mp3', 'b.wav', None, True, True),
+    ('samrate', 'a.mp3', 'b.mp3', 60, True, False),
+    ('vol', 'a.wav', 'b.wav', 60, True, False),
+])
+def test_applies(operation, source, destination, segment_sec, resume, expected):
+    assert resumable.applies(operation, source, destination, segment_sec, resume) is expected
+
+
+def test_bounds():
+    assert resumable._bounds(10, 3, 4) == [(0, 3), (3, 6), (6, 9), (9, 10)]
+    assert resumable._bounds(10, 4, 1) == [(0, 4), (4, 8), (8, 10)]
+    assert resumable._bounds(0, 4, 8) == []
+
+
+def test_checkpoint(tmp_path):
+    destination = os.fspath(tmp_path / 'out.wav')
+    job = {'operation': 'test', 'segments': [[0, 1], [1, 2]]}
+    checkpoint = resumable.Checkpoint(destination, job).load()
+    assert os.path.isdir(tmp_path / '.out.wav.resume')
+    for index in range(2):
+        part_file = checkpoint.part(index, '.pcm')
+        with open(part_file + '.tmp', 'wb') as f:
+            f.write(bytes(10 + index))
+        checkpoint.complete(index, part_file, 0, None)
+    state = json.loads(open(checkpoint.path).read())
+    assert [record['bytes'] for record in state['done']] == [10, 11]
+
+    # resume keeps the parts of the same job
+    assert resumable.Checkpoint(destination, job).load(resume=True).resumed == 2
+
+    # a part of another size is done again
+    with open(checkpoint.part(1, '.pcm'), 'ab') as f:
+        f.write(b'x')
+    assert sorted(resumable.Checkpoint(destination, job).load(resume=True).done) == [0]
+
+    # another job starts over
+    other = resumable.Checkpoint(destination, {**job, 'operation': 'other'}).load(resume=True)
+    assert other.resumed == 0 and os.listdir(other.directory) == []
+
+
+def test_plain_run_starts_over(tmp_path):
+    destination = os.fspath(tmp_path / 'out.wav')
+    checkpoint = resumable.Checkpoint(destination, {'job': 1}).load()
+    part_file = checkpoint.part(0, '.pcm')
+    with open(part_file + '.tmp', 'wb') as f:
+        f.write(b'data')
+    checkpoint.complete(0, part_file, 0, None)
+
+    checkpoint = resumable.Checkpoint(destination, {'job': 1}).load(resume=False)
+    assert checkpoint.resumed == 0 and os.listdir(checkpoint.directory) == []
+
+
+def test_corrupt_source(corrupt_wavs, tmp_path):
+    for path in corrupt_wavs:
+        with pytest.raises(FormatError, match='Invalid wav data'):
+            resumable.change_samrate(path, os.fspath(tmp_path / 'out.wav'), 22050, segment_sec=1)
+        with pytest.raises(FormatError, match='Invalid wav data'):
+            resumable.encode(path, os.fspath(tmp_path / 'out.mp3'), segment_sec=1)
+
+
+@pytest.mark.ffmpeg
+def test_samrate_resumes_after_interruption(monkeypatch, make_wav, tmp_path):
+    source = make_wav('a.wav', 5.0)
+    expected = os.fspath(tmp_path / 'expected.wav')
+    resumable.change_samrate(source, expected, 48000, segment_sec=1)
+    samples = read_wav(expected).samples
+    assert samples.shape == (240000, 2)
+    assert not os.path.exists(resumable.work_directory(expected))
+
+    # close to a single resampling of the whole file
+    sound_api.change_samrate_file(source, os.fspath(tmp_path / 'single.wav'), 48000)
+    single = read_wav(tmp_path / 'single.wav').samples
+    assert np.abs(samples.astype(int) - single).max() <= 2
+
+    resample_segment = resumable._resample_segment
+    calls = []
+
+    def interrupted(*args):
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        calls.append(args)
+        resample_segment(*args)
+
+    destination = os.fspath(tmp_path / 'b.wav')
+    monkeypatch.setattr(resumable, '_resample_segment', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        resumable.change_samrate(source, destination, 48000, segment_sec=1)
+    monkeypatch.setattr(resumable, '_resample_segment', resample_segment)
+    assert not os.path.exists(destination)
+    assert os.path.exists(resumable.work_directory(destination))
+
+    checkpoint = resumable.change_samrate(source, destination, 48000, segment_sec=1, resume=True)
+    assert checkpoint.resumed == 2
+    assert np.array_equal(read_wav(destination).samples, samples)
+    assert not os.path.exists(resumable.work_directory(destination))
+
+
+@pytest.mark.ffmpeg
+def test_encode_by_segments(make_wav, tmp_path):
+    import parallel_mp3
+
+    source = make_wav('a.wav', 5.0, frame_rate=22050, channels=1)
+    destination = os.fspath(tmp_path / 'a.mp3')
+    resumable.encode(source, destination, jobs=2, segment_sec=1)
+    check = parallel_mp3.check_against_serial(source, destination)
+    assert check.ok, check
+
+
+@pytest.mark.ffmpeg
+def test_decode_by_segments(make_wav, tmp_path):
+    source = make_wav('a.wav', 3.0)
+    mp3 = os.fspath(tmp_path / 'a.mp3')
+    sound_api.convert_file(source, mp3)
+    sound_api.convert_file(mp3, os.fspath(tmp_path / 'single.wav'))
+
+    destination = os.fspath(tmp_path / 'b.wav')
+    resumable.decode(mp3, destination, segment_sec=1)
+    assert np.array_equal(read_wav(destination).samples, read_wav(tmp_path / 'single.wav').samples)
+
+    # a rerun with resume of a finished job has no checkpoint, it starts over
+    checkpoint = resumable.decode(mp3, destination, overwrite=True, segment_sec=1, resume=True)
+    assert checkpoint.resumed == 0
+
+
+@pytest.mark.ffmpeg
+def test_resume_option(cli, make_wav, tmp_path):
+    make_wav('a.wav', 3.0)
+    completed = cli('samrate', '--samrate', '22050', '--segment', '1', '--resume', 'a.wav', 'b.wav')
+    assert completed.stderr == ''
+    assert sound_api.probe(tmp_path / 'b.wav').frames == 66150
@@ -0,0 +1,186 @@
+import io
+
+import numpy as np
+import pytest
+
+import sound_api
+from conftest import read_wav, tone
+from sound_api import (Audio, DestinationExistsError, FormatError, ParameterError, SourceNotFoundError)
+
+
+def test_load_numpy_float_and_int():
+    audio = sound_api.load(tone(0.1, 8000, 1), frame_rate=8000)
+    assert (audio.frames, audio.channels, audio.frame_rate, audio.sample_width) == (800, 1, 8000, 2)
+    assert audio.samples.dtype == np.int16
+
+    ints = sound_api.load(np.arange(10, dtype=np.int32), frame_rate=8000, sample_width=3)
+    assert ints.samples.shape == (10, 1) and ints.samples.dtype == np.int32
+
+
+@pytest.mark.parametrize('kwargs, message', [
+    ({}, 'frame_rate is required'),
+    ({'frame_rate': 8000, 'sample_width': 5}, 'Unsupported sample width'),
+])
+def test_load_numpy_errors(kwargs, message):
+    with pytest.raises(ParameterError, match=message):
+        sound_api.load(np.zeros(10, dtype=np.float32), **kwargs)
+
+
+def test_load_numpy_wrong_shape():
+    with pytest.raises(ParameterError):
+        sound_api.load(np.zeros((2, 2, 2)), frame_rate=8000)
+
+
+def test_load_path_bytes_and_file_object(make_wav):
+    path = make_wav('a.wav', 0.2)
+    from_path = sound_api.load(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert np.array_equal(sound_api.load(data, format='.wav').samples, from_path.samples)
+    assert np.array_equal(sound_api.load(io.BytesIO(data), format='.wav').samples, from_path.samples)
+    with open(path, 'rb') as f:
+        assert np.array_equal(sound_api.load(f).samples, from_path.samples)
+
+
+def test_load_errors(tmp_path):
+    with pytest.raises(SourceNotFoundError):
+        sound_api.load(tmp_path / 'missing.wav')
+    with pytest.raises(FormatError, match='format is required'):
+        sound_api.load(b'RIFF')
+    (tmp_path / 'a.ogg').write_bytes(b'OggS')
+    with pytest.raises(FormatError):
+        sound_api.load(tmp_path / 'a.ogg')
+
+
+def test_corrupt_wav_is_format_error(corrupt_wavs):
+    for path in corrupt_wavs:
+        with pytest.raises(FormatError, match='Invalid wav data'):
+            sound_api.load(path)
+        with pytest.raises(FormatError, match='Invalid wav data'):
+            sound_api.probe(path)
+
+
+@pytest.mark.parametrize('sample_width', [1, 2, 3, 4])
+def test_wav_round_trip(tmp_path, sample_width):
+    audio = sound_api.from_float(tone(0.05, 8000), 8000, sample_width)
+    size = sound_api.save(audio, tmp_path / 'a.wav')
+    assert size == (tmp_path / 'a.wav').stat().st_size
+    loaded = sound_api.load(tmp_path / 'a.wav')
+    assert loaded.sample_width == sample_width
+    assert np.array_equal(loaded.samples, audio.samples)
+    assert np.array_equal(sound_api.load(sound_api.to_bytes(audio), format='.wav').samples, audio.samples)
+
+
+def test_save_errors(tmp_path):
+    audio = sound_api.from_float(tone(0.01, 8000), 8000, 2)
+    sound_api.save(audio, tmp_path / 'a.wav')
+    with pytest.raises(DestinationExistsError):
+        sound_api.save(audio, tmp_path / 'a.wav')
+    sound_api.save(audio, tmp_path / 'a.wav', overwrite=True)
+    with pytest.raises(FormatError):
+        sound_api.save(audio, io.BytesIO())
+    with pytest.raises(FormatError):
+        sound_api.save(audio, tmp_path / 'a.flac')
+
+
+def test_change_volume():
+    audio = sound_api.from_float(tone(0.1, 8000, amplitude=0.5), 8000, 2)
+    quieter = sound_api.change_volume(audio, -6.0206)
+    assert np.allclose(quieter.samples, audio.samples / 2, atol=1)
+
+
+def test_change_channels():
+    stereo = sound_api.from_float(tone(0.1, 8000), 8000, 2)
+    mono = sound_api.change_channels(stereo, 1)
+    assert mono.channels == 1
+    assert sound_api.change_channels(mono, 2).channels == 2
+    with pytest.raises(ParameterError, match='already monaural'):
+        sound_api.change_channels(mono, 1)
+    with pytest.raises(ParameterError):
+        sound_api.change_channels(stereo, 3)
+
+
+def test_clip_and_join():
+    audio = sound_api.from_float(tone(1.0, 8000), 8000, 2)
+    head = sound_api.clip(audio, end=250)
+    tail = sound_api.clip(audio, start=250)
+    assert (head.frames, tail.frames) == (2000, 6000)
+    assert np.array_equal(sound_api.join(head, tail).samples, audio.samples)
+    assert sound_api.clip(audio, start=-100).frames == 800
+
+    with pytest.raises(ParameterError, match='same as original'):
+        sound_api.clip(audio)
+    with pytest.raises(ParameterError, match='later than'):
+        sound_api.clip(audio, start=500, end=400)
+    with pytest.raises(ParameterError, match='out of range'):
+        sound_api.clip(audio, end=2000)
+    with pytest.raises(FormatError):
+        sound_api.join(audio, sound_api.change_channels(audio, 1))
+
+
+def test_change_samrate():
+    audio = sound_api.from_float(tone(0.5, 44100, freq=1000), 44100, 2)
+    resampled = sound_api.change_samrate(audio, 48000)
+    assert resampled.frame_rate == 48000
+    assert resampled.frames == 24000
+    expected = sound_api.from_float(tone(0.5, 48000, freq=1000), 48000, 2)
+    # the edges are the transients of the filter
+    middle = slice(1000, -1000)
+    assert np.abs(resampled.samples[middle].astype(int) - expected.samples[middle]).max() <= 2
+
+    with pytest.raises(ParameterError, match='already the same'):
+        sound_api.change_samrate(audio, 44100)
+    with pytest.raises(ParameterError):
+        sound_api.change_samrate(audio, 0)
+
+
+def test_error_message():
+    assert sound_api.error_message(FormatError('Bad.')) == 'Bad.'
+    assert sound_api.error_message(ValueError('bad value')) == 'ValueError: bad value'
+    assert sound_api.error_message(RuntimeError()) == 'RuntimeError'
+
+
+def test_remove_chunks_file(make_wav, tmp_path):
+    source = make_wav('a.wav', 0.2)
+    result = sound_api.remove_chunks_file(source, tmp_path / 'b.wav')
+    assert result.operation == 'chunk'
+    assert result.bytes_written == (tmp_path / 'b.wav').stat().st_size
+    assert np.array_equal(read_wav(tmp_path / 'b.wav').samples, read_wav(source).samples)
+    with pytest.raises(DestinationExistsError):
+        sound_api.remove_chunks_file(source, tmp_path / 'b.wav')
+
+
+def test_remove_chunks_file_corrupt(corrupt_wavs, tmp_path):
+    for path in corrupt_wavs:
+        with pytest.raises(FormatError, match='Invalid wav data'):
+            sound_api.remove_chunks_file(path, tmp_path / 'out.wav')
+        # the temporary output is removed
+        assert not list(tmp_path.glob('.out.*'))
+        assert not (tmp_path / 'out.wav').exists()
+
+
+@pytest.mark.ffmpeg
+def test_file_operations(make_wav, tmp_path):
+    source = make_wav('a.wav', 1.0)
+    sound_api.change_volume_file(source, tmp_path / 'vol.wav', -6)
+    sound_api.change_channels_file(source, tmp_path / 'mono.wav', 1)
+    assert sound_api.probe(tmp_path / 'mono.wav').channels == 1
+    sound_api.clip_file(source, tmp_path / 'clip.wav', 0, 500)
+    assert sound_api.get_length(tmp_path / 'clip.wav') == 500
+    sound_api.join_files(source, tmp_path / 'clip.wav', tmp_path / 'join.wav')
+    assert sound_api.get_length(tmp_path / 'join.wav') == 1500
+    sound_api.change_samrate_file(source, tmp_path / 'rate.wav', 22050)
+    assert sound_api.probe(tmp_path / 'rate.wav').frame_rate == 22050
+
+    result = sound_api.convert_file(source, tmp_path / 'a.mp3')
+    assert result.bytes_written > 0
+    assert sound_api.probe(tmp_path / 'a.mp3').channels == 2
+
+    with pytest.raises(FormatError, match='same format'):
+        sound_api.convert_file(source, tmp_path / 'b.wav')
+    with pytest.raises(FormatError, match='different format'):
+        sound_api.change_volume_file(source, tmp_path / 'vol.mp3', -6)
+    with pytest.raises(ParameterError, match='already stereo'):
+        sound_api.change_channels_file(source, tmp_path / 'stereo.wav', 2)
+    with pytest.raises(SourceNotFoundError):
+        sound_api.clip_file(tmp_path / 'missing.wav', tmp_path / 'c.wav', 0, 100)
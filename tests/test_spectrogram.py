@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import pytest
+
+import spectrogram
+from sound_api import DestinationExistsError, FormatError, ParameterError
+
+
+def test_column_reducer_bounded():
+    reducer = spectrogram.ColumnReducer(width=8, height=3)
+    for _ in range(100):
+        reducer.add(np.ones((97, 3)))
+    assert reducer.columns.shape == (16, 3)
+    result = reducer.result()
+    assert result.shape == (8, 3)
+    assert np.allclose(result, 1.0)
+
+
+def test_column_reducer_average():
+    reducer = spectrogram.ColumnReducer(width=4, height=1)
+    reducer.add(np.arange(16, dtype=np.float64)[:, np.newaxis])
+    # 16 frames -> merged to 2 frames per column, then resampled to 4 columns
+    assert reducer.result()[:, 0].tolist() == pytest.approx([1.5, 5.5, 9.5, 13.5])
+
+
+def test_column_reducer_short_input():
+    reducer = spectrogram.ColumnReducer(width=10, height=2)
+    reducer.add(np.ones((3, 2)))
+    assert reducer.result().shape == (3, 2)
+
+
+@pytest.mark.parametrize('scale', spectrogram.SCALES)
+def test_filterbank(scale):
+    matrix = spectrogram.filterbank(512, 8000, 40, scale)
+    assert matrix.shape == (257, 40)
+    # every band takes at least a bin
+    assert (matrix.sum(axis=0) > 0).all()
+
+
+def test_filterbank_invalid_scale():
+    with pytest.raises(ParameterError):
+        spectrogram.filterbank(512, 8000, 40, 'bark')
+
+
+def test_compute_peak(make_wav):
+    source = make_wav('a.wav', 2.0, frame_rate=8000, freq=1000.0)
+    db, duration_ms = spectrogram.compute(source, width=50, height=40, scale='linear', n_fft=512, block_frames=1000)
+    assert db.shape == (40, 50)
+    assert duration_ms == 2000
+    # linear bands of 4000 / 41 Hz, 1 kHz is around the band 9
+    assert abs(int(np.median(db.argmax(axis=0))) - 9) <= 1
+    assert db.max() - db.min() <= spectrogram.DYNAMIC_RANGE_DB + 1e-3
+
+
+def test_compute_block_size_independent(make_wav):
+    source = make_wav('a.wav', 1.0, frame_rate=8000, freq=500.0)
+    a, _ = spectrogram.compute(source, width=20, height=16, n_fft=256, block_frames=777)
+    b, _ = spectrogram.compute(source, width=20, height=16, n_fft=256, block_frames=1 << 16)
+    assert np.allclose(a, b, atol=1e-3)
+
+
+@pytest.mark.parametrize('kwargs', [{'width': 0}, {'height': -1}, {'n_fft': 8}])
+def test_compute_parameter_errors(make_wav, kwargs):
+    with pytest.raises(ParameterError):
+        spectrogram.compute(make_wav('a.wav', 0.1), **kwargs)
+
+
+def test_spectrogram_file(make_wav, tmp_path):
+    source = make_wav('a.wav', 0.5, frame_rate=8000)
+    result = spectrogram.spectrogram_file(source, os.fspath(tmp_path / 'a.npy'), width=30, height=20, n_fft=256)
+    assert (result.width, result.height, result.duration_ms) == (30, 20, 500)
+    assert np.load(tmp_path / 'a.npy').shape == (20, 30)
+
+    spectrogram.spectrogram_file(source, os.fspath(tmp_path / 'a.png'), width=30, height=20, n_fft=256)
+    from matplotlib import image
+    assert image.imread(tmp_path / 'a.png').shape[:2] == (20, 30)
+
+    with pytest.raises(DestinationExistsError):
+        spectrogram.spectrogram_file(source, os.fspath(tmp_path / 'a.npy'))
+    with pytest.raises(FormatError):
+        spectrogram.spectrogram_file(source, os.fspath(tmp_path / 'a.jpg'))
+
+
+def test_spectrogram_files_corrupt(make_wav, corrupt_wavs, tmp_path):
+    output_dir = os.fspath(tmp_path / 'out')
+    make_wav('good.wav', 0.5, frame_rate=8000)
+    results = list(spectrogram.spectrogram_files([os.fspath(tmp_path)], output_dir, '.npy', jobs=2, width=10, height=8, n_fft=256))
+    errors = [error for _, error in results if error is not None]
+    assert len(errors) == len(corrupt_wavs)
+    assert all('Invalid wav data' in error for error in errors)
+    done = sorted(os.path.basename(result.destination) for result, _ in results if result is not None)
+    assert done == ['good_spectrogram.npy', 'whole_spectrogram.npy']
@@ -0,0 +1,127 @@
+import os
+import struct
+
+import numpy as np
+import pytest
+
+import remove_chunk
+import tags
+from conftest import read_wav
+from sound_api import FormatError, ParameterError
+
+
+def chunk_ids(path):
+    with open(path, 'rb') as f:
+        return [chunk.chunk_id for chunk in remove_chunk.read_chunks(f)]
+
+
+def test_wav_tags_keep_the_audio(make_wav):
+    path = make_wav('a.wav', 0.2)
+    samples = read_wav(path).samples
+
+    assert tags.write_tags(path, {'title': 'Song A', 'artist': 'Someone'}) == ['append']
+    assert tags.read_tags(path) == {'title': 'Song A', 'artist': 'Someone'}
+    assert chunk_ids(path) == [b'fmt ', b'data', b'LIST']
+
+    # same size, over the old chunk
+    assert tags.write_tags(path, {'title': 'Song B'}) == ['in place']
+    assert tags.read_tags(path) == {'title': 'Song B', 'artist': 'Someone'}
+
+    # removed, the chunk is left as a padding
+    assert tags.write_tags(path, {'title': None, 'artist': None}) == ['in place']
+    assert tags.read_tags(path) == {}
+    assert chunk_ids(path)[-1] == b'JUNK'
+
+    # a new chunk reuses the padding
+    size = os.path.getsize(path)
+    assert tags.write_tags(path, {'INAM': 'x'}) == ['in place']
+    assert os.path.getsize(path) == size
+    assert tags.read_tags(path) == {'title': 'x'}
+
+    assert np.array_equal(read_wav(path).samples, samples)
+
+
+def test_wav_truncated_is_rewritten(make_wav):
+    path = make_wav('a.wav', 0.2)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 100)
+    samples = read_wav(path).samples
+
+    assert tags.write_tags(path, {'title': 'T'}) == ['rewrite']
+    # the new chunk and a padding are placed before the data
+    assert chunk_ids(path) == [b'fmt ', b'LIST', b'JUNK', b'data']
+    assert tags.read_tags(path) == {'title': 'T'}
+    assert np.array_equal(read_wav(path).samples, samples)
+
+
+def test_bext(make_wav):
+    path = make_wav('a.wav', 0.1)
+    tags.write_tags(path, {'bext.description': 'Take 1', 'bext.time_reference': '48000'})
+    assert tags.read_tags(path) == {'bext.description': 'Take 1', 'bext.time_reference': '48000'}
+
+    with pytest.raises(ParameterError, match='number of samples'):
+        tags.write_tags(path, {'bext.time_reference': 'noon'})
+    with pytest.raises(ParameterError, match='Unknown tag name'):
+        tags.write_tags(path, {'bext.nothing': 'x'})
+
+
+def test_tag_name_errors(make_wav):
+    path = make_wav('a.wav', 0.1)
+    with pytest.raises(ParameterError, match='Unknown tag name'):
+        tags.write_tags(path, {'mood': 'x'})
+    with pytest.raises(ParameterError, match='read only'):
+        tags.write_tags(path, {'id3v1.title': 'x'})
+
+
+def test_corrupt_wav_tags(corrupt_wavs):
+    truncated, not_riff, head = corrupt_wavs
+    with pytest.raises(FormatError, match='FourCC'):
+        tags.read_tags(not_riff)
+    # the truncated chunks are not the data chunk, a rewrite would lose the new tags
+    for path in (truncated, head):
+        data = open(path, 'rb').read()
+        with pytest.raises(FormatError, match='chunk is truncated'):
+            tags.write_tags(path, {'title': 'x'})
+        assert open(path, 'rb').read() == data
+
+
+# MPEG-1 Layer III frames of 417 bytes, tags do not need decodable audio
+FRAMES = (struct.pack('>I', 0xFFFB9064) + bytes(413)) * 5
+
+
+def test_mp3_tags_keep_the_audio(tmp_path):
+    path = tmp_path / 'a.mp3'
+    path.write_bytes(FRAMES)
+
+    # a new ID3v2 tag moves the audio, later edits fit in its padding
+    assert tags.write_tags(path, {'title': 'Song', 'date': '2024'}) == ['rewrite']
+    assert tags.read_tags(path) == {'title': 'Song', 'date': '2024'}
+    assert tags.write_tags(path, {'title': 'Other song', 'track': '3/9'}) == ['in place']
+    assert tags.read_tags(path) == {'title': 'Other song', 'date': '2024', 'track': '3/9'}
+
+    # ID3v1 gets the changed fields only
+    assert tags.write_tags(path, {'title': 'Other song', 'track': '3', 'genre': 'Jazz'}, id3v1=True) == ['in place', 'append']
+    read = tags.read_tags(path)
+    assert (read['id3v1.title'], read['id3v1.track'], read['id3v1.genre'], 'id3v1.date' in read) == ('Other song', '3', 'Jazz', False)
+    # an existing ID3v1 tag is always updated
+    assert tags.write_tags(path, {'title': None}) == ['in place', 'in place']
+    assert 'title' not in tags.read_tags(path)
+
+    data = path.read_bytes()
+    assert data[-128:-125] == b'TAG'
+    assert data[-128 - len(FRAMES):-128] == FRAMES
+
+
+def test_mp3_comment_with_description_is_kept(tmp_path):
+    import id3
+
+    path = tmp_path / 'a.mp3'
+    path.write_bytes(FRAMES)
+    app_data = id3.Id3Frame(b'COMM', 0, b'\x03eng' + b'iTunNORM\x00' + b' 0000')
+    id3.write_id3v2(path, id3.Id3Tag(4, [app_data]))
+
+    tags.write_tags(path, {'comment': 'Hello'})
+    with open(path, 'rb') as f:
+        frames = id3.read_id3v2(f).frames
+    assert app_data in frames
+    assert tags.read_tags(path) == {'comment': 'Hello'}
@@ -0,0 +1,109 @@
+import os
+import struct
+
+import pytest
+
+import sound_api
+import tags
+import verify
+
+FRAME = struct.pack('>I', 0xFFFB9064) + bytes(413)
+
+
+def mp3_issues(tmp_path, data):
+    path = tmp_path / 'a.mp3'
+    path.write_bytes(data)
+    return verify.check_mp3_frames(os.fspath(path))
+
+
+def test_digest_ignores_the_chunks(make_wav, tmp_path):
+    path = make_wav('a.wav', 0.2)
+    digest, info, frames = verify.pcm_digest(path)
+    assert frames == info.frames == 8820
+
+    tags.write_tags(path, {'title': 'tagged'})
+    assert verify.pcm_digest(path)[0] == digest
+
+
+def test_verify_file(make_wav):
+    path = make_wav('a.wav', 0.2)
+    report = verify.verify_file(path, expected_frames=8820)
+    assert report['ok'], report
+    assert (report['format'], report['channels'], report['frames'], report['duration_ms']) == ('wav', 2, 8820, 200)
+
+    report = verify.verify_file(path, expected_frames=8800, tolerance=10)
+    assert report['issues'] == ['8820 frames, expected 8800 (tolerance 10)']
+    assert verify.verify_file(path, expected_frames=8800, tolerance=20)['ok']
+    assert verify.verify_file(path, same_as='0' * 64)['issues'] == ['PCM is different from the reference']
+
+
+def test_truncated_data(make_wav):
+    path = make_wav('a.wav', 0.2)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 400)
+    report = verify.verify_file(path)
+    assert report['issues'] == ['data is truncated (8720 of 8820 frames in the header)']
+
+
+def test_corrupt_and_missing(corrupt_wavs, tmp_path):
+    for path in corrupt_wavs:
+        report = verify.verify_file(path)
+        assert not report['ok']
+        assert report['issues'][0].startswith('Invalid wav data')
+    assert verify.verify_file(os.fspath(tmp_path / 'missing.wav'))['issues'] == ['Source file does not exist.']
+
+
+def test_mp3_frames_clean(tmp_path):
+    report, issues = mp3_issues(tmp_path, FRAME * 4 + b'TAG' + bytes(125))
+    assert report == {'mp3_frames': 4, 'xing_frames': None}
+    assert issues == []
+
+
+def test_mp3_frames_broken(tmp_path):
+    report, issues = mp3_issues(tmp_path, FRAME * 2 + b'garbage' + FRAME * 3)
+    assert report['mp3_frames'] == 5
+    assert issues == [f'broken mp3 data at {2 * len(FRAME)} (7 bytes)']
+
+    report, issues = mp3_issues(tmp_path, FRAME * 2 + FRAME[:100])
+    assert issues == [f'last mp3 frame is truncated at {2 * len(FRAME)} (100 of 417 bytes)']
+
+    report, issues = mp3_issues(tmp_path, FRAME * 2 + b'\x00' * 50)
+    assert issues == [f'no mp3 frame after {2 * len(FRAME)} (50 bytes)']
+
+    assert mp3_issues(tmp_path, b'\x00' * 1000)[1][-1] == 'no mp3 frame'
+
+
+@pytest.mark.ffmpeg
+def test_mp3_file(make_wav, tmp_path):
+    sound_api.convert_file(make_wav('a.wav', 1.0), os.fspath(tmp_path / 'a.mp3'))
+    report = verify.verify_file(os.fspath(tmp_path / 'a.mp3'), expected_frames=44100, tolerance=verify.MP3_TOLERANCE_FRAMES)
+    assert report['ok'], report
+    assert report['xing_frames'] == report['mp3_frames'] - 1
+
+
+def test_verify_result_chunk(make_wav, tmp_path):
+    source = make_wav('a.wav', 0.2)
+    tags.write_tags(source, {'title': 'x'})
+    result = sound_api.remove_chunks_file(source, os.fspath(tmp_path / 'b.wav'))
+    report = verify.verify_result(result)
+    assert report['ok'], report
+    assert report['operation'] == 'chunk' and report['expected_frames'] == 8820
+
+
+@pytest.mark.ffmpeg
+def test_verify_result_clip_and_join(make_wav, tmp_path):
+    source = make_wav('a.wav', 1.0)
+    clipped = sound_api.clip_file(source, os.fspath(tmp_path / 'clip.wav'), 100, 600)
+    assert verify.verify_result(clipped, 100, 600)['ok']
+    joined = sound_api.join_files(source, os.fspath(tmp_path / 'clip.wav'), os.fspath(tmp_path / 'join.wav'))
+    report = verify.verify_result(joined)
+    assert report['ok'], report
+    assert report['expected_frames'] == 44100 + 22050
+
+
+def test_verify_files(make_wav, corrupt_wavs, tmp_path):
+    make_wav('a.wav', 0.1)
+    for jobs in (1, 2):
+        reports = list(verify.verify_files([os.fspath(tmp_path)], jobs=jobs))
+        assert [os.path.basename(r['file']) for r in reports] == ['a.wav', 'head.wav', 'not_riff.wav', 'truncated.wav', 'whole.wav']
+        assert [r['ok'] for r in reports] == [True, False, False, False, True]
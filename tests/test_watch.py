@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import batch
+import watch
+
+
+def chunk_jobs(path):
+    stem, _ = os.path.splitext(path)
+    return [batch.Job('chunk', (path,), f'{stem}.out.wav')]
+
+
+def make_ingest(root, state_file, make_jobs=chunk_jobs, **kwargs):
+    return watch.Ingest(os.fspath(root), make_jobs, batch.Scheduler(), os.fspath(state_file), jobs=2, **kwargs)
+
+
+def run_until(ingest, count, timeout=20.0):
+    """
+    Run the ingest on a thread until count files are done, returns the WatchResults
+    """
+    done = []
+    ingest.on_done = done.append
+    stop = threading.Event()
+    thread = threading.Thread(target=ingest.run, args=(stop,))
+    thread.start()
+    deadline = time.monotonic() + timeout
+    while len(done) < count and time.monotonic() < deadline:
+        time.sleep(0.05)
+    stop.set()
+    thread.join()
+    return done
+
+
+def rows(state_file):
+    db = watch.open_state(os.fspath(state_file))
+    try:
+        return {os.path.basename(path): (status, error) for path, status, error in db.execute('SELECT path, status, error FROM files')}
+    finally:
+        db.close()
+
+
+def test_settle_time(make_wav, tmp_path):
+    path = os.path.abspath(make_wav('a.wav', 0.1))
+    ingest = make_ingest(tmp_path, tmp_path / 'state.sqlite', settle=2.0)
+    db = watch.open_state(os.fspath(tmp_path / 'state.sqlite'))
+    try:
+        with ThreadPoolExecutor(1) as pool:
+            ingest._touch(path, 0.0)
+            ingest._submit_settled(db, pool, 1.0)
+            assert not ingest.running
+
+            # a file still being written is not processed
+            with open(path, 'ab') as f:
+                f.write(bytes(4))
+            ingest._submit_settled(db, pool, 2.5)
+            assert not ingest.running and ingest.pending[path].changed == 2.5
+
+            ingest._submit_settled(db, pool, 4.5)
+            assert len(ingest.running) == 1 and not ingest.pending
+            ingest._collect(db, 5.0, block=True)
+            assert not ingest.running
+    finally:
+        db.close()
+    assert rows(tmp_path / 'state.sqlite') == {'a.wav': ('done', None)}
+
+
+def test_ignored_files(make_wav, tmp_path):
+    ingest = make_ingest(tmp_path, tmp_path / 'state.sqlite')
+    ingest.outputs = {os.fspath(tmp_path / 'out.wav')}
+    (tmp_path / '.hidden').mkdir()
+    for path in (tmp_path / 'out.wav', tmp_path / '.hidden' / 'a.wav', tmp_path / '.a.tmp.wav', tmp_path / 'notes.txt'):
+        path.write_bytes(b'')
+        ingest._touch(os.fspath(path), 0.0)
+    assert ingest.pending == {}
+
+
+def test_poller(make_wav, tmp_path):
+    make_wav('a.wav', 0.1)
+    poller = watch.Poller(os.fspath(tmp_path), interval=0.0)
+    assert poller.events(0.0) == []
+    path = make_wav('b.wav', 0.1)
+    make_wav('.c.wav', 0.1)
+    assert poller.events(0.0) == [path]
+    os.utime(tmp_path / 'a.wav', ns=(0, 0))
+    assert poller.events(0.0) == [os.fspath(tmp_path / 'a.wav')]
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/sys/fs/inotify'), reason='inotify is not available')
+def test_inotify(make_wav, tmp_path):
+    watcher = watch.open_watcher(os.fspath(tmp_path))
+    try:
+        assert isinstance(watcher, watch.Inotify)
+        path = make_wav('a.wav', 0.1)
+        assert path in watcher.events(1.0)
+
+        # the files of a new directory are reported
+        (tmp_path / 'sub').mkdir()
+        path = make_wav('sub/b.wav', 0.1)
+        events = watcher.events(1.0) + watcher.events(0.2)
+        assert path in events
+    finally:
+        watcher.close()
+
+
+@pytest.mark.parametrize('poll', [False, True])
+def test_bad_files_fail_alone(make_wav, corrupt_wavs, tmp_path, poll):
+    state_file = tmp_path / '.state.sqlite'
+    make_wav('good.wav', 0.1)
+    results = run_until(make_ingest(tmp_path, state_file, settle=0.1, poll=poll, interval=0.1), 5)
+    assert len(results) == 5
+    assert sorted(os.path.basename(r.path) for r in results if r.ok) == ['good.wav', 'whole.wav']
+    state = rows(state_file)
+    assert state['good.wav'] == ('done', None)
+    for name in ('truncated.wav', 'not_riff.wav', 'head.wav'):
+        status, error = state[name]
+        assert status == 'failed' and error.startswith('Invalid wav data')
+    assert (tmp_path / 'good.out.wav').exists()
+
+    # a restart does not process them again, the outputs are not inputs
+    assert run_until(make_ingest(tmp_path, state_file, settle=0.1, poll=poll, interval=0.1), 1, timeout=1.0) == []
+
+    # a modified file is processed again
+    make_wav('good.wav', 0.2)
+    results = run_until(make_ingest(tmp_path, state_file, settle=0.1, poll=poll, interval=0.1), 1)
+    assert [os.path.basename(r.path) for r in results] == ['good.wav']
+    assert results[0].results[0].error == 'Destination file already exists.'
+    assert rows(state_file)['good.wav'][0] == 'failed'
+
+
+def test_make_jobs_error(make_wav, tmp_path):
+    def broken(path):
+        raise ValueError('no jobs')
+
+    make_wav('a.wav', 0.1)
+    results = run_until(make_ingest(tmp_path, tmp_path / '.state.sqlite', make_jobs=broken, settle=0.0), 1)
+    assert results[0].error == 'ValueError: no jobs'
+    assert rows(tmp_path / '.state.sqlite') == {'a.wav': ('failed', 'ValueError: no jobs')}
+
+
+def test_watch_command_errors(cli, tmp_path):
+    assert 'missing is not a directory.' in cli('watch', '--do', 'chunk {source} {stem}.out.wav', 'missing').stderr
+    (tmp_path / 'in').mkdir()
+    assert 'Invalid placeholder' in cli('watch', '--do', 'chunk {source} {other}.wav', 'in').stderr
+    assert '--do 1: batch can not be a job.' in cli('watch', '--do', 'batch {source}', 'in').stderr
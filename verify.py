@@ -0,0 +1,239 @@
+# 
+# Integrity verification of sound files
+# 
+# The hash is computed over the decoded PCM, not the container bytes, so the same
+# sound gives the same hash whatever chunks or tags the file has.
+# Wav is read natively, mp3 is decoded by ffmpeg through a pipe (the hash of mp3 depends
+# on the decoder). The mp3 frames are walked in the mapped file to find broken or truncated frames.
+# Every check streams the file by blocks, the memory does not depend on the length.
+# 
+
+import hashlib
+import math
+import mmap
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+import parallel_mp3
+import sound_api
+from sound_api import SoundFileError
+
+
+BLOCK_FRAMES = 1 << 16
+MP3_TOLERANCE_FRAMES = 2 * 1152     # encoder delay / padding rounding of a re-encode
+RESYNC_FRAMES = 2                   # valid frames in a row to resync after a broken part
+
+
+def pcm_digest(source_file):
+    """
+    (sha256 hex digest of the decoded PCM, AudioInfo, frames actually decoded)
+    """
+    digest = hashlib.sha256()
+    frames = 0
+    with sound_api.BlockReader(source_file, block_frames=BLOCK_FRAMES) as reader:
+        info = reader.info
+        frame_size = info.channels * info.sample_width
+        while buf := reader.read_raw(BLOCK_FRAMES):
+            digest.update(buf)
+            frames += len(buf) // frame_size
+    return digest.hexdigest(), info, frames
+
+
+def _frame_size_at(buf, offset):
+    if offset + 4 > len(buf):
+        return None
+    return parallel_mp3._frame_size(struct.unpack_from('>I', buf, offset)[0])
+
+
+def _resync(buf, offset):
+    """
+    Offset of the next run of RESYNC_FRAMES valid frames, None if there is none
+    """
+    end = len(buf)
+    while (offset := buf.find(b'\xff', offset)) >= 0:
+        position = offset
+        for _ in range(RESYNC_FRAMES):
+            size = _frame_size_at(buf, position)
+            if size is None or position + size > end:
+                break
+            position += size
+        else:
+            return offset
+        offset += 1
+    return None
+
+
+def check_mp3_frames(source_file):
+    """
+    Walk the mp3 frames, returns ({'mp3_frames': .., 'xing_frames': ..}, issues)
+    """
+    issues = []
+    with open(source_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        end = len(buf)
+        offset = parallel_mp3.id3v2_size(buf[:10])
+        frames = 0
+        xing_frames = None
+        broken = 0
+
+        while offset + 4 <= end:
+            size = _frame_size_at(buf, offset)
+            if size is not None and offset + size <= end:
+                if frames == 0:
+                    xing_frames = parallel_mp3.xing_frames(buf[offset:offset + size])
+                frames += 1
+                offset += size
+                continue
+            if size is not None:
+                issues.append(f'last mp3 frame is truncated at {offset} ({end - offset} of {size} bytes)')
+                offset = end
+                break
+
+            # trailing tags
+            if buf[offset:offset + 3] == b'TAG' and end - offset == 128:
+                offset = end
+                break
+            if buf[offset:offset + 8] == b'APETAGEX' or buf[offset:offset + 11] == b'LYRICSBEGIN':
+                offset = end
+                break
+
+            position = _resync(buf, offset + 1)
+            if position is None:
+                issues.append(f'no mp3 frame after {offset} ({end - offset} bytes)')
+                offset = end
+                break
+            broken += 1
+            if broken <= 10:
+                issues.append(f'broken mp3 data at {offset} ({position - offset} bytes)')
+            offset = position
+
+        if offset < end:
+            issues.append(f'trailing bytes at {offset} ({end - offset} bytes)')
+        if broken > 10:
+            issues.append(f'broken mp3 data at {broken - 10} more places')
+
+    if frames == 0:
+        issues.append('no mp3 frame')
+    # the Xing frame itself is not counted in the tag
+    if xing_frames is not None and xing_frames != frames - 1:
+        issues.append(f'Xing tag has {xing_frames} frames but the stream has {frames - 1}')
+    return {'mp3_frames': frames, 'xing_frames': xing_frames}, issues
+
+
+def _check_expected(report, issues, expected_frames=None, tolerance=0, same_as=None):
+    if expected_frames is not None:
+        report['expected_frames'] = expected_frames
+        if abs(report['frames'] - expected_frames) > tolerance:
+            issues.append(f'{report["frames"]} frames, expected {expected_frames} (tolerance {tolerance})')
+    if same_as is not None and report['pcm_sha256'] != same_as:
+        issues.append('PCM is different from the reference')
+
+
+def verify_file(source_file, expected_frames=None, tolerance=0, same_as=None):
+    """
+    Report (dict) of a sound file : format, frames, PCM hash and the issues.
+    expected_frames is checked with the tolerance, same_as is a PCM hash to be equal to.
+    """
+    report = {'file': source_file}
+    issues = []
+    try:
+        sound_api.check_source(source_file)
+        fmt = sound_api._check_format(sound_api._extension(source_file))
+        report['format'] = fmt.lstrip('.')
+
+        if fmt == '.mp3':
+            mp3_report, mp3_issues = check_mp3_frames(source_file)
+            report.update(mp3_report)
+            issues += mp3_issues
+
+        sha256, info, frames = pcm_digest(source_file)
+        report.update({
+            'channels': info.channels,
+            'frame_rate': info.frame_rate,
+            'sample_width': info.sample_width,
+            'frames': frames,
+            'duration_ms': round(frames * 1000 / info.frame_rate),
+            'pcm_sha256': sha256,
+        })
+        if info.frames is not None and info.frames != frames:
+            issues.append(f'data is truncated ({frames} of {info.frames} frames in the header)')
+        _check_expected(report, issues, expected_frames, tolerance, same_as)
+    except (SoundFileError, OSError, ValueError) as e:
+        issues.append(str(e))
+
+    report['issues'] = issues
+    report['ok'] = not issues
+    return report
+
+
+def _frames_of(source_file):
+    if sound_api._extension(source_file) == '.wav':
+        # header only
+        info = sound_api.probe(source_file)
+        return info.frames, info.frame_rate
+    # mp3, the length is known after decoding only
+    _, info, frames = pcm_digest(source_file)
+    return frames, info.frame_rate
+
+
+def verify_result(result, start=None, end=None):
+    """
+    Report of the output of a file operation (FileResult), the frames are checked
+    against the sources. start / end are the parameters of clip.
+    """
+    report = verify_file(result.destination)
+    report = {'operation': result.operation, 'sources': list(result.sources), **report}
+    if 'frames' not in report:
+        return report
+
+    output_rate = report['frame_rate']
+    sources = [_frames_of(source_file) for source_file in result.sources]
+    frames, frame_rate = sources[0]
+    mp3 = any(sound_api._extension(path) == '.mp3' for path in (*result.sources, result.destination))
+    tolerance = MP3_TOLERANCE_FRAMES if mp3 else 0
+    same_as = None
+
+    if result.operation == 'clip':
+        length = round(frames * 1000 / frame_rate)
+        start, end = sound_api.clip_range(length, start, end)
+        expected = round((end - start) * output_rate / 1000)
+        tolerance += math.ceil(output_rate / 1000)
+    elif result.operation == 'join':
+        expected = sum(frames for frames, _ in sources)
+    elif result.operation in ('samrate', 'chain'):
+        expected = round(frames * output_rate / frame_rate)
+        tolerance += math.ceil(output_rate / 1000)
+    elif result.operation == 'mix':
+        # the length depends on the offsets of the sources
+        expected = None
+    else:
+        expected = frames
+        if result.operation == 'chunk':
+            # only the chunks are removed, the PCM is the same
+            same_as, _, _ = pcm_digest(result.sources[0])
+
+    issues = report.pop('issues')
+    del report['ok']
+    _check_expected(report, issues, expected, tolerance, same_as)
+    report['issues'] = issues
+    report['ok'] = not issues
+    return report
+
+
+def _verify_job(job):
+    """
+    Worker process : report of one file
+    """
+    return verify_file(*job)
+
+
+def verify_files(targets, jobs=None, expected_frames=None, tolerance=0, same_as=None):
+    """
+    Reports of the sound files of targets in the order of the files
+    """
+    work = [(path, expected_frames, tolerance, same_as) for path in sound_api.find_sound_files(targets)]
+    if len(work) <= 1 or jobs == 1:
+        yield from map(_verify_job, work)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        yield from pool.map(_verify_job, work)
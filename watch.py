@@ -0,0 +1,359 @@
+# 
+# Watch folder ingestion
+# 
+# New or modified sound files of a directory tree are detected by inotify (Linux, through libc)
+# or by polling the modification times (other systems, or when inotify is not available).
+# A file is processed when it has not changed for the settle time, so a file which is still
+# being copied is never read half written. The jobs of a file run in order on a worker pool,
+# and the size and mtime of the processed files are kept in an SQLite state file, so a restart
+# does not process them again. The outputs of the jobs and the hidden files (temporary outputs)
+# are ignored, so the outputs may be written into the watched tree.
+# 
+
+import ctypes
+import ctypes.util
+import os
+import select
+import sqlite3
+import struct
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+import sound_api
+
+
+DEFAULT_STATE = 'watch.sqlite'
+SETTLE_SEC = 2.0                # no change for this time before a file is processed
+POLL_SEC = 1.0                  # interval of the polling watcher
+TICK_SEC = 0.2                  # longest wait for events, the settled files are checked at this interval
+
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+_inotify_event = struct.Struct('iIII')      # wd, mask, cookie, len, followed by the name
+
+
+def _hidden(path, root):
+    relative = os.path.relpath(path, root)
+    return any(part.startswith('.') for part in relative.split(os.sep))
+
+
+def _walk(root):
+    """
+    Sound files of the tree, without the hidden files and directories
+    """
+    for path in sound_api.find_sound_files([root]):
+        if not _hidden(path, root):
+            yield os.path.abspath(path)
+
+
+class Inotify:
+    """
+    inotify watches of a directory tree, new subdirectories are watched as they appear
+    """
+    def __init__(self, root):
+        self.root = root
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}       # watch descriptor -> directory
+        try:
+            self._add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def _add_tree(self, top):
+        """
+        Watch the directories of the tree, returns the sound files found there
+        """
+        found = []
+        for directory, dirs, files in os.walk(top):
+            dirs[:] = [name for name in dirs if not name.startswith('.')]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno), directory)
+            self.watches[wd] = directory
+            found += [os.path.join(directory, name) for name in files if sound_api._extension(name) in sound_api.SUPPORTED_FORMATS]
+        return found
+
+    def events(self, timeout):
+        """
+        Paths changed within timeout
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while offset + _inotify_event.size <= len(buf):
+            wd, mask, _, length = _inotify_event.unpack_from(buf, offset)
+            name = buf[offset + _inotify_event.size:offset + _inotify_event.size + length].rstrip(b'\0')
+            offset += _inotify_event.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # events are lost, the whole tree is checked once
+                paths += _walk(self.root)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or not name:
+                continue
+            path = os.path.join(self.watches[wd], os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not os.path.basename(path).startswith('.'):
+                    # the files may be written before the watch is added
+                    try:
+                        paths += self._add_tree(path)
+                    except OSError:
+                        pass
+                continue
+            paths.append(path)
+        return paths
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class Poller:
+    """
+    Size and mtime of the files of a directory tree, compared every interval
+    """
+    def __init__(self, root, interval=POLL_SEC):
+        self.root = root
+        self.interval = interval
+        self.snapshot = self._scan()
+        self.next_scan = time.monotonic() + interval
+
+    def _scan(self):
+        snapshot = {}
+        for path in _walk(self.root):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def events(self, timeout):
+        wait_sec = self.next_scan - time.monotonic()
+        if wait_sec > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0.0, wait_sec))
+        snapshot = self._scan()
+        self.next_scan = time.monotonic() + self.interval
+        paths = [path for path, stat in snapshot.items() if self.snapshot.get(path) != stat]
+        self.snapshot = snapshot
+        return paths
+
+    def close(self):
+        pass
+
+
+def open_watcher(root, poll=False, interval=POLL_SEC):
+    """
+    Inotify on Linux, Poller if poll or inotify is not available
+    """
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return Inotify(root)
+        except (OSError, AttributeError):
+            # no libc inotify, or out of watches (fs.inotify.max_user_watches)
+            pass
+    return Poller(root, interval)
+
+
+# 
+# State
+# 
+
+def open_state(state_file):
+    db = sqlite3.connect(state_file)
+    db.execute('PRAGMA journal_mode = WAL')
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            processed_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS outputs (
+            path TEXT PRIMARY KEY
+        );
+    """)
+    return db
+
+
+@dataclass
+class Pending:
+    changed: float          # monotonic time of the last change
+    size: int
+    mtime_ns: int
+
+
+@dataclass
+class WatchResult:
+    path: str
+    results: list = field(default_factory=list)     # batch.JobResults
+    error: str | None = None
+    seconds: float = 0.0    # from the last change to the end of the jobs
+
+    @property
+    def ok(self):
+        return self.error is None and all(r.error is None for r in self.results)
+
+
+class Ingest:
+    """
+    Process the settled new / modified files of root.
+    make_jobs(path) returns the batch.Jobs of a file, run by scheduler.run_chain() on jobs threads.
+    on_start(watcher) and on_done(WatchResult) are called in the thread of run().
+    """
+    def __init__(self, root, make_jobs, scheduler, state_file=DEFAULT_STATE, jobs=None,
+                 settle=SETTLE_SEC, poll=False, interval=POLL_SEC, on_start=None, on_done=None):
+        self.root = os.path.abspath(root)
+        self.make_jobs = make_jobs
+        self.scheduler = scheduler
+        self.state_file = state_file
+        self.jobs = jobs or os.cpu_count() or 1
+        self.settle = settle
+        self.poll = poll
+        self.interval = interval
+        self.on_start = on_start
+        self.on_done = on_done
+        self.pending = {}       # path -> Pending
+        self.running = {}       # future -> (path, size, mtime_ns, changed)
+        self.outputs = set()
+
+    def _done_before(self, db, path, st):
+        """
+        Processed (done or failed) with the same size and mtime
+        """
+        row = db.execute('SELECT size, mtime_ns FROM files WHERE path = ?', (path,)).fetchone()
+        return row == (st.st_size, st.st_mtime_ns)
+
+    def _touch(self, path, now):
+        if path in self.outputs or _hidden(path, self.root) or sound_api._extension(path) not in sound_api.SUPPORTED_FORMATS:
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.pending.pop(path, None)
+            return
+        self.pending[path] = Pending(now, st.st_size, st.st_mtime_ns)
+
+    def _work(self, jobs):
+        for job in jobs:
+            os.makedirs(os.path.dirname(os.path.abspath(job.destination)), exist_ok=True)
+        return self.scheduler.run_chain(jobs)
+
+    def _submit_settled(self, db, pool, now):
+        busy = {path for path, *_ in self.running.values()}
+        for path, entry in list(self.pending.items()):
+            if now - entry.changed < self.settle or path in busy:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+            if (st.st_size, st.st_mtime_ns) != (entry.size, entry.mtime_ns):
+                # still being written
+                self.pending[path] = Pending(now, st.st_size, st.st_mtime_ns)
+                continue
+            del self.pending[path]
+            if self._done_before(db, path, st):
+                continue
+
+            try:
+                jobs = self.make_jobs(path)
+            except Exception as e:
+                self._finish(db, path, st.st_size, st.st_mtime_ns, WatchResult(path, error=sound_api.error_message(e)))
+                continue
+            # the outputs are registered before they appear
+            destinations = [os.path.abspath(job.destination) for job in jobs]
+            self.outputs.update(destinations)
+            with db:
+                db.executemany('INSERT OR IGNORE INTO outputs (path) VALUES (?)', [(d,) for d in destinations])
+            self.running[pool.submit(self._work, jobs)] = (path, st.st_size, st.st_mtime_ns, entry.changed)
+
+    def _finish(self, db, path, size, mtime_ns, watch_result):
+        if watch_result.ok:
+            status, error = 'done', None
+        else:
+            status = 'failed'
+            error = watch_result.error or next(r.error for r in watch_result.results if r.error is not None)
+        with db:
+            db.execute('INSERT OR REPLACE INTO files (path, size, mtime_ns, status, error, processed_at) VALUES (?, ?, ?, ?, ?, ?)',
+                       (path, size, mtime_ns, status, error, time.time()))
+        if self.on_done is not None:
+            self.on_done(watch_result)
+
+    def _collect(self, db, now, block=False):
+        if not self.running:
+            return
+        done, _ = wait(list(self.running), timeout=TICK_SEC if block else 0, return_when=FIRST_COMPLETED)
+        for future in done:
+            path, size, mtime_ns, changed = self.running.pop(future)
+            watch_result = WatchResult(path, seconds=time.monotonic() - changed)
+            try:
+                watch_result.results = future.result()
+            except Exception as e:
+                # a bad file fails alone and is recorded, the daemon goes on
+                watch_result.error = sound_api.error_message(e)
+            self._finish(db, path, size, mtime_ns, watch_result)
+            # changed again while it was processed
+            self._touch(path, now)
+
+    def run(self, stop=None):
+        """
+        Watch until stop (threading.Event) is set or KeyboardInterrupt, the running jobs are finished
+        """
+        db = open_state(self.state_file)
+        watcher = None
+        try:
+            self.outputs = {path for path, in db.execute('SELECT path FROM outputs')}
+            # the files dropped while the watcher was not running, once at the start
+            watcher = open_watcher(self.root, self.poll, self.interval)
+            now = time.monotonic()
+            for path in _walk(self.root):
+                self._touch(path, now)
+            if self.on_start is not None:
+                self.on_start(watcher)
+
+            with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='watch') as pool:
+                try:
+                    while stop is None or not stop.is_set():
+                        for path in watcher.events(TICK_SEC if not self.running else 0):
+                            self._touch(os.path.abspath(path), time.monotonic())
+                        self._submit_settled(db, pool, time.monotonic())
+                        self._collect(db, time.monotonic(), block=bool(self.running))
+                finally:
+                    while self.running:
+                        self._collect(db, time.monotonic(), block=True)
+        finally:
+            if watcher is not None:
+                watcher.close()
+            db.close()